@@ -0,0 +1,323 @@
+"""
+Benchmarks the staging and core loaders end to end against a local PostgreSQL instance.
+
+For every scale factor the production database is seeded with synthetic_data_generator, then every staging loader
+is timed for each transfer mode and every core loader once, both on a full load and on an incremental load of the
+newest rows. The throughput, latency and peak memory of each load are written to a results file and compared with
+a stored baseline.
+
+The benchmark truncates and reseeds the production, staging and core tables, and snapshots terminate the sessions
+of the databases they copy. It therefore runs against its own databases on the server of PRODUCTION_DSN and
+WAREHOUSE_DSN, production_benchmark and warehouse_benchmark by default, created beforehand with the production,
+staging and core tables (e.g. from pg_dump --schema-only of the pipeline databases). It refuses to run against the
+pipeline databases themselves unless --allow-pipeline-databases is given. Its watermarks are kept in a temporary
+folder, away from ETL_LOAD_PATH.
+
+Between loads the warehouse is reset by restoring template snapshots, see database_snapshot, which takes seconds
+and leaves no bloat to skew the next load. Seeded production databases are kept as snapshots too, so a rerun with
+--reuse-seed skips the data generation. Without the CREATEDB privilege, --truncate-reset truncates instead.
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import psycopg2
+from psycopg2 import sql
+
+import synthetic_data_generator
+from database_snapshot import create_snapshot, restore_snapshot, snapshot_exists
+from etl_logging import setup_logging
+from pipeline import (CORE_LOADERS, STAGING_LOADERS, STAGING_WATERMARKS, LoadOptions, PRODUCTION_DSN, WAREHOUSE_DSN,
+                      cascade_truncate_tables_core, cascade_truncate_tables_staging, close_connection_pools,
+                      connect_warehouse, close_connection, write_staging_watermark)
+
+# Loads shorter than this are too noisy to flag as regressions
+MIN_COMPARED_SECONDS = 0.5
+
+# Databases the benchmark seeds and loads by default, on the server of PRODUCTION_DSN and WAREHOUSE_DSN
+BENCHMARK_PRODUCTION_DATABASE = "production_benchmark"
+BENCHMARK_WAREHOUSE_DATABASE = "warehouse_benchmark"
+
+
+def use_databases(production_database, warehouse_database, logger):
+    """
+    Points PRODUCTION_DSN and WAREHOUSE_DSN at the given databases for the rest of the process. The pipeline
+    connects through these dicts, so they are updated in place, with the connection pools of the previous databases
+    closed first.
+    """
+    close_connection_pools()
+    PRODUCTION_DSN["database"] = production_database
+    WAREHOUSE_DSN["database"] = warehouse_database
+    logger.info(f"Benchmarking against the databases {production_database} and {warehouse_database}.")
+
+
+def timed_load(loader, args, trace_memory):
+    """
+    Runs a loader and measures it.
+
+    Returns:
+        dict: rows (None if the loader failed), seconds, rows_per_second and peak_memory_bytes.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        rows = loader(*args)
+    finally:
+        seconds = time.perf_counter() - started
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+    return {
+        "rows": rows,
+        "seconds": round(seconds, 4),
+        "rows_per_second": round(rows / seconds, 1) if rows and seconds else None,
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def incremental_cutoffs(fraction):
+    """
+    Returns the watermark of each staging table below which its production rows form the base of the incremental
+    load, so that the newest `fraction` of the rows is the delta.
+    """
+    conn = psycopg2.connect(**PRODUCTION_DSN)
+    try:
+        cutoffs = {}
+        with conn.cursor() as cursor:
+            for staging_table, (_, _, key_column) in STAGING_WATERMARKS.items():
+                cursor.execute(sql.SQL("SELECT percentile_disc(%s) WITHIN GROUP (ORDER BY {}) FROM {}").format(
+                    sql.Identifier(key_column), sql.Identifier("public", staging_table.split('.')[1])),
+                    (1 - fraction,))
+                cutoffs[staging_table] = cursor.fetchone()[0] or 0
+        return cutoffs
+    finally:
+        conn.close()
+
+
+def trim_staging(cutoffs, logger):
+    """
+    Deletes the staging rows past the cutoffs, leaving the base of the incremental load.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            for staging_table, cutoff in cutoffs.items():
+                _, _, key_column = STAGING_WATERMARKS[staging_table]
+                cursor.execute(sql.SQL("DELETE FROM {} WHERE {} > %s").format(
+                    sql.Identifier(*staging_table.split('.')), sql.Identifier(key_column)), (cutoff,))
+        warehouse_conn.commit()
+    finally:
+        close_connection(warehouse_conn)
+    logger.info("Staging trimmed to the base of the incremental load.")
+
+
+def run_staging_loads(folder, mode, load, scale_factor, logger, trace_memory):
+    """
+    Times every staging loader, extracting past the watermarks in folder.
+    """
+    results = []
+    options = LoadOptions(insert_mode=mode, maintenance=False)
+    for staging_table, loader in STAGING_LOADERS.items():
+        result = timed_load(loader, (folder, logger, options), trace_memory)
+        results.append({"scale_factor": scale_factor, "layer": "staging", "table": staging_table, "load": load,
+                        "mode": mode, **result})
+    return results
+
+
+def run_core_loads(load, scale_factor, logger, trace_memory):
+    """
+    Times every core loader over the current staging contents.
+    """
+    results = []
+    for loader in CORE_LOADERS:
+        result = timed_load(loader, (logger, LoadOptions(maintenance=False)), trace_memory)
+        results.append({"scale_factor": scale_factor, "layer": "core",
+                        "table": f"core.{loader.__name__.replace('delta_core_load_', '')}", "load": load,
+                        "mode": None, **result})
+    return results
+
+
+def seed_production(scale_factor, seed, logger, snapshots, reuse_seed):
+    """
+    Fills production at a scale factor, from the snapshot of an earlier seeding when reuse_seed allows it.
+    """
+    label = f"benchmark_sf{scale_factor:g}_seed{seed}".replace(".", "_")
+    if snapshots and reuse_seed and snapshot_exists(PRODUCTION_DSN, label):
+        restore_snapshot(PRODUCTION_DSN, label, logger)
+        return
+    production_conn = psycopg2.connect(**PRODUCTION_DSN)
+    try:
+        synthetic_data_generator.load_tables(
+            production_conn, synthetic_data_generator.generate_tables(scale_factor, seed), logger, replace=True)
+    finally:
+        production_conn.close()
+    if snapshots:
+        create_snapshot(PRODUCTION_DSN, label, logger)
+
+
+def run_benchmark(scale_factors, modes, fraction, logger, trace_memory=True, seed=42, snapshots=True,
+                  reuse_seed=False):
+    """
+    Seeds production at each scale factor and times the full and incremental loads of every table.
+
+    The full load starts from empty staging and core tables. The incremental load starts from core holding all but
+    the newest `fraction` of the rows and staging emptied as after the core load, then stages the delta in each
+    transfer mode and loads it into core. With snapshots the warehouse is restored to these starting points before
+    every transfer mode, otherwise staging is truncated.
+
+    Returns:
+        list: One result per layer, table, load and mode.
+    """
+    results = []
+    folder = tempfile.mkdtemp(prefix="etl_benchmark_")
+    cascade_truncate_tables_staging(logger)
+    cascade_truncate_tables_core(logger)
+    if snapshots:
+        create_snapshot(WAREHOUSE_DSN, "benchmark_empty", logger, folder)
+
+    for scale_factor in scale_factors:
+        seed_production(scale_factor, seed, logger, snapshots, reuse_seed)
+
+        for mode in modes:
+            if snapshots:
+                restore_snapshot(WAREHOUSE_DSN, "benchmark_empty", logger, folder)
+            else:
+                cascade_truncate_tables_staging(logger)
+                cascade_truncate_tables_core(logger)
+                for staging_table in STAGING_WATERMARKS:
+                    write_staging_watermark(folder, staging_table, 0)
+            results += run_staging_loads(folder, mode, "full", scale_factor, logger, trace_memory)
+        results += run_core_loads("full", scale_factor, logger, trace_memory)
+
+        # Starting point of the incremental load: the base rows in core, staging consumed, watermarks at the cutoffs
+        cutoffs = incremental_cutoffs(fraction)
+        cascade_truncate_tables_core(logger)
+        trim_staging(cutoffs, logger)
+        for loader in CORE_LOADERS:
+            loader(logger, LoadOptions(maintenance=False))
+        cascade_truncate_tables_staging(logger)
+        for staging_table, cutoff in cutoffs.items():
+            write_staging_watermark(folder, staging_table, cutoff)
+        if snapshots:
+            create_snapshot(WAREHOUSE_DSN, "benchmark_incremental", logger, folder)
+
+        for mode in modes:
+            if snapshots:
+                restore_snapshot(WAREHOUSE_DSN, "benchmark_incremental", logger, folder)
+            else:
+                cascade_truncate_tables_staging(logger)
+                for staging_table, cutoff in cutoffs.items():
+                    write_staging_watermark(folder, staging_table, cutoff)
+            results += run_staging_loads(folder, mode, "incremental", scale_factor, logger, trace_memory)
+        results += run_core_loads("incremental", scale_factor, logger, trace_memory)
+        logger.info(f"Benchmark of scale factor {scale_factor} done.")
+    return results
+
+
+def result_key(result):
+    return result["scale_factor"], result["layer"], result["table"], result["load"], result["mode"]
+
+
+def compare_with_baseline(results, baseline, threshold):
+    """
+    Lists the loads that failed, or got slower than the baseline by more than threshold (0.1 = 10%), ignoring
+    loads shorter than MIN_COMPARED_SECONDS in both runs.
+
+    Returns:
+        list: Descriptions of the regressions.
+    """
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = result_key(result)
+        if result["rows"] is None:
+            regressions.append(f"{key}: failed")
+            continue
+        previous = baseline_results.get(key)
+        if previous is None or previous["rows"] is None:
+            continue
+        if max(result["seconds"], previous["seconds"]) < MIN_COMPARED_SECONDS:
+            continue
+        if result["seconds"] > previous["seconds"] * (1 + threshold):
+            regressions.append(f"{key}: {result['seconds']:.2f}s against {previous['seconds']:.2f}s "
+                               f"(+{result['seconds'] / previous['seconds'] - 1:.0%})")
+    return regressions
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the staging and core loaders against a local database.")
+    parser.add_argument("--scale-factors", default="1", help="comma separated scale factors to seed (default: 1)")
+    parser.add_argument("--modes", default="insert,values,copy",
+                        help="comma separated staging transfer modes to time (default: all)")
+    parser.add_argument("--incremental-fraction", type=float, default=0.1,
+                        help="share of the newest rows loaded by the incremental load (default: 0.1)")
+    parser.add_argument("--results", default="benchmark_results.json", help="file receiving the results")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="stored results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown against the baseline reported as a regression (default: 0.1 = 10%%)")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the peak memory tracking, which slows down the Python side of the loads")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the synthetic data")
+    parser.add_argument("--reuse-seed", action="store_true",
+                        help="restore production from the snapshot of an earlier run with the same scale factor and "
+                             "seed instead of generating it again")
+    parser.add_argument("--truncate-reset", action="store_true",
+                        help="reset the warehouse by truncating instead of restoring snapshots, which need CREATEDB")
+    parser.add_argument("--production-database", default=BENCHMARK_PRODUCTION_DATABASE,
+                        help=f"production database to seed (default: {BENCHMARK_PRODUCTION_DATABASE})")
+    parser.add_argument("--warehouse-database", default=BENCHMARK_WAREHOUSE_DATABASE,
+                        help=f"warehouse database to load (default: {BENCHMARK_WAREHOUSE_DATABASE})")
+    parser.add_argument("--allow-pipeline-databases", action="store_true",
+                        help="allow benchmarking against the databases of the pipeline, whose data it destroys")
+    args = parser.parse_args(argv)
+    pipeline_databases = {PRODUCTION_DSN["database"], WAREHOUSE_DSN["database"]}
+    if args.production_database == args.warehouse_database:
+        parser.error("--production-database and --warehouse-database must differ")
+    if {args.production_database, args.warehouse_database} & pipeline_databases and not args.allow_pipeline_databases:
+        parser.error(f"refusing to truncate the pipeline databases {', '.join(sorted(pipeline_databases))}, "
+                     "pass --allow-pipeline-databases to benchmark against them")
+
+    logger = setup_logging("benchmark.log")
+    use_databases(args.production_database, args.warehouse_database, logger)
+    results = run_benchmark([float(value) for value in args.scale_factors.split(",")],
+                            [mode.strip() for mode in args.modes.split(",")], args.incremental_fraction, logger,
+                            trace_memory=not args.no_memory, seed=args.seed, snapshots=not args.truncate_reset,
+                            reuse_seed=args.reuse_seed)
+    report = {"commit": current_commit(), "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+    with open(args.results, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"{len(results)} results written to {args.results}.")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline saved to {args.baseline}.")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to store one.")
+        return 0
+
+    with open(args.baseline) as file:
+        regressions = compare_with_baseline(results, json.load(file), args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"{len(regressions)} regressions against {args.baseline}.")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
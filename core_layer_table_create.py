@@ -1,10 +1,67 @@
-import logging
+import argparse
+import calendar
+from datetime import date
+
 import psycopg2
+from psycopg2 import sql
+
+from etl_logging import setup_logging
+
+# Fact tables that are range partitioned by month, with their partition key column
+PARTITIONED_FACT_TABLES = {
+    "sales_fact": "time_id",
+    "returns_fact": "return_date",
+}
+
+# Secondary indexes of the star schema. BRIN on the append-ordered time keys, b-tree on the fact foreign keys used
+# by star joins and covering indexes for the usual dimension lookups.
+CORE_INDEXES = [
+    ("sales_fact_time_id_brin",
+     "CREATE INDEX IF NOT EXISTS sales_fact_time_id_brin ON {schema}.Sales_fact USING BRIN (time_id)"),
+    ("sales_fact_product_id_idx",
+     "CREATE INDEX IF NOT EXISTS sales_fact_product_id_idx ON {schema}.Sales_fact (product_id)"),
+    ("sales_fact_customer_id_idx",
+     "CREATE INDEX IF NOT EXISTS sales_fact_customer_id_idx ON {schema}.Sales_fact (customer_id)"),
+    ("sales_fact_campaign_id_idx",
+     "CREATE INDEX IF NOT EXISTS sales_fact_campaign_id_idx ON {schema}.Sales_fact (campaign_id)"),
+    ("sales_fact_supplier_id_idx",
+     "CREATE INDEX IF NOT EXISTS sales_fact_supplier_id_idx ON {schema}.Sales_fact (supplier_id)"),
+    ("sales_fact_order_id_idx",
+     "CREATE INDEX IF NOT EXISTS sales_fact_order_id_idx ON {schema}.Sales_fact (order_id)"),
+    ("returns_fact_return_date_brin",
+     "CREATE INDEX IF NOT EXISTS returns_fact_return_date_brin ON {schema}.returns_fact USING BRIN (return_date)"),
+    ("returns_fact_order_id_idx",
+     "CREATE INDEX IF NOT EXISTS returns_fact_order_id_idx ON {schema}.returns_fact (order_id)"),
+    ("returns_fact_product_id_idx",
+     "CREATE INDEX IF NOT EXISTS returns_fact_product_id_idx ON {schema}.returns_fact (product_id)"),
+    ("customer_product_ratings_fact_customer_id_idx",
+     "CREATE INDEX IF NOT EXISTS customer_product_ratings_fact_customer_id_idx "
+     "ON {schema}.customer_product_ratings_fact (customer_id)"),
+    ("customer_product_ratings_fact_product_id_idx",
+     "CREATE INDEX IF NOT EXISTS customer_product_ratings_fact_product_id_idx "
+     "ON {schema}.customer_product_ratings_fact (product_id)"),
+    ("time_dimension_timeid_idx",
+     "CREATE INDEX IF NOT EXISTS time_dimension_timeid_idx "
+     "ON {schema}.time_dimension (timeid) INCLUDE (date, year, quarter, month, day)"),
+    ("product_dimension_category_idx",
+     "CREATE INDEX IF NOT EXISTS product_dimension_category_idx "
+     "ON {schema}.product_dimension (category, sub_category) INCLUDE (product_id)"),
+    ("product_dimension_subcategory_id_idx",
+     "CREATE INDEX IF NOT EXISTS product_dimension_subcategory_id_idx "
+     "ON {schema}.product_dimension (subcategory_id)"),
+    ("customer_dimension_location_idx",
+     "CREATE INDEX IF NOT EXISTS customer_dimension_location_idx "
+     "ON {schema}.customer_dimension (country, state, city) INCLUDE (customer_id)"),
+    ("campaign_dimension_dates_idx",
+     "CREATE INDEX IF NOT EXISTS campaign_dimension_dates_idx "
+     "ON {schema}.campaign_dimension (start_date, end_date) INCLUDE (campaign_id)"),
+]
 
 
 def intialize_logger():
     """
-    Initializes and configures a logger with two handlers for error and info messages.
+    Initializes the logger writing JSON lines to create_table_warehouse.log from a background thread, see
+    etl_logging.
 
     Returns:
         logger (logging.Logger): The configured logger object.
@@ -12,39 +69,198 @@ def intialize_logger():
     Raises:
         None
     """
+    return setup_logging('create_table_warehouse.log')
+
+
+def create_etl_schema(conn, logger):
+    sql_query = """
+        CREATE SCHEMA IF NOT EXISTS etl;
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query)
+            conn.commit()
+            logger.info("etl schema created successfully.")
+    except Exception as e:
+        logger.error(f"Failed to create etl schema. Error: {e}")
+
+
+def create_load_rejects_table(conn, logger):
+    sql_query = """
+        CREATE TABLE IF NOT EXISTS etl.load_rejects (
+            reject_id BIGSERIAL PRIMARY KEY,
+            stage CHARACTER VARYING(20) NOT NULL,
+            table_name CHARACTER VARYING(100) NOT NULL,
+            record JSONB,
+            error TEXT NOT NULL,
+            rejected_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query)
+            conn.commit()
+            logger.info("load_rejects table created successfully.")
+    except Exception as e:
+        logger.error(f"Failed to create load_rejects table. Error: {e}")
+
+
+def create_run_id_sequence(conn, logger):
+    sql_query = """
+        CREATE SEQUENCE IF NOT EXISTS etl.run_id_seq;
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query)
+            conn.commit()
+            logger.info("run_id_seq sequence created successfully.")
+    except Exception as e:
+        logger.error(f"Failed to create run_id_seq sequence. Error: {e}")
+
+
+def create_pipeline_runs_table(conn, logger):
+    sql_query = """
+        CREATE TABLE IF NOT EXISTS etl.pipeline_runs (
+            run_id BIGINT PRIMARY KEY DEFAULT nextval('etl.run_id_seq'),
+            stage CHARACTER VARYING(20) NOT NULL,
+            status CHARACTER VARYING(20) NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            watermarks JSONB,
+            started_at TIMESTAMP NOT NULL DEFAULT now(),
+            finished_at TIMESTAMP,
+            error TEXT
+        );
+        CREATE INDEX IF NOT EXISTS pipeline_runs_stage_idx ON etl.pipeline_runs (stage, run_id);
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query)
+            conn.commit()
+            logger.info("pipeline_runs table created successfully.")
+    except Exception as e:
+        logger.error(f"Failed to create pipeline_runs table. Error: {e}")
 
-    # Configure logging with two handlers
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    # Handler for errors
-    error_handler = logging.FileHandler('create_table_warehouse.log')
-    error_handler.setLevel(logging.ERROR)
-    error_formatter = logging.Formatter('%(asctime)s [%(levelname)s] - %(message)s')
-    error_handler.setFormatter(error_formatter)
-    logger.addHandler(error_handler)
 
-    # Handler for info messages
-    info_handler = logging.FileHandler('create_table_warehouse.log')
-    info_handler.setLevel(logging.INFO)
-    info_formatter = logging.Formatter('%(asctime)s [%(levelname)s] - %(message)s')
-    info_handler.setFormatter(info_formatter)
-    logger.addHandler(info_handler)
+def create_core_run_undo_table(conn, logger):
+    """
+    Creates the table keeping the previous contents of the core rows a core run updated in place, the subcategory
+    lookup and renamed products, so a failed run can be rolled back completely.
+    """
+    sql_query = """
+        CREATE TABLE IF NOT EXISTS etl.core_run_undo (
+            undo_id BIGSERIAL PRIMARY KEY,
+            run_id BIGINT NOT NULL,
+            table_name CHARACTER VARYING(100) NOT NULL,
+            previous JSONB NOT NULL,
+            recorded_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS core_run_undo_run_idx ON etl.core_run_undo (run_id);
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query)
+            conn.commit()
+            logger.info("core_run_undo table created successfully.")
+    except Exception as e:
+        logger.error(f"Failed to create core_run_undo table. Error: {e}")
+
 
-    return logger
+def create_run_metrics_table(conn, logger):
+    sql_query = """
+        CREATE TABLE IF NOT EXISTS etl.run_metrics (
+            metric_id BIGSERIAL PRIMARY KEY,
+            run_id BIGINT,
+            stage CHARACTER VARYING(20) NOT NULL,
+            table_name CHARACTER VARYING(100) NOT NULL,
+            wall_seconds DOUBLE PRECISION NOT NULL,
+            cpu_seconds DOUBLE PRECISION NOT NULL,
+            rows BIGINT NOT NULL DEFAULT 0,
+            bytes BIGINT NOT NULL DEFAULT 0,
+            batches INTEGER NOT NULL DEFAULT 0,
+            retries INTEGER NOT NULL DEFAULT 0,
+            succeeded BOOLEAN NOT NULL,
+            session_profile CHARACTER VARYING(30),
+            session_settings JSONB,
+            recorded_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+        ALTER TABLE etl.run_metrics ADD COLUMN IF NOT EXISTS session_profile CHARACTER VARYING(30);
+        ALTER TABLE etl.run_metrics ADD COLUMN IF NOT EXISTS session_settings JSONB;
+        CREATE INDEX IF NOT EXISTS run_metrics_run_idx ON etl.run_metrics (run_id, stage);
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query)
+            conn.commit()
+            logger.info("run_metrics table created successfully.")
+    except Exception as e:
+        logger.error(f"Failed to create run_metrics table. Error: {e}")
 
 
-def create_customer_product_ratings_fact_table(conn, logger):
+def create_freshness_table(conn, logger):
     sql_query = """
-        CREATE TABLE IF NOT EXISTS core.customer_product_ratings_fact (
+        CREATE TABLE IF NOT EXISTS etl.freshness (
+            recorded_at TIMESTAMP NOT NULL DEFAULT now(),
+            source_table CHARACTER VARYING(100) NOT NULL,
+            production_max_key BIGINT,
+            staging_watermark BIGINT,
+            core_watermark BIGINT,
+            row_lag BIGINT,
+            time_lag_seconds DOUBLE PRECISION
+        );
+        CREATE INDEX IF NOT EXISTS freshness_source_table_idx ON etl.freshness (source_table, recorded_at);
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query)
+            conn.commit()
+            logger.info("freshness table created successfully.")
+    except Exception as e:
+        logger.error(f"Failed to create freshness table. Error: {e}")
+
+
+# Core tables whose rows are tagged with the run that loaded them, in dependency order
+RUN_TAGGED_TABLES = [
+    "time_dimension",
+    "customer_dimension",
+    "product_dimension",
+    "campaign_dimension",
+    "supplier_dimension",
+    "order_dimension",
+    "sales_fact",
+    "returns_fact",
+    "customer_product_ratings_fact",
+]
+
+
+def create_run_id_columns(conn, logger, schema="core"):
+    """
+    Adds the etl_run_id column to the dimension and fact tables, so the rows of a failed parallel load can be
+    removed again. Adding it to a partitioned table adds it to all of its partitions.
+    """
+    try:
+        with conn.cursor() as cursor:
+            for table_name in RUN_TAGGED_TABLES:
+                cursor.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS etl_run_id BIGINT").format(
+                    sql.Identifier(schema, table_name)))
+            conn.commit()
+            logger.info("etl_run_id columns created successfully.")
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Failed to create etl_run_id columns. Error: {e}")
+
+
+def create_customer_product_ratings_fact_table(conn, logger, schema="core"):
+    sql_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {schema}.customer_product_ratings_fact (
             customerproductrating_id SERIAL PRIMARY KEY,
-            customer_id INTEGER REFERENCES core.customer_dimension(customer_id),
-            product_id INTEGER REFERENCES core.product_dimension(product_id),
+            customer_id INTEGER REFERENCES {schema}.customer_dimension(customer_id),
+            product_id INTEGER REFERENCES {schema}.product_dimension(product_id),
             ratings NUMERIC(2,1),
             review VARCHAR(255),
             sentiment VARCHAR(10),
             CONSTRAINT customerproductrating_ratings_check CHECK (ratings >= 1 AND ratings <= 5)
         );
-    """
+    """).format(schema=sql.Identifier(schema))
     try:
         with conn.cursor() as cursor:
             cursor.execute(sql_query)
@@ -54,10 +270,11 @@ def create_customer_product_ratings_fact_table(conn, logger):
         logger.error(f"Failed to create customer_product_ratings_fact table. Error: {e}")
 
 
-def create_sales_fact_table(conn, logger):
-    sql_query = """
-        CREATE TABLE IF NOT EXISTS core.Sales_fact (
-            id SERIAL PRIMARY KEY,
+def create_sales_fact_table(conn, logger, schema="core"):
+    sql_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {schema}.Sales_fact (
+            id SERIAL,
+            orderitem_id INTEGER NOT NULL,
             order_id INTEGER NOT NULL,
             time_id INTEGER NOT NULL,
             product_id INTEGER NOT NULL,
@@ -68,13 +285,18 @@ def create_sales_fact_table(conn, logger):
             subtotal INTEGER NOT NULL,
             discount_percentage NUMERIC(3,2) NOT NULL,
             sales_price INTEGER NOT NULL,
-            FOREIGN KEY (customer_id) REFERENCES core.customer_dimension(customer_id),
-            FOREIGN KEY (supplier_id) REFERENCES core.supplier_dimension(supplier_id),
-            FOREIGN KEY (product_id) REFERENCES core.product_dimension(product_id),
-            FOREIGN KEY (campaign_id) REFERENCES core.campaign_dimension(campaign_id),
-            FOREIGN KEY (order_id) REFERENCES core.Order_dimension(order_id)
-        );
-    """
+            PRIMARY KEY (id, time_id),
+            -- one fact per order item, so loading an order item again inserts nothing
+            CONSTRAINT sales_fact_orderitem_key UNIQUE (orderitem_id, time_id),
+            FOREIGN KEY (customer_id) REFERENCES {schema}.customer_dimension(customer_id),
+            FOREIGN KEY (supplier_id) REFERENCES {schema}.supplier_dimension(supplier_id),
+            FOREIGN KEY (product_id) REFERENCES {schema}.product_dimension(product_id),
+            FOREIGN KEY (campaign_id) REFERENCES {schema}.campaign_dimension(campaign_id),
+            FOREIGN KEY (order_id) REFERENCES {schema}.Order_dimension(order_id)
+        ) PARTITION BY RANGE (time_id);
+        ALTER TABLE {schema}.sales_fact ADD COLUMN IF NOT EXISTS orderitem_id INTEGER;
+        CREATE UNIQUE INDEX IF NOT EXISTS sales_fact_orderitem_key ON {schema}.sales_fact (orderitem_id, time_id);
+    """).format(schema=sql.Identifier(schema))
     try:
         with conn.cursor() as cursor:
             cursor.execute(sql_query)
@@ -84,9 +306,9 @@ def create_sales_fact_table(conn, logger):
         logger.error(f"Failed to create Sales_fact table.  Error: {e}")
 
 
-def create_supplier_dimension_table(conn, logger):
-    sql_query = """
-        CREATE TABLE IF NOT EXISTS core.supplier_dimension (
+def create_supplier_dimension_table(conn, logger, schema="core"):
+    sql_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {schema}.supplier_dimension (
             supplier_id INTEGER PRIMARY KEY,
             supplier_name CHARACTER VARYING(50),
             email CHARACTER VARYING(50),
@@ -94,7 +316,7 @@ def create_supplier_dimension_table(conn, logger):
             state CHARACTER VARYING(50),
             city CHARACTER VARYING(50)
         );
-    """
+    """).format(schema=sql.Identifier(schema))
     try:
         with conn.cursor() as cursor:
             cursor.execute(sql_query)
@@ -104,14 +326,25 @@ def create_supplier_dimension_table(conn, logger):
         logger.error(f"Failed to create Supplier_dimension table. Error: {e}")
 
 
-def create_order_dimension_table(conn, logger):
-    sql_query = """
-        CREATE TABLE IF NOT EXISTS core.Order_dimension (
+def create_order_dimension_table(conn, logger, schema="core"):
+    sql_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {schema}.Order_dimension (
             order_id INTEGER PRIMARY KEY,
-            customer_id INTEGER REFERENCES core.product_dimension(product_id),
+            customer_id INTEGER REFERENCES {schema}.customer_dimension(customer_id),
             payment_method CHARACTER VARYING(50)
         );
-    """
+        -- tables created before the foreign key referenced customer_dimension get it replaced, unvalidated
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_constraint
+                       WHERE conrelid = {table}::regclass AND confrelid = {wrong_parent}::regclass) THEN
+                ALTER TABLE {schema}.order_dimension DROP CONSTRAINT order_dimension_customer_id_fkey;
+                ALTER TABLE {schema}.order_dimension ADD CONSTRAINT order_dimension_customer_id_fkey
+                    FOREIGN KEY (customer_id) REFERENCES {schema}.customer_dimension(customer_id) NOT VALID;
+            END IF;
+        END $$;
+    """).format(schema=sql.Identifier(schema), table=sql.Literal(f"{schema}.order_dimension"),
+                wrong_parent=sql.Literal(f"{schema}.product_dimension"))
     try:
         with conn.cursor() as cursor:
             cursor.execute(sql_query)
@@ -121,15 +354,15 @@ def create_order_dimension_table(conn, logger):
         logger.error(f"Failed to create Order_dimension table. Error: {e}")
 
 
-def create_campaign_dimension_table(conn, logger):
-    sql_query = """
-        CREATE TABLE IF NOT EXISTS core.campaign_dimension (
+def create_campaign_dimension_table(conn, logger, schema="core"):
+    sql_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {schema}.campaign_dimension (
             campaign_id INTEGER PRIMARY KEY,
             campaign_name CHARACTER VARYING(100) NOT NULL,
             start_date DATE NOT NULL,
             end_date DATE NOT NULL
         );
-    """
+    """).format(schema=sql.Identifier(schema))
     try:
         with conn.cursor() as cursor:
             cursor.execute(sql_query)
@@ -139,9 +372,9 @@ def create_campaign_dimension_table(conn, logger):
         logger.error(f"Failed to create Campaign_dimension table. Error: {e}")
 
 
-def create_customer_dimension_table(conn, logger):
-    sql_query = """
-        CREATE TABLE IF NOT EXISTS core.customer_dimension (
+def create_customer_dimension_table(conn, logger, schema="core"):
+    sql_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {schema}.customer_dimension (
             customer_id INTEGER PRIMARY KEY,
             first_name CHARACTER VARYING(50) NOT NULL,
             last_name CHARACTER VARYING(50) NOT NULL,
@@ -152,7 +385,7 @@ def create_customer_dimension_table(conn, logger):
             latitude DOUBLE PRECISION,
             longitude DOUBLE PRECISION
         );
-    """
+    """).format(schema=sql.Identifier(schema))
     try:
         with conn.cursor() as cursor:
             cursor.execute(sql_query)
@@ -162,17 +395,19 @@ def create_customer_dimension_table(conn, logger):
         logger.error(f"Failed to create Customer_dimension table. Error: {e}")
 
 
-def create_product_dimension_table(conn, logger):
-    sql_query = """
-        CREATE TABLE IF NOT EXISTS core.product_dimension (
+def create_product_dimension_table(conn, logger, schema="core"):
+    sql_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {schema}.product_dimension (
             product_id INTEGER PRIMARY KEY,
             name CHARACTER VARYING(255) NOT NULL,
             price NUMERIC(10,2) NOT NULL,
             description TEXT NOT NULL,
             category CHARACTER VARYING(100) NOT NULL,
-            sub_category CHARACTER VARYING(100) NOT NULL
+            sub_category CHARACTER VARYING(100) NOT NULL,
+            subcategory_id INTEGER
         );
-    """
+        ALTER TABLE {schema}.product_dimension ADD COLUMN IF NOT EXISTS subcategory_id INTEGER;
+    """).format(schema=sql.Identifier(schema))
     try:
         with conn.cursor() as cursor:
             cursor.execute(sql_query)
@@ -182,9 +417,32 @@ def create_product_dimension_table(conn, logger):
         logger.error(f"Failed to create Product_dimension table. Error: {e}")
 
 
-def create_time_dimension_table(conn, logger):
-    sql_query = """
-        CREATE TABLE IF NOT EXISTS core.time_dimension (
+def create_subcategory_lookup_table(conn, logger, schema="core"):
+    """
+    Creates the subcategory to category mapping the product dimension loader keeps to propagate category and
+    subcategory renames to the denormalised product rows.
+    """
+    sql_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {schema}.subcategory_lookup (
+            subcategory_id INTEGER PRIMARY KEY,
+            category_id INTEGER NOT NULL,
+            subcategory_name CHARACTER VARYING(100) NOT NULL,
+            category_name CHARACTER VARYING(100) NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS subcategory_lookup_category_id_idx ON {schema}.subcategory_lookup (category_id);
+    """).format(schema=sql.Identifier(schema))
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query)
+            conn.commit()
+            logger.info("subcategory_lookup table created successfully.")
+    except Exception as e:
+        logger.error(f"Failed to create subcategory_lookup table. Error: {e}")
+
+
+def create_time_dimension_table(conn, logger, schema="core"):
+    sql_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {schema}.time_dimension (
             id SERIAL PRIMARY KEY,
             timeid INTEGER NOT NULL,
             date DATE NOT NULL,
@@ -199,7 +457,7 @@ def create_time_dimension_table(conn, logger):
             minutes SMALLINT NOT NULL,
             seconds SMALLINT NOT NULL
         );
-    """
+    """).format(schema=sql.Identifier(schema))
     try:
         with conn.cursor() as cursor:
             cursor.execute(sql_query)
@@ -209,17 +467,18 @@ def create_time_dimension_table(conn, logger):
         logger.error(f"Failed to create Time_dimension table. Error: {e}")
 
 
-def create_returns_fact_table(conn, logger):
-    sql_query = """
-        CREATE TABLE IF NOT EXISTS core.returns_fact (
-            return_id SERIAL PRIMARY KEY,
-            order_id INTEGER REFERENCES core.Order_dimension(order_id),
-            product_id INTEGER REFERENCES core.product_dimension(product_id),
-            return_date DATE,
+def create_returns_fact_table(conn, logger, schema="core"):
+    sql_query = sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {schema}.returns_fact (
+            return_id SERIAL,
+            order_id INTEGER REFERENCES {schema}.Order_dimension(order_id),
+            product_id INTEGER REFERENCES {schema}.product_dimension(product_id),
+            return_date DATE NOT NULL,
             reason TEXT,
-            amount_refunded NUMERIC(10,2)
-        );
-    """
+            amount_refunded NUMERIC(10,2),
+            PRIMARY KEY (return_id, return_date)
+        ) PARTITION BY RANGE (return_date);
+    """).format(schema=sql.Identifier(schema))
     try:
         with conn.cursor() as cursor:
             cursor.execute(sql_query)
@@ -229,7 +488,300 @@ def create_returns_fact_table(conn, logger):
         logger.error(f"Failed to create returns_fact table. Error: {e}")
 
 
+def create_sales_aggregate_tables(conn, logger, schema="core"):
+    measures = """
+            order_lines BIGINT NOT NULL,
+            quantity BIGINT NOT NULL,
+            subtotal NUMERIC NOT NULL,
+            sales_amount NUMERIC NOT NULL,
+            discount_amount NUMERIC NOT NULL
+    """
+    sql_queries = {
+        "agg_daily_sales": f"""
+            CREATE TABLE IF NOT EXISTS {{schema}}.agg_daily_sales (
+                sales_date DATE PRIMARY KEY,{measures}
+            );
+        """,
+        "agg_product_sales": f"""
+            CREATE TABLE IF NOT EXISTS {{schema}}.agg_product_sales (
+                product_id INTEGER PRIMARY KEY,{measures}
+            );
+        """,
+        "agg_category_sales": f"""
+            CREATE TABLE IF NOT EXISTS {{schema}}.agg_category_sales (
+                category CHARACTER VARYING(100) NOT NULL,
+                sub_category CHARACTER VARYING(100) NOT NULL,{measures},
+                PRIMARY KEY (category, sub_category)
+            );
+        """,
+        "agg_campaign_sales": f"""
+            CREATE TABLE IF NOT EXISTS {{schema}}.agg_campaign_sales (
+                campaign_id INTEGER PRIMARY KEY,{measures}
+            );
+        """,
+        "agg_supplier_sales": f"""
+            CREATE TABLE IF NOT EXISTS {{schema}}.agg_supplier_sales (
+                supplier_id INTEGER PRIMARY KEY,{measures}
+            );
+        """,
+        "aggregate_watermark": """
+            CREATE TABLE IF NOT EXISTS {schema}.aggregate_watermark (
+                aggregate_name CHARACTER VARYING(50) PRIMARY KEY,
+                last_fact_id BIGINT NOT NULL,
+                refreshed_at TIMESTAMP NOT NULL DEFAULT now()
+            );
+        """,
+    }
+    for table_name, sql_query in sql_queries.items():
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL(sql_query).format(schema=sql.Identifier(schema)))
+                conn.commit()
+                logger.info(f"{table_name} table created successfully.")
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Failed to create {table_name} table. Error: {e}")
+
+
+def create_core_indexes(conn, logger, schema="core"):
+    for index_name, sql_query in CORE_INDEXES:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL(sql_query).format(schema=sql.Identifier(schema)))
+                conn.commit()
+                logger.info(f"{index_name} index created successfully.")
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Failed to create {index_name} index. Error: {e}")
+
+
+def report_index_usage(conn, logger):
+    """
+    Prints the size and usage of every index in the core schema, so indexes that cost more than they return can be
+    dropped. Partition indexes are summed into their partitioned parent index.
+
+    Usage counters are cumulative since the last statistics reset, so compare reports taken over a representative
+    period of dashboard traffic.
+    """
+    sql_query = """
+        WITH index_usage AS (
+            SELECT
+                COALESCE(parent.indexrelid, s.indexrelid) AS indexrelid,
+                s.idx_scan,
+                s.idx_tup_read,
+                pg_relation_size(s.indexrelid) AS index_bytes
+            FROM pg_stat_user_indexes s
+            LEFT JOIN pg_inherits inh ON inh.inhrelid = s.indexrelid
+            LEFT JOIN pg_index parent ON parent.indexrelid = inh.inhparent
+            WHERE s.schemaname = 'core'
+        )
+        SELECT
+            i.indrelid::regclass::text AS table_name,
+            u.indexrelid::regclass::text AS index_name,
+            i.indisprimary OR i.indisunique AS is_constraint,
+            sum(u.index_bytes) AS index_bytes,
+            sum(u.idx_scan) AS idx_scan,
+            sum(u.idx_tup_read) AS idx_tup_read
+        FROM index_usage u
+        JOIN pg_index i ON i.indexrelid = u.indexrelid
+        GROUP BY 1, 2, 3
+        ORDER BY 4 DESC
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query)
+            rows = cursor.fetchall()
+    except Exception as e:
+        logger.error(f"Failed to report index usage. Error: {e}")
+        return
+
+    print(f"{'table':<40} {'index':<55} {'size':>12} {'scans':>12} {'tuples read':>14}")
+    for table_name, index_name, is_constraint, index_bytes, idx_scan, idx_tup_read in rows:
+        flag = "  <- unused" if idx_scan == 0 and not is_constraint else ""
+        print(f"{table_name:<40} {index_name:<55} {int(index_bytes) // 1024:>10}kB {int(idx_scan):>12} "
+              f"{int(idx_tup_read):>14}{flag}")
+    logger.info(f"Index usage reported for {len(rows)} core indexes.")
+
+
+def next_month_start(month):
+    """
+    Returns the first day of the month following month.
+    """
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def month_starts(first_day, last_day):
+    """
+    Yields the first day of every month between first_day and last_day (inclusive).
+    """
+    month = date(first_day.year, first_day.month, 1)
+    while month <= last_day:
+        yield month
+        month = next_month_start(month)
+
+
+def monthly_partition_bounds(table_name, month):
+    """
+    Returns the partition name and the [lower, upper) bounds of the monthly partition of a fact table.
+
+    Args:
+        table_name (str): One of PARTITIONED_FACT_TABLES, e.g. 'sales_fact'.
+        month (date): The first day of the month.
+
+    Returns:
+        tuple: (partition_name, lower, upper). Bounds are epoch seconds for time_id and dates for return_date.
+    """
+    next_month = next_month_start(month)
+    if PARTITIONED_FACT_TABLES[table_name] == "time_id":
+        lower, upper = calendar.timegm(month.timetuple()), calendar.timegm(next_month.timetuple())
+    else:
+        lower, upper = month, next_month
+    return f"{table_name}_p{month:%Y_%m}", lower, upper
+
+
+def create_monthly_partition(conn, table_name, month, detached=False, schema="core"):
+    """
+    Creates the monthly partition of a fact table inside the caller's transaction.
+
+    A detached partition is created as a standalone table with a CHECK constraint matching its bounds, so it can be
+    loaded without touching the parent and then attached by attach_monthly_partition without a validation scan. It
+    has the indexes of the parent, so its unique keys reject the same rows the parent would, and attaching it
+    adopts them instead of building them.
+
+    Args:
+        conn (connection): Connection to the warehouse database.
+        table_name (str): One of PARTITIONED_FACT_TABLES, e.g. 'sales_fact'.
+        month (date): The first day of the month.
+        detached (bool): Create the partition as a standalone table instead of attaching it.
+        schema (str): The schema of the fact table.
+
+    Returns:
+        str: The schema qualified partition name.
+    """
+    partition_name, lower, upper = monthly_partition_bounds(table_name, month)
+    key = sql.Identifier(PARTITIONED_FACT_TABLES[table_name])
+    with conn.cursor() as cursor:
+        if detached:
+            cursor.execute(sql.SQL("""
+                CREATE TABLE IF NOT EXISTS {partition} (
+                    LIKE {parent} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING INDEXES,
+                    CONSTRAINT {check} CHECK ({key} >= {lower} AND {key} < {upper})
+                )
+            """).format(
+                partition=sql.Identifier(schema, partition_name),
+                parent=sql.Identifier(schema, table_name),
+                check=sql.Identifier(f"{partition_name}_bounds"),
+                key=key, lower=sql.Literal(lower), upper=sql.Literal(upper)
+            ))
+        else:
+            cursor.execute(sql.SQL("""
+                CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {parent}
+                FOR VALUES FROM ({lower}) TO ({upper})
+            """).format(
+                partition=sql.Identifier(schema, partition_name),
+                parent=sql.Identifier(schema, table_name),
+                lower=sql.Literal(lower), upper=sql.Literal(upper)
+            ))
+    return f"{schema}.{partition_name}"
+
+
+def attach_monthly_partition(conn, table_name, month, schema="core"):
+    """
+    Attaches a partition created with create_monthly_partition(detached=True) and drops its bounds CHECK.
+    """
+    partition_name, lower, upper = monthly_partition_bounds(table_name, month)
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            ALTER TABLE {parent} ATTACH PARTITION {partition}
+            FOR VALUES FROM ({lower}) TO ({upper})
+        """).format(
+            parent=sql.Identifier(schema, table_name),
+            partition=sql.Identifier(schema, partition_name),
+            lower=sql.Literal(lower), upper=sql.Literal(upper)
+        ))
+        cursor.execute(sql.SQL("ALTER TABLE {partition} DROP CONSTRAINT IF EXISTS {check}").format(
+            partition=sql.Identifier(schema, partition_name),
+            check=sql.Identifier(f"{partition_name}_bounds")))
+
+
+# Monthly partitions found in the catalog by (schema, fact table), so a load whose months all have their partition
+# skips the catalog query. Partitions created in a transaction that may still roll back are not remembered.
+_known_partitions = {}
+
+
+def forget_monthly_partitions(schema=None):
+    """
+    Drops the remembered partitions of a schema, or of every schema, after its tables were dropped or renamed.
+    """
+    for known_schema, table_name in list(_known_partitions):
+        if schema is None or known_schema == schema:
+            _known_partitions.pop((known_schema, table_name), None)
+
+
+def missing_monthly_partitions(conn, table_name, first_day, last_day, schema="core"):
+    """
+    Returns the months between first_day and last_day that have no partition of the fact table yet.
+    """
+    months = list(month_starts(first_day, last_day))
+    known = _known_partitions.get((schema, table_name), set())
+    if all(monthly_partition_bounds(table_name, month)[0] in known for month in months):
+        return []
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            JOIN pg_namespace n ON n.oid = p.relnamespace
+            WHERE n.nspname = %s AND p.relname = %s
+        """, (schema, table_name))
+        existing = {row[0] for row in cursor.fetchall()}
+    _known_partitions[(schema, table_name)] = existing
+    return [month for month in months if monthly_partition_bounds(table_name, month)[0] not in existing]
+
+
+def ensure_monthly_partitions(conn, logger, table_name, first_day, last_day, schema="core"):
+    """
+    Creates the missing monthly partitions of a fact table covering first_day to last_day.
+
+    Returns:
+        list: The months whose partitions were created.
+    """
+    created = missing_monthly_partitions(conn, table_name, first_day, last_day, schema)
+    for month in created:
+        create_monthly_partition(conn, table_name, month, schema=schema)
+    if created:
+        logger.info(f"Created {len(created)} monthly partitions for {schema}.{table_name}.")
+    return created
+
+
+def create_core_tables(conn, logger, schema="core", indexes=True):
+    """
+    Creates the dimension, fact and aggregate tables of the star schema in the given schema, and optionally its
+    secondary indexes.
+    """
+    create_supplier_dimension_table(conn, logger, schema)
+    create_customer_dimension_table(conn, logger, schema)
+    create_product_dimension_table(conn, logger, schema)
+    create_subcategory_lookup_table(conn, logger, schema)
+    create_order_dimension_table(conn, logger, schema)
+    create_campaign_dimension_table(conn, logger, schema)
+    create_time_dimension_table(conn, logger, schema)
+    create_customer_product_ratings_fact_table(conn, logger, schema)
+    create_returns_fact_table(conn, logger, schema)
+    create_sales_fact_table(conn, logger, schema)
+    create_sales_aggregate_tables(conn, logger, schema)
+    create_run_id_columns(conn, logger, schema)
+    if indexes:
+        create_core_indexes(conn, logger, schema)
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Create the warehouse core tables and indexes.")
+    parser.add_argument("--report-indexes", action="store_true",
+                        help="report size and usage of the core indexes instead of creating tables")
+    args = parser.parse_args()
+
     conn = psycopg2.connect(
         database="warehouse",
         user="postgres",
@@ -238,15 +790,18 @@ def main():
         port="5432"
     )
     logger = intialize_logger()
-    create_supplier_dimension_table(conn, logger)
-    create_customer_dimension_table(conn, logger)
-    create_product_dimension_table(conn, logger)
-    create_order_dimension_table(conn, logger)
-    create_campaign_dimension_table(conn, logger)
-    create_time_dimension_table(conn, logger)
-    create_customer_product_ratings_fact_table(conn, logger)
-    create_returns_fact_table(conn, logger)
-    create_sales_fact_table(conn, logger)
+    if args.report_indexes:
+        report_index_usage(conn, logger)
+        conn.close()
+        return
+    create_etl_schema(conn, logger)
+    create_load_rejects_table(conn, logger)
+    create_run_id_sequence(conn, logger)
+    create_pipeline_runs_table(conn, logger)
+    create_core_run_undo_table(conn, logger)
+    create_run_metrics_table(conn, logger)
+    create_freshness_table(conn, logger)
+    create_core_tables(conn, logger)
     conn.close()
 
 
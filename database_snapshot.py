@@ -0,0 +1,178 @@
+"""
+Snapshots and restores the production or warehouse database through PostgreSQL template databases.
+
+A snapshot is a copy of the database made with CREATE DATABASE ... TEMPLATE, a file level copy that takes seconds
+where truncating and reloading takes minutes and leaves bloat behind. Restoring drops the database and clones it
+back from the snapshot. Snapshots of the warehouse also keep the pipeline state files of ETL_LOAD_FOLDER
+(watermarks, consumed watermarks, dirty staging tables), so a restored warehouse and its watermarks agree.
+
+Cloning needs the CREATEDB privilege and no other session connected to the source database, so open sessions
+are terminated first.
+"""
+import argparse
+import os
+import shutil
+
+import psycopg2
+from psycopg2 import sql
+
+from etl_logging import setup_logging
+from pipeline import PRODUCTION_DSN, STAGING_WATERMARKS, WAREHOUSE_DSN, close_connection_pools, load_etl_path
+
+DATABASES = {
+    "production": PRODUCTION_DSN,
+    "warehouse": WAREHOUSE_DSN,
+}
+
+# Pipeline state files of ETL_LOAD_FOLDER kept with warehouse snapshots
+STATE_FILES = sorted({file_name for file_name, _, _ in STAGING_WATERMARKS.values()}) + [
+    "consumed_watermarks.json",
+    "dirty_staging_tables.json",
+    "pending_staging_rows.json",
+]
+
+
+def snapshot_name(dsn, label):
+    return f"{dsn['database']}_snapshot_{label}"
+
+
+def state_folder(ETL_LOAD_FOLDER, label):
+    return os.path.join(ETL_LOAD_FOLDER, "snapshots", label)
+
+
+def admin_connection(dsn):
+    """
+    Connects to the maintenance database of the server holding dsn, in autocommit mode as CREATE and DROP
+    DATABASE require.
+    """
+    conn = psycopg2.connect(**{**dsn, "database": "postgres"})
+    conn.autocommit = True
+    return conn
+
+
+def terminate_sessions(cursor, database):
+    cursor.execute("""
+        SELECT pg_terminate_backend(pid) FROM pg_stat_activity
+        WHERE datname = %s AND pid <> pg_backend_pid()
+    """, (database,))
+
+
+def clone_database(cursor, source, target):
+    """
+    Replaces the target database with a copy of the source database.
+    """
+    terminate_sessions(cursor, source)
+    terminate_sessions(cursor, target)
+    cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(target)))
+    cursor.execute(sql.SQL("CREATE DATABASE {} TEMPLATE {}").format(sql.Identifier(target), sql.Identifier(source)))
+
+
+def snapshot_exists(dsn, label):
+    conn = admin_connection(dsn)
+    try:
+        with conn.cursor() as cursor:
+            return _database_exists(cursor, snapshot_name(dsn, label))
+    finally:
+        conn.close()
+
+
+def create_snapshot(dsn, label, logger, ETL_LOAD_FOLDER=None):
+    """
+    Captures the database of dsn as the template database <database>_snapshot_<label>, replacing an earlier
+    snapshot with the same label. The snapshot is marked as a template that accepts no connections, so it stays as
+    captured.
+
+    Args:
+        dsn (dict): Connection settings of the database, e.g. WAREHOUSE_DSN.
+        label (str): Name of the snapshot.
+        logger (Logger): The logger object for logging.
+        ETL_LOAD_FOLDER (str, optional): Folder of the pipeline state files to keep with the snapshot.
+    """
+    close_connection_pools()
+    snapshot = snapshot_name(dsn, label)
+    conn = admin_connection(dsn)
+    try:
+        with conn.cursor() as cursor:
+            if _database_exists(cursor, snapshot):
+                # a template database cannot be dropped
+                cursor.execute(sql.SQL("ALTER DATABASE {} WITH IS_TEMPLATE false").format(
+                    sql.Identifier(snapshot)))
+            clone_database(cursor, dsn["database"], snapshot)
+            cursor.execute(sql.SQL("ALTER DATABASE {} WITH IS_TEMPLATE true ALLOW_CONNECTIONS false").format(
+                sql.Identifier(snapshot)))
+    finally:
+        conn.close()
+
+    if ETL_LOAD_FOLDER:
+        folder = state_folder(ETL_LOAD_FOLDER, label)
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+        for file_name in STATE_FILES:
+            if os.path.exists(os.path.join(ETL_LOAD_FOLDER, file_name)):
+                shutil.copy2(os.path.join(ETL_LOAD_FOLDER, file_name), folder)
+    logger.info(f"Snapshot {snapshot} of {dsn['database']} created.")
+
+
+def restore_snapshot(dsn, label, logger, ETL_LOAD_FOLDER=None):
+    """
+    Replaces the database of dsn with the snapshot captured under label, and the pipeline state files with the
+    ones kept with it. State files the snapshot did not have are removed.
+    """
+    close_connection_pools()
+    snapshot = snapshot_name(dsn, label)
+    conn = admin_connection(dsn)
+    try:
+        with conn.cursor() as cursor:
+            if not _database_exists(cursor, snapshot):
+                raise ValueError(f"No snapshot {label} of {dsn['database']}")
+            clone_database(cursor, snapshot, dsn["database"])
+    finally:
+        conn.close()
+
+    if ETL_LOAD_FOLDER:
+        folder = state_folder(ETL_LOAD_FOLDER, label)
+        for file_name in STATE_FILES:
+            saved, current = os.path.join(folder, file_name), os.path.join(ETL_LOAD_FOLDER, file_name)
+            if os.path.exists(saved):
+                shutil.copy2(saved, current)
+            elif os.path.exists(current):
+                os.remove(current)
+    logger.info(f"{dsn['database']} restored from snapshot {snapshot}.")
+
+
+def drop_snapshot(dsn, label, logger, ETL_LOAD_FOLDER=None):
+    snapshot = snapshot_name(dsn, label)
+    conn = admin_connection(dsn)
+    try:
+        with conn.cursor() as cursor:
+            if _database_exists(cursor, snapshot):
+                cursor.execute(sql.SQL("ALTER DATABASE {} WITH IS_TEMPLATE false").format(sql.Identifier(snapshot)))
+                cursor.execute(sql.SQL("DROP DATABASE {}").format(sql.Identifier(snapshot)))
+    finally:
+        conn.close()
+    if ETL_LOAD_FOLDER:
+        shutil.rmtree(state_folder(ETL_LOAD_FOLDER, label), ignore_errors=True)
+    logger.info(f"Snapshot {snapshot} dropped.")
+
+
+def _database_exists(cursor, database):
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_database WHERE datname = %s)", (database,))
+    return cursor.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Snapshot or restore the production or warehouse database.")
+    parser.add_argument("action", choices=("snapshot", "restore", "drop"))
+    parser.add_argument("--database", choices=tuple(DATABASES), default="warehouse")
+    parser.add_argument("--label", default="default", help="name of the snapshot")
+    args = parser.parse_args()
+
+    logger = setup_logging("database_snapshot.log")
+    # Only the warehouse goes with the pipeline state files
+    ETL_LOAD_FOLDER = load_etl_path() if args.database == "warehouse" else None
+    action = {"snapshot": create_snapshot, "restore": restore_snapshot, "drop": drop_snapshot}[args.action]
+    action(DATABASES[args.database], args.label, logger, ETL_LOAD_FOLDER)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+# Fields every record carries, taken from the innermost log_context of the emitting thread
+CONTEXT_FIELDS = ("run_id", "table", "stage")
+
+_context = threading.local()
+_listener = None
+_log_file = None
+_setup_lock = threading.Lock()
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Tags the records logged by this thread inside the block with run_id, table and/or stage. Nested contexts
+    inherit the fields they do not override.
+    """
+    stack = getattr(_context, "stack", None)
+    if stack is None:
+        stack = _context.stack = [{}]
+    stack.append({**stack[-1], **{key: value for key, value in fields.items() if value is not None}})
+    try:
+        yield
+    finally:
+        stack.pop()
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copies the fields of the current log_context onto the record. Runs in the emitting thread, before the record
+    is queued.
+    """
+
+    def filter(self, record):
+        stack = getattr(_context, "stack", None)
+        fields = stack[-1] if stack else {}
+        for field in CONTEXT_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, fields.get(field))
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `limit` records per `interval` seconds for each rate_limit key, e.g. one per table for
+    rejected rows. The first record let through after a suppression reports how many were dropped. Records
+    without a rate_limit key are never limited.
+
+    Log with: logger.error("...", extra={"rate_limit": key})
+    """
+
+    def __init__(self, limit=10, interval=60.0):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, "rate_limit", None)
+        if key is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            started, passed, suppressed = self._windows.get(key, (now, 0, 0))
+            if now - started >= self.interval:
+                started, passed = now, 0
+            if passed >= self.limit:
+                self._windows[key] = (started, passed, suppressed + 1)
+                return False
+            self._windows[key] = (started, passed + 1, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class ExceptionKeepingQueueHandler(QueueHandler):
+    """
+    A QueueHandler that keeps the traceback of a record in its 'exception' field. The stock prepare merges it into
+    the message and drops exc_info, which may not be picklable.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exception = logging.Formatter().formatException(record.exc_info)
+        record.exc_info, record.exc_text = None, None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, with the log_context fields and any suppression count.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS + ("suppressed",):
+            if getattr(record, field, None) is not None:
+                entry[field] = getattr(record, field)
+        if getattr(record, "exception", None):
+            entry["exception"] = record.exception
+        elif record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup_logging(log_file, level=logging.INFO):
+    """
+    Configures the root logger to queue records to a background thread writing them as JSON lines to log_file.
+    Logging from the loaders then only costs a queue put. Later calls return the already configured root logger,
+    so the log file gets a single handler however often the entry points initialize logging; a later call naming
+    another file logs a warning, since its records keep going to the first file.
+
+    Args:
+        log_file (str): The log file, opened in append mode.
+        level (int): The lowest level logged.
+
+    Returns:
+        logger (logging.Logger): The configured root logger.
+    """
+    global _listener, _log_file
+    logger = logging.getLogger()
+    with _setup_lock:
+        if _listener is not None:
+            if os.path.abspath(log_file) != _log_file:
+                logger.warning("Logging is already set up to write to %s, %s is not used.", _log_file,
+                               os.path.abspath(log_file))
+            return logger
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(JsonFormatter())
+
+        records = queue.SimpleQueue()
+        queue_handler = ExceptionKeepingQueueHandler(records)
+        queue_handler.addFilter(ContextFilter())
+        queue_handler.addFilter(RateLimitFilter())
+        logger.setLevel(level)
+        logger.addHandler(queue_handler)
+
+        _listener = QueueListener(records, file_handler, respect_handler_level=True)
+        _listener.start()
+        _log_file = file_handler.baseFilename
+        atexit.register(shutdown_logging)
+    return logger
+
+
+def shutdown_logging():
+    """
+    Writes out the queued records and stops the background writer.
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+
+def log_file_path():
+    """
+    Returns the absolute path of the log file, None before setup_logging.
+    """
+    return _log_file
@@ -1,11 +1,547 @@
 import psycopg2
+import argparse
+import cProfile
+import csv
+import functools
+import io
 import json
-import logging
 import os
+import pstats
+import signal
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
 from psycopg2 import OperationalError, sql
 import psycopg2
 from psycopg2 import sql
 from psycopg2 import IntegrityError, DataError
+from psycopg2.extensions import STATUS_READY
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+
+from core_layer_table_create import (RUN_TAGGED_TABLES, attach_monthly_partition, create_core_indexes,
+                                     create_core_tables, create_monthly_partition, ensure_monthly_partitions,
+                                     forget_monthly_partitions, missing_monthly_partitions, next_month_start)
+from etl_logging import log_context, log_file_path, setup_logging
+from staging_layer_table_create import crash_truncated_staging_tables, set_staging_persistence
+
+
+@dataclass
+class LoadOptions:
+    """
+    Options shared by the staging and core loaders.
+
+    Attributes:
+        fault_isolation (bool): On a failing batch, bisect it to isolate the offending rows, keep the good rows
+            and quarantine the rejects in etl.load_rejects instead of rolling back the whole batch.
+        fault_isolation_page_keys (int): Source keys a fault isolated core load inserts per statement before
+            bisecting, see execute_core_insert.
+        attach_partitions (bool): Load months without a fact partition into standalone tables and attach them
+            afterwards, instead of creating the partitions up front and routing rows through the parent.
+        bulk_load (bool): Force (True) or disable (False) the bulk fact load; None chooses by delta size.
+        bulk_load_min_rows (int): Smallest fact delta loaded in bulk mode.
+        bulk_load_ratio (float): Smallest fact delta, relative to the rows already in the fact table, loaded in
+            bulk mode.
+        index_build_workers (int): Connections used to rebuild indexes after a bulk load.
+        aggregate_full_rebuild (bool): Rebuild the sales aggregates from scratch instead of folding in new facts.
+        aggregate_consistency_check (bool): Compare the sales aggregates with core.sales_fact after refreshing them
+            and rebuild them on a mismatch.
+        core_schema (str): The schema the core loaders write into.
+        shadow_swap (bool): Build the core tables in a shadow schema and swap it with the live core schema once
+            complete, instead of truncating and refilling the live tables.
+        workers (int): Connections used by the core load. Above 1 the dimensions are loaded concurrently and
+            core.sales_fact in hash slices of order_id.
+        run_id (int): The run the loaded rows are tagged with, in the etl_batch_id column of staging rows and the
+            etl_run_id column of core rows.
+        fact_slice (tuple): (index, count) restricting the sales fact load to order_id % count = index.
+        insert_mode (str): How staging records are sent: 'insert' (executemany), 'values' (multi-row INSERT
+            ... VALUES) or 'copy' (COPY FROM STDIN).
+        fast_staging (bool): Keep the staging tables UNLOGGED and commit staging loads with synchronous_commit off.
+            Staging can be re-extracted from production, so neither needs to survive a crash.
+        prepare_staging (bool): Check the staging persistence mode and the crash sentinel at the start of every
+            staging run, see prepare_staging_tables. The daemon does it once and after failed batches instead.
+        staging_retention (bool): After a core load, purge the staging rows it consumed.
+        retention_chunk_rows (int): Rows deleted per transaction by the staging purge.
+        full_reload_max_rows (int): Production tables up to this size are copied completely into staging, see
+            choose_staging_load_mode.
+        full_reload_ratio (float): Fraction of new rows above which a table is copied completely.
+        maintenance (bool): ANALYZE, and VACUUM where needed, the tables a stage changed substantially before the
+            stages reading them run.
+        analyze_min_rows (int): Rows a table must have received in the run to be analyzed.
+        analyze_ratio (float): Fraction of the table the received rows must amount to for it to be analyzed.
+        vacuum_dead_ratio (float): Fraction of dead rows above which a table is vacuumed as well.
+        maintenance_workers (int): Tables maintained concurrently.
+        profile_dir (str): Directory receiving a cProfile dump, a memory peak and the EXPLAIN (ANALYZE, BUFFERS)
+            of the core SELECTs for every loader, see timed_stage. None disables profiling.
+        core_delta (dict): Restricts the core loaders to the staging rows no core load consumed yet, by staging
+            table: (consumed watermark, extraction watermark, pending keys), see core_delta_filter. None reads
+            every staged row.
+    """
+    fault_isolation: bool = False
+    fault_isolation_page_keys: int = 10000
+    attach_partitions: bool = False
+    bulk_load: bool = None
+    bulk_load_min_rows: int = 500000
+    bulk_load_ratio: float = 0.1
+    index_build_workers: int = 4
+    aggregate_full_rebuild: bool = False
+    aggregate_consistency_check: bool = True
+    core_schema: str = "core"
+    shadow_swap: bool = False
+    workers: int = 1
+    run_id: int = None
+    fact_slice: tuple = None
+    insert_mode: str = "insert"
+    fast_staging: bool = False
+    prepare_staging: bool = True
+    staging_retention: bool = False
+    retention_chunk_rows: int = 10000
+    full_reload_max_rows: int = 10000
+    full_reload_ratio: float = 0.5
+    maintenance: bool = True
+    analyze_min_rows: int = 10000
+    analyze_ratio: float = 0.1
+    vacuum_dead_ratio: float = 0.2
+    maintenance_workers: int = 4
+    profile_dir: str = None
+    core_delta: dict = None
+
+
+# Connection settings of the production (OLTP) database and the data warehouse
+PRODUCTION_DSN = {
+    "database": "production",
+    "user": "postgres",
+    "password": "swati",
+    "host": "localhost",
+    "port": "5432",
+}
+WAREHOUSE_DSN = {
+    "database": "warehouse",
+    "user": "postgres",
+    "password": "swati",
+    "host": "localhost",
+    "port": "5432",
+}
+
+# Session settings applied per pipeline stage by connect_production/connect_warehouse(profile=...)
+SESSION_PROFILES = {
+    # reading the deltas out of production
+    "bulk_extract": {
+        "work_mem": "64MB",
+        "max_parallel_workers_per_gather": "2",
+        "jit": "off",
+        "statement_timeout": "30min",
+        "lock_timeout": "30s",
+    },
+    # the staging joins and DISTINCTs of the core loaders
+    "core_join": {
+        "work_mem": "256MB",
+        "max_parallel_workers_per_gather": "4",
+        "jit": "off",
+        "statement_timeout": "0",
+        "lock_timeout": "1min",
+    },
+    # index and foreign key rebuilds after bulk loads
+    "index_build": {
+        "maintenance_work_mem": "1GB",
+        "max_parallel_maintenance_workers": "4",
+        "statement_timeout": "0",
+        "lock_timeout": "1min",
+    },
+}
+
+# Connections opened per session profile since the run metrics were last written, see write_run_metrics
+session_profile_usage = {}
+
+# Connection pools opened by open_connection_pools, keyed by database, and the pool each lent connection came from
+_connection_pools = {}
+_pooled_connections = {}
+_pool_lock = threading.Lock()
+
+
+def open_connection_pools(max_connections):
+    """
+    Opens thread safe connection pools for the production database and the warehouse. While they are open,
+    connect_production and connect_warehouse lend pooled connections and close_connection returns them.
+
+    Returns:
+        bool: True if the pools were opened by this call, False if they were already open.
+    """
+    with _pool_lock:
+        if _connection_pools:
+            return False
+        _connection_pools["production"] = ThreadedConnectionPool(1, max_connections, **PRODUCTION_DSN)
+        _connection_pools["warehouse"] = ThreadedConnectionPool(1, max_connections, **WAREHOUSE_DSN)
+        return True
+
+
+def close_connection_pools():
+    """
+    Closes the connection pools and every connection they hold.
+    """
+    with _pool_lock:
+        for pool in _connection_pools.values():
+            pool.closeall()
+        _connection_pools.clear()
+        _pooled_connections.clear()
+
+
+def apply_session_profile(conn, profile):
+    """
+    Applies the settings of a SESSION_PROFILES entry to a connection for the rest of its session.
+    """
+    with conn.cursor() as cursor:
+        for name, value in SESSION_PROFILES[profile].items():
+            cursor.execute("SELECT set_config(%s, %s, false)", (name, value))
+    # Session settings made in a transaction that is rolled back are reverted, so they are committed right away
+    conn.commit()
+    with _pool_lock:
+        session_profile_usage[profile] = session_profile_usage.get(profile, 0) + 1
+    metric = run_metrics.current()
+    if metric is not None:
+        metric.session_profile = profile
+        metric.session_settings = dict(SESSION_PROFILES[profile])
+
+
+def _connect(database, dsn, profile=None):
+    with _pool_lock:
+        pool = _connection_pools.get(database)
+    conn = None
+    if pool is not None:
+        try:
+            conn = pool.getconn()
+            with _pool_lock:
+                _pooled_connections[id(conn)] = pool
+        except PoolError:
+            # Every pooled connection is lent out, fall back to a private one
+            pass
+    if conn is None:
+        conn = psycopg2.connect(**dsn)
+    if profile is not None:
+        apply_session_profile(conn, profile)
+    return conn
+
+
+def connect_production(profile=None):
+    """
+    Returns a connection to the production database, from the pool if one is open, tuned with the given
+    SESSION_PROFILES entry.
+    """
+    return _connect("production", PRODUCTION_DSN, profile)
+
+
+def connect_warehouse(profile=None):
+    """
+    Returns a connection to the data warehouse, from the pool if one is open, tuned with the given SESSION_PROFILES
+    entry.
+    """
+    return _connect("warehouse", WAREHOUSE_DSN, profile)
+
+
+def close_connection(conn):
+    """
+    Closes a connection from connect_production or connect_warehouse, or returns it to its pool. Uncommitted work
+    is rolled back either way, and a pooled connection loses its session profile.
+    """
+    with _pool_lock:
+        pool = _pooled_connections.pop(id(conn), None)
+    if pool is None:
+        conn.close()
+        return
+    if not conn.closed:
+        if conn.status != STATUS_READY:
+            conn.rollback()
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("RESET ALL")
+            conn.commit()
+        except psycopg2.Error:
+            conn.close()
+    pool.putconn(conn, close=bool(conn.closed))
+
+
+@dataclass
+class StageMetric:
+    """
+    Measurements of one pipeline stage on one table.
+
+    Attributes:
+        stage (str): 'staging' or 'core' for a whole loader, 'extract', 'transfer', 'load' or 'commit' for its
+            steps.
+        table (str): The table loaded.
+        run_id (int): The pipeline run, see begin_pipeline_run.
+        wall_seconds (float): Elapsed time.
+        cpu_seconds (float): CPU time of the loading thread.
+        rows (int): Rows handled.
+        bytes (int): Approximate size of the rows sent or received.
+        batches (int): Statements or round trips used.
+        retries (int): Chunks retried after a row-level error.
+        succeeded (bool): Whether the stage completed.
+        session_profile (str): The SESSION_PROFILES entry of the connection the stage opened, if any.
+        session_settings (dict): The settings of that profile as applied.
+    """
+    stage: str
+    table: str
+    run_id: int = None
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    rows: int = 0
+    bytes: int = 0
+    batches: int = 0
+    retries: int = 0
+    succeeded: bool = True
+    session_profile: str = None
+    session_settings: dict = None
+
+
+class RunMetrics:
+    """
+    Collects the StageMetric records of the stages run in this process. Safe to use from the loader threads.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def current(self):
+        """
+        Returns the innermost stage being measured in this thread, None outside of any.
+        """
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def measure(self, stage, table, run_id=None):
+        if run_id is None and self.current() is not None:
+            run_id = self.current().run_id
+        metric = StageMetric(stage, table, run_id)
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        self._local.stack.append(metric)
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            with log_context(run_id=run_id, table=table, stage=stage):
+                yield metric
+        except BaseException:
+            metric.succeeded = False
+            raise
+        finally:
+            metric.wall_seconds = time.perf_counter() - wall
+            metric.cpu_seconds = time.thread_time() - cpu
+            self._local.stack.pop()
+            with self._lock:
+                self.metrics.append(metric)
+
+    def drain(self):
+        """
+        Returns the collected metrics and starts over.
+        """
+        with self._lock:
+            metrics, self.metrics = self.metrics, []
+        return metrics
+
+
+run_metrics = RunMetrics()
+
+
+# Held by the loader being profiled with cProfile
+_profiler_lock = threading.Lock()
+
+
+def profile_artifact_path(options, suffix):
+    """
+    Returns the path of a profile artifact of the stage being measured, or None when profiling is off. The name
+    holds the run and, for the concurrent slices of the sales fact load, the slice, e.g.
+    'core.sales_fact.run42.slice2of4.prof', so concurrent loaders never write the same file.
+    """
+    metric = run_metrics.current()
+    if not options or not options.profile_dir or metric is None:
+        return None
+    name = f"{metric.stage}.{metric.table.split('.')[-1]}"
+    if metric.run_id is not None:
+        name += f".run{metric.run_id}"
+    if options.fact_slice:
+        name += f".slice{options.fact_slice[0] + 1}of{options.fact_slice[1]}"
+    return os.path.join(options.profile_dir, f"{name}{suffix}")
+
+
+def profiled_call(loader, args, kwargs, options):
+    """
+    Runs a loader under cProfile and tracemalloc and writes its artifacts to options.profile_dir: the raw profile
+    (.prof, for pstats or snakeviz), the 30 most expensive functions (.txt) and the traced memory (.memory.json).
+    The memory peak is process wide, so with several workers it includes the loaders running alongside. Newer
+    Pythons allow a single active profiler, so concurrent loaders are profiled one at a time and the others only get
+    their memory traced.
+    """
+    os.makedirs(options.profile_dir, exist_ok=True)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_memory = tracemalloc.get_traced_memory()[0]
+    profiler = cProfile.Profile() if _profiler_lock.acquire(blocking=False) else None
+    try:
+        if profiler is None:
+            return loader(*args, **kwargs)
+        return profiler.runcall(loader, *args, **kwargs)
+    finally:
+        current_memory, peak_memory = tracemalloc.get_traced_memory()
+        if profiler is not None:
+            _profiler_lock.release()
+            profiler.dump_stats(profile_artifact_path(options, ".prof"))
+            with open(profile_artifact_path(options, ".txt"), "w") as file:
+                pstats.Stats(profiler, stream=file).sort_stats("cumulative").print_stats(30)
+        with open(profile_artifact_path(options, ".memory.json"), "w") as file:
+            json.dump({"start_bytes": start_memory, "end_bytes": current_memory, "peak_bytes": peak_memory}, file,
+                      indent=2)
+
+
+def timed_stage(stage, table):
+    """
+    Decorates a staging or core loader so every call is measured as a stage of the given table. The rows are taken
+    from the loader's return value, and a None return marks the stage as failed. With options.profile_dir the
+    loader is profiled as well, see profiled_call.
+    """
+    def decorator(loader):
+        @functools.wraps(loader)
+        def wrapper(*args, **kwargs):
+            options = kwargs.get("options") or next((arg for arg in args if isinstance(arg, LoadOptions)), None)
+            with run_metrics.measure(stage, table, options.run_id if options else None) as metric:
+                if options and options.profile_dir:
+                    result = profiled_call(loader, args, kwargs, options)
+                else:
+                    result = loader(*args, **kwargs)
+                metric.rows = result or 0
+                metric.succeeded = result is not None
+                return result
+        return wrapper
+    return decorator
+
+
+def estimated_bytes(records, sample_size=100):
+    """
+    Estimates the text size of records from a sample, cheap enough for the load path.
+    """
+    if not records:
+        return 0
+    sample = records[:sample_size]
+    sample_bytes = sum(len(str(value)) for record in sample for value in record)
+    return sample_bytes * len(records) // len(sample)
+
+
+class MeasuredCursor:
+    """
+    Wraps a production cursor so the extraction query is measured as the 'extract' stage and fetching its rows as
+    the 'transfer' stage of a staging table.
+    """
+
+    def __init__(self, cursor, table):
+        self._cursor = cursor
+        self._table = table
+
+    def execute(self, query, params=None):
+        with run_metrics.measure("extract", self._table) as metric:
+            self._cursor.execute(query, params)
+            metric.batches = 1
+
+    def fetchall(self):
+        with run_metrics.measure("transfer", self._table) as metric:
+            rows = self._cursor.fetchall()
+            metric.rows, metric.bytes, metric.batches = len(rows), estimated_bytes(rows), 1
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def timed_commit(conn, table):
+    """
+    Commits a connection, measured as the 'commit' stage of a table.
+    """
+    with run_metrics.measure("commit", table) as metric:
+        conn.commit()
+        metric.batches = 1
+
+
+def write_run_metrics(ETL_LOAD_FOLDER, logger):
+    """
+    Writes the metrics collected since the last call to etl.run_metrics, to run_metrics.json in ETL_LOAD_FOLDER
+    and to a Prometheus textfile, pipeline_metrics.prom in ETL_LOAD_FOLDER unless ETL_METRICS_TEXTFILE names
+    another path, e.g. in the node exporter's textfile directory.
+
+    The session profile counts start over with every call, so they cover the same run as the metrics.
+
+    Returns:
+        list: The StageMetric records written.
+    """
+    metrics = run_metrics.drain()
+    with _pool_lock:
+        profile_usage = dict(session_profile_usage)
+        session_profile_usage.clear()
+    if not metrics:
+        return metrics
+
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            execute_values(cursor, """
+                INSERT INTO etl.run_metrics
+                    (run_id, stage, table_name, wall_seconds, cpu_seconds, rows, bytes, batches, retries, succeeded,
+                     session_profile, session_settings)
+                VALUES %s
+            """, [(m.run_id, m.stage, m.table, m.wall_seconds, m.cpu_seconds, m.rows, m.bytes, m.batches, m.retries,
+                   m.succeeded, m.session_profile, json.dumps(m.session_settings) if m.session_settings else None)
+                  for m in metrics])
+        warehouse_conn.commit()
+    except psycopg2.Error as e:
+        warehouse_conn.rollback()
+        logger.error(f"Error writing run metrics: {e}")
+    finally:
+        close_connection(warehouse_conn)
+
+    if ETL_LOAD_FOLDER:
+        with open(os.path.join(ETL_LOAD_FOLDER, 'run_metrics.json'), 'w') as file:
+            json.dump({
+                "recorded_at": time.time(),
+                "stages": [metric.__dict__ for metric in metrics],
+                "session_profiles": profile_usage,
+            }, file, indent=2)
+
+    textfile = os.environ.get('ETL_METRICS_TEXTFILE') or (
+        os.path.join(ETL_LOAD_FOLDER, 'pipeline_metrics.prom') if ETL_LOAD_FOLDER else None)
+    if textfile:
+        totals = {}
+        for metric in metrics:
+            total = totals.setdefault((metric.stage, metric.table), [0.0, 0.0, 0, 0, 0, 0, 0])
+            for index, value in enumerate((metric.wall_seconds, metric.cpu_seconds, metric.rows, metric.bytes,
+                                           metric.batches, metric.retries, int(not metric.succeeded))):
+                total[index] += value
+        lines = []
+        for index, (name, help_text) in enumerate((
+                ("etl_stage_wall_seconds", "Wall time of a pipeline stage in the last run."),
+                ("etl_stage_cpu_seconds", "CPU time of a pipeline stage in the last run."),
+                ("etl_stage_rows", "Rows handled by a pipeline stage in the last run."),
+                ("etl_stage_bytes", "Approximate bytes handled by a pipeline stage in the last run."),
+                ("etl_stage_batches", "Statements or round trips of a pipeline stage in the last run."),
+                ("etl_stage_retries", "Chunks retried by a pipeline stage in the last run."),
+                ("etl_stage_failures", "Failed executions of a pipeline stage in the last run."))):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            lines += [f'{name}{{stage="{stage}",table="{table}"}} {total[index]}'
+                      for (stage, table), total in sorted(totals.items())]
+        lines += ["# HELP etl_session_profile_connections Connections opened per session profile in the last run.",
+                  "# TYPE etl_session_profile_connections gauge"]
+        lines += [f'etl_session_profile_connections{{profile="{profile}"}} {count}'
+                  for profile, count in sorted(profile_usage.items())]
+        # Written aside and renamed, so the exporter never reads a partial file
+        with open(textfile + '.tmp', 'w') as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(textfile + '.tmp', textfile)
+
+    logger.info(f"Recorded {len(metrics)} stage metrics.")
+    return metrics
 
 
 # setup a etl path
@@ -24,7 +560,7 @@ def load_etl_path():
 # set up a logger
 def intialize_logger():
     """
-    Initializes and configures a logger with two handlers for error and info messages.
+    Initializes the logger writing JSON lines to delta_load.log from a background thread, see etl_logging.
 
     Returns:
         logger (logging.Logger): The configured logger object.
@@ -32,126 +568,898 @@ def intialize_logger():
     Raises:
         None
     """
-    # Configure logging with two handlers
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    # Handler for errors
-    error_handler = logging.FileHandler('delta_load.log')
-    error_handler.setLevel(logging.ERROR)
-    error_formatter = logging.Formatter('%(asctime)s [%(levelname)s] - %(message)s')
-    error_handler.setFormatter(error_formatter)
-    logger.addHandler(error_handler)
-
-    # Handler for info messages
-    info_handler = logging.FileHandler('delta_load.log')
-    info_handler.setLevel(logging.INFO)
-    info_formatter = logging.Formatter('%(asctime)s [%(levelname)s] - %(message)s')
-    info_handler.setFormatter(info_formatter)
-    logger.addHandler(info_handler)
-    return logger
+    return setup_logging('delta_load.log')
 
 
 def cascade_truncate_tables_staging(logger):
-    warehouse_conn, warehouse_cursor = None, None
+    """
+    Empties every staging table registered in STAGING_LOADERS with a single TRUNCATE statement.
+    """
+    warehouse_conn = None
     try:
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
-        # Create a cursor for the data warehouse
-        warehouse_cursor = warehouse_conn.cursor()
-
-        # Truncate tables in a specific order to avoid foreign key constraint errors
-        tables = [
-            "staging.customer_product_ratings",
-            "staging.orderitem",
-            "staging.location",
-            "staging.category",
-            "staging.supplier",
-            "staging.payment_method",
-            "staging.subcategory",
-            "staging.product",
-            "staging.customer",
-            "staging.marketing_campaigns"
-        ]
-
-        for table in tables:
-            warehouse_cursor.execute(f"TRUNCATE TABLE {table} CASCADE")
+        with warehouse_conn.cursor() as warehouse_cursor:
+            warehouse_cursor.execute(sql.SQL("TRUNCATE TABLE {} CASCADE").format(
+                sql.SQL(', ').join(sql.Identifier(*table.split('.')) for table in STAGING_LOADERS)))
 
         # Commit the changes to the data warehouse
         warehouse_conn.commit()
+        logger.info("Tables truncated successfully")
 
     except OperationalError as e:
         logger.error(f"Error connecting to the data warehouse: {e}")
 
     finally:
-        # Close cursor and connection
-        warehouse_cursor.close()
-        warehouse_conn.close()
-        logger.info("Tables truncated successfully")
+        # Close the connection
+        if warehouse_conn is not None:
+            close_connection(warehouse_conn)
+
+
+def purge_consumed_staging_rows(ETL_LOAD_FOLDER, logger, options=None):
+    """
+    Deletes the staging rows the core load has already consumed, i.e. with a key up to the consumed watermark of
+    their table, in chunks of options.retention_chunk_rows. Every chunk commits on its own and skips rows locked by
+    a concurrent load, so the purge never holds long locks or blocks the staging loaders.
 
+    The FULL_RELOAD_STAGING_TABLES, which the core loaders join against in full, are never purged, nor are the
+    rows waiting for the row they join (see read_pending_staging_rows) or still referenced by unconsumed rows of
+    another staging table (see STAGING_REFERENCES).
 
-def cascade_truncate_tables_core(logger):
-    warehouse_conn, warehouse_cursor = None, None
+    Returns:
+        int: The number of rows deleted.
+    """
+    options = options or LoadOptions()
+    consumed = read_consumed_watermarks(ETL_LOAD_FOLDER)
+    pending = read_pending_staging_rows(ETL_LOAD_FOLDER)
+    warehouse_conn = connect_warehouse()
+    deleted = 0
     try:
-        # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        for staging_table, (_, _, key_column) in STAGING_WATERMARKS.items():
+            watermark = consumed.get(staging_table)
+            if not watermark or staging_table in FULL_RELOAD_STAGING_TABLES:
+                continue
+            key = sql.Identifier("t", key_column)
+            conditions = [sql.SQL("{} <= {}").format(key, sql.Literal(watermark))]
+            if pending.get(staging_table):
+                conditions.append(sql.SQL("{} <> ALL({})").format(key, sql.Literal(pending[staging_table])))
+            for referencing_table, column in STAGING_REFERENCES.get(staging_table, ()):
+                _, _, referencing_key = STAGING_WATERMARKS[referencing_table]
+                conditions.append(sql.SQL("""
+                    NOT EXISTS (
+                        SELECT 1 FROM {referencing} r
+                        WHERE r.{column} = {key}
+                          AND (r.{referencing_key} > {watermark} OR r.{referencing_key} = ANY({pending}))
+                    )
+                """).format(referencing=sql.Identifier(*referencing_table.split('.')), column=sql.Identifier(column),
+                            key=key, referencing_key=sql.Identifier(referencing_key),
+                            watermark=sql.Literal(consumed.get(referencing_table, 0)),
+                            pending=sql.SQL("{}::bigint[]").format(
+                                sql.Literal(pending.get(referencing_table, [])))))
+            delete_query = sql.SQL("""
+                DELETE FROM {table}
+                WHERE ctid IN (
+                    SELECT t.ctid FROM {table} t
+                    WHERE {conditions}
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            """).format(table=sql.Identifier(*staging_table.split('.')),
+                        conditions=sql.SQL(" AND ").join(conditions))
+            table_deleted = 0
+            while True:
+                with warehouse_conn.cursor() as cursor:
+                    cursor.execute(delete_query, (options.retention_chunk_rows,))
+                    chunk = cursor.rowcount
+                warehouse_conn.commit()
+                table_deleted += chunk
+                if chunk < options.retention_chunk_rows:
+                    break
+            if table_deleted:
+                logger.info(f"Purged {table_deleted} consumed rows from {staging_table}.")
+            deleted += table_deleted
+        return deleted
 
-        # Create a cursor for the data warehouse
-        warehouse_cursor = warehouse_conn.cursor()
+    except psycopg2.Error as e:
+        warehouse_conn.rollback()
+        logger.error(f"Error purging consumed staging rows: {e}")
+        return deleted
+
+    finally:
+        close_connection(warehouse_conn)
+
+
+def cascade_truncate_tables_core(logger, ETL_LOAD_FOLDER=None):
+    """
+    Empties the core dimension, fact and sales aggregate tables and the subcategory lookup with a single TRUNCATE
+    statement. With ETL_LOAD_FOLDER the core load state is reset as well: no staging row counts as consumed and
+    every staging table as dirty, so the next core load reads all of staging again.
+    """
+    warehouse_conn = None
+    try:
+        # Connect to the data warehouse
+        warehouse_conn = connect_warehouse()
 
-        # Truncate tables in a specific order to avoid foreign key constraint errors
-        tables = [
-            "core.Sales_fact",
-            "core.supplier_dimension",
-            "core.Order_dimension",
-            "core.campaign_dimension",
-            "core.customer_dimension",
-            "core.product_dimension",
-            "core.time_dimension",
-            "core.returns_fact"
-        ]
-
-        for table in tables:
-            warehouse_cursor.execute(f"TRUNCATE TABLE {table} CASCADE")
+        tables = RUN_TAGGED_TABLES + list(SALES_AGGREGATES) + ["aggregate_watermark", "subcategory_lookup"]
+        with warehouse_conn.cursor() as warehouse_cursor:
+            warehouse_cursor.execute(sql.SQL("TRUNCATE TABLE {} CASCADE").format(
+                sql.SQL(', ').join(sql.Identifier("core", table) for table in tables)))
+            warehouse_cursor.execute("DELETE FROM etl.core_run_undo WHERE table_name LIKE 'core.%'")
 
         # Commit the changes to the data warehouse
         warehouse_conn.commit()
+        logger.info("Tables truncated successfully")
 
     except OperationalError as e:
         logger.error(f"Error connecting to the data warehouse: {e}")
+        return
 
     finally:
-        # Close cursor and connection
-        warehouse_cursor.close()
-        warehouse_conn.close()
-        logger.info("Tables truncated successfully")
+        # Close the connection
+        if warehouse_conn is not None:
+            close_connection(warehouse_conn)
+
+    if ETL_LOAD_FOLDER:
+        write_dirty_staging_tables(ETL_LOAD_FOLDER, set(STAGING_WATERMARKS))
+        for file_name in ('consumed_watermarks.json', 'pending_staging_rows.json'):
+            if os.path.exists(os.path.join(ETL_LOAD_FOLDER, file_name)):
+                os.remove(os.path.join(ETL_LOAD_FOLDER, file_name))
+        logger.info("Core load state reset, all of staging will be loaded again.")
+
+
+# fault isolation helpers
+def bisect_insert(warehouse_conn, chunk, insert_chunk, rejects):
+    """
+    Inserts a chunk inside a savepoint and, if a row-level error occurs, splits the chunk in halves until the
+    offending items are isolated. Every bad item costs O(log n) retries instead of losing the whole batch.
+
+    Args:
+        warehouse_conn (connection): Connection to the warehouse database, with an open transaction.
+        chunk (list): The items (records or keys) to insert.
+        insert_chunk (callable): Called as insert_chunk(cursor, chunk) to insert a non-empty chunk.
+        rejects (list): Receives an (item, error) tuple for every item that could not be inserted.
+
+    Returns:
+        int: The number of items inserted.
+    """
+    if not chunk:
+        return 0
+    with warehouse_conn.cursor() as cursor:
+        cursor.execute("SAVEPOINT bisect_chunk")
+        try:
+            insert_chunk(cursor, chunk)
+        except (IntegrityError, DataError) as e:
+            cursor.execute("ROLLBACK TO SAVEPOINT bisect_chunk")
+            cursor.execute("RELEASE SAVEPOINT bisect_chunk")
+            if run_metrics.current() is not None:
+                run_metrics.current().retries += 1
+            if len(chunk) == 1:
+                rejects.append((chunk[0], str(e).strip()))
+                return 0
+            middle = len(chunk) // 2
+            return (bisect_insert(warehouse_conn, chunk[:middle], insert_chunk, rejects)
+                    + bisect_insert(warehouse_conn, chunk[middle:], insert_chunk, rejects))
+        cursor.execute("RELEASE SAVEPOINT bisect_chunk")
+        return len(chunk)
+
+
+def write_load_rejects(warehouse_conn, stage, table_name, rejects, logger):
+    """
+    Writes rejected rows with their error text to the etl.load_rejects quarantine table.
+
+    Args:
+        warehouse_conn (connection): Connection to the warehouse database, with an open transaction.
+        stage (str): The pipeline stage that rejected the rows ('staging' or 'core').
+        table_name (str): The table the rows were meant for.
+        rejects (list): (record, error) tuples, where record is the JSON text of the rejected row.
+        logger (Logger): The logger object for logging.
+
+    Returns:
+        None
+    """
+    with warehouse_conn.cursor() as cursor:
+        cursor.executemany("""
+            INSERT INTO etl.load_rejects (stage, table_name, record, error)
+            VALUES (%s, %s, %s, %s)
+        """, [(stage, table_name, record, error) for record, error in rejects])
+    for record, error in rejects:
+        # formatted only if the rate limit lets the record through
+        logger.error("Rejected row for %s: %s Row: %s", table_name, error, record, extra={"rate_limit": table_name})
+    logger.warning(f"{len(rejects)} rows rejected for {table_name} and quarantined in etl.load_rejects.")
+
+
+# Staging tables the core loaders only join against and never insert from wholesale, so reloading them completely
+# cannot make the core load insert a row twice
+FULL_RELOAD_STAGING_TABLES = {"staging.location", "staging.category", "staging.subcategory", "staging.payment_method"}
+
+
+def shared_columns(production_cursor, production_table, warehouse_cursor, staging_table):
+    """
+    Returns the columns of a staging table that its production table has as well, in staging order.
+    """
+    query = """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s
+        ORDER BY ordinal_position
+    """
+    production_cursor.execute(query, tuple(production_table.split('.')))
+    production_columns = {row[0] for row in production_cursor.fetchall()}
+    warehouse_cursor.execute(query, tuple(staging_table.split('.')))
+    return [row[0] for row in warehouse_cursor.fetchall() if row[0] in production_columns]
+
+
+def table_fingerprint(cursor, table, columns, key_column):
+    """
+    Summarizes the rows of a table on the server, so a production table and its staging copy can be compared
+    without transferring them. Tables whose column types differ never compare equal.
+
+    Returns:
+        tuple: (row count, md5 of the rows in key order, largest key).
+    """
+    cursor.execute(sql.SQL("""
+        SELECT count(*), md5(string_agg(t::text, '|' ORDER BY t.{key})), max(t.{key})
+        FROM (SELECT {columns} FROM {table}) t
+    """).format(key=sql.Identifier(key_column), columns=sql.SQL(', ').join(map(sql.Identifier, columns)),
+                table=sql.Identifier(*table.split('.'))))
+    return cursor.fetchone()
+
+
+def choose_staging_load_mode(production_conn, warehouse_conn, staging_table, watermark, logger, options=None):
+    """
+    Chooses how to load a staging table in this run from the estimated size of its production table and of the
+    delta past the watermark.
+
+    - 'full' copies the whole production table, replacing the staging rows, when it is small enough that the
+      copy costs less than tracking the delta, or when most of it is new anyway. Only FULL_RELOAD_STAGING_TABLES
+      qualify. The delta is only counted up to that fraction of the table. When the staged rows already equal the
+      production table, see table_fingerprint, nothing is reloaded: the load appends after the production key, so
+      no row is extracted, the table is not marked dirty and the core loaders joining it do not run again.
+    - 'upsert' merges the delta when some of it is already staged, e.g. after a watermark reset.
+    - 'append' inserts the delta otherwise.
+
+    Returns:
+        tuple: (mode, watermark to extract after), the watermark is 0 for a full reload.
+    """
+    options = options or LoadOptions()
+    _, _, key_column = STAGING_WATERMARKS[staging_table]
+    source_table = sql.Identifier("public", staging_table.split('.')[1])
+    with production_conn.cursor() as cursor:
+        total_rows = estimated_row_count(cursor, f"public.{staging_table.split('.')[1]}")
+        # Counting stops where a full reload becomes worthwhile, so a large backlog is not counted out
+        count_limit = max(1, int(options.full_reload_ratio * total_rows))
+        cursor.execute(sql.SQL("SELECT count(*) FROM (SELECT 1 FROM {} WHERE {} > %s LIMIT %s) delta").format(
+            source_table, sql.Identifier(key_column)), (watermark, count_limit))
+        delta_rows = cursor.fetchone()[0]
+
+    if staging_table in FULL_RELOAD_STAGING_TABLES and (
+            total_rows <= options.full_reload_max_rows or delta_rows >= options.full_reload_ratio * total_rows):
+        mode = 'full'
+        with production_conn.cursor() as production_cursor, warehouse_conn.cursor() as warehouse_cursor:
+            columns = shared_columns(production_cursor, f"public.{staging_table.split('.')[1]}",
+                                     warehouse_cursor, staging_table)
+            production_fingerprint = table_fingerprint(
+                production_cursor, f"public.{staging_table.split('.')[1]}", columns, key_column)
+            if production_fingerprint == table_fingerprint(warehouse_cursor, staging_table, columns, key_column):
+                logger.info(f"{staging_table} is unchanged in production, full reload skipped.")
+                return 'append', production_fingerprint[2] or 0
+    else:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE {} > %s)").format(
+                sql.Identifier(*staging_table.split('.')), sql.Identifier(key_column)), (watermark,))
+            mode = 'upsert' if cursor.fetchone()[0] else 'append'
+
+    logger.info(f"{mode.capitalize()} load chosen for {staging_table}: {delta_rows}"
+                f"{'+' if delta_rows >= count_limit else ''} rows past watermark {watermark}, "
+                f"about {int(total_rows)} rows in production.")
+    return mode, (0 if mode == 'full' else watermark)
+
+
+def load_staging_records(warehouse_conn, staging_table, columns, records, logger, options=None, mode='append'):
+    """
+    Inserts extracted records into a staging table within the caller's transaction.
+
+    In 'full' mode the records replace the contents of the table. In 'upsert' mode records whose key, the first column, is already staged overwrite the staged row.
+    options.insert_mode picks how the records are sent. The time taken is logged and measured as the 'load' stage.
+
+    With options.fault_isolation a failing batch is bisected: the good rows stay in the transaction and the
+    offending rows are written to etl.load_rejects. With options.fast_staging the transaction commits without
+    waiting for its WAL to be flushed. With options.run_id the rows are tagged with it in their etl_batch_id column.
+
+    Args:
+        warehouse_conn (connection): Connection to the warehouse database.
+        staging_table (str): The schema qualified staging table, e.g. 'staging.orders'.
+        columns (tuple): The staging columns, in the order of the record fields.
+        records (list): The records extracted from production.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+        mode (str, optional): 'append', 'upsert' or 'full', see choose_staging_load_mode.
+
+    Returns:
+        int: The number of records inserted.
+    """
+    options = options or LoadOptions()
+    started = time.perf_counter()
+    table = sql.Identifier(*staging_table.split('.'))
+    if options.run_id is not None:
+        # tag every row with the staging run, see begin_pipeline_run
+        columns = tuple(columns) + ("etl_batch_id",)
+        records = [tuple(record) + (options.run_id,) for record in records]
+    insert_query = sql.SQL("INSERT INTO {} ({}) VALUES ({})").format(
+        table,
+        sql.SQL(', ').join(map(sql.Identifier, columns)),
+        sql.SQL(', ').join(sql.Placeholder() * len(columns))
+    )
+    if mode == 'upsert':
+        insert_query = sql.SQL("{} ON CONFLICT ({}) DO UPDATE SET {}").format(
+            insert_query, sql.Identifier(columns[0]),
+            sql.SQL(', ').join(sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column))
+                               for column in columns[1:]))
+
+    values_query = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+        table, sql.SQL(', ').join(map(sql.Identifier, columns)))
+    if mode == 'upsert':
+        values_query = sql.SQL("{} ON CONFLICT ({}) DO UPDATE SET {}").format(
+            values_query, sql.Identifier(columns[0]),
+            sql.SQL(', ').join(sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(column))
+                               for column in columns[1:]))
+    copy_query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(
+        table, sql.SQL(', ').join(map(sql.Identifier, columns)))
+
+    def insert_chunk(cursor, chunk):
+        metric = run_metrics.current()
+        if options.insert_mode == 'copy' and mode != 'upsert':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for record in chunk:
+                writer.writerow(['\\N' if value is None else value for value in record])
+            metric.bytes += buffer.tell()
+            metric.batches += 1
+            buffer.seek(0)
+            cursor.copy_expert(copy_query, buffer)
+        elif options.insert_mode in ('values', 'copy'):
+            # COPY cannot resolve conflicts, so upserts fall back to multi-row VALUES
+            metric.batches += -(-len(chunk) // 1000)
+            execute_values(cursor, values_query, chunk, page_size=1000)
+        else:
+            metric.batches += len(chunk)
+            cursor.executemany(insert_query, chunk)
+
+    with warehouse_conn.cursor() as cursor:
+        if options.fast_staging:
+            cursor.execute("SET LOCAL synchronous_commit = off")
+        if mode == 'full':
+            cursor.execute(sql.SQL("TRUNCATE TABLE {}").format(table))
+
+    with run_metrics.measure("load", staging_table, options.run_id) as metric:
+        if options.insert_mode != 'copy':
+            metric.bytes = estimated_bytes(records)
+        if not options.fault_isolation:
+            with warehouse_conn.cursor() as cursor:
+                insert_chunk(cursor, records)
+            inserted = len(records)
+        else:
+            rejects = []
+            inserted = bisect_insert(warehouse_conn, list(records), insert_chunk, rejects)
+            if rejects:
+                write_load_rejects(warehouse_conn, 'staging', staging_table, [
+                    (json.dumps(dict(zip(columns, record)), default=str), error) for record, error in rejects
+                ], logger)
+        metric.rows = inserted
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"{mode.capitalize()} load of {staging_table}: {inserted} records in {elapsed:.3f}s.")
+    return inserted
+
+
+def explain_core_select(warehouse_conn, target_table, query, options):
+    """
+    Appends the EXPLAIN (ANALYZE, BUFFERS) of a core SELECT to the .explain.txt artifact of the stage being
+    profiled. ANALYZE runs the SELECT, so profiled core loads read their sources twice.
+    """
+    path = profile_artifact_path(options, ".explain.txt")
+    if path is None:
+        return
+    with warehouse_conn.cursor() as cursor:
+        cursor.execute(sql.SQL("EXPLAIN (ANALYZE, BUFFERS) {}").format(query))
+        plan = "\n".join(row[0] for row in cursor.fetchall())
+    with open(path, "a") as file:
+        file.write(f"-- {target_table}\n{plan}\n\n")
+
+
+def and_filters(*filters):
+    """
+    Combines the given row filters, ignoring None, into one condition; None if there is none.
+    """
+    filters = [row_filter for row_filter in filters if row_filter is not None]
+    if not filters:
+        return None
+    return sql.SQL(" AND ").join(sql.SQL("({})").format(row_filter) for row_filter in filters)
+
+
+def core_delta_filter(options, staging_table, alias=None):
+    """
+    Restricts a core SELECT to the rows of staging_table in options.core_delta: past the consumed watermark up to
+    the extraction watermark the core load started from, plus the rows pending from earlier loads.
+
+    Returns:
+        sql.Composable: The condition, None without options.core_delta.
+    """
+    if options.core_delta is None or staging_table not in options.core_delta:
+        return None
+    consumed, extracted, pending = options.core_delta[staging_table]
+    _, _, key_column = STAGING_WATERMARKS[staging_table]
+    key = sql.Identifier(alias, key_column) if alias else sql.Identifier(key_column)
+    row_filter = sql.SQL("{key} > {consumed} AND {key} <= {extracted}").format(
+        key=key, consumed=sql.Literal(consumed), extracted=sql.Literal(extracted))
+    if pending:
+        row_filter = sql.SQL("({} OR {} = ANY({}))").format(row_filter, key, sql.Literal(list(pending)))
+    return row_filter
+
+
+def execute_core_insert(warehouse_conn, target_table, columns, select_query, source_table, key_column, logger,
+                        options=None, source_alias=None, extra_filter=None, query_arguments=None,
+                        conflict_columns=None):
+    """
+    Runs an INSERT ... SELECT from staging into a core table within the caller's transaction.
+
+    Rows whose key is already in the target table are skipped, so loading the same staging rows again inserts
+    nothing. Tables keyed by a generated id name the natural key the skipping goes by in conflict_columns. The
+    select_query must contain a {row_filter} placeholder in its WHERE clause. A plain load fills it with TRUE;
+    with options.fault_isolation the load runs over pages of options.fault_isolation_page_keys source keys, each
+    retried on failure over ranges of the key, bisecting until the offending source rows are isolated and
+    quarantined in etl.load_rejects. With options.run_id the rows are tagged with the run in their etl_run_id column.
+
+    Args:
+        warehouse_conn (connection): Connection to the warehouse database.
+        target_table (str): The schema qualified core table, e.g. 'core.returns_fact'.
+        columns (tuple): The target columns, in the order of the select list.
+        select_query (sql.SQL): The SELECT producing the core rows.
+        source_table (str): The staging table driving the SELECT, e.g. 'staging.returns'.
+        key_column (str): A key of the source table used to split the load into ranges.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+        source_alias (str, optional): The alias of the source table inside select_query.
+        extra_filter (sql.Composable, optional): An additional condition restricting the rows to load.
+        query_arguments (dict, optional): Composables for the other placeholders of select_query, e.g. the
+            schema qualified tables it joins.
+        conflict_columns (tuple, optional): The columns of the unique key identifying rows already loaded, e.g.
+            ('orderitem_id', 'time_id'). Defaults to any unique key of the target table.
+
+    Returns:
+        int: The number of rows inserted.
+    """
+    options = options or LoadOptions()
+    query_arguments = query_arguments or {}
+    conflict_target = sql.SQL("")
+    if conflict_columns:
+        conflict_target = sql.SQL("({}) ").format(sql.SQL(', ').join(map(sql.Identifier, conflict_columns)))
+    key = sql.Identifier(source_alias, key_column) if source_alias else sql.Identifier(key_column)
+
+    def insert_query(row_filter):
+        if extra_filter is not None:
+            row_filter = sql.SQL("({}) AND ({})").format(extra_filter, row_filter)
+        target_columns, query = columns, select_query.format(row_filter=row_filter, **query_arguments)
+        if options.run_id is not None:
+            target_columns = tuple(columns) + ("etl_run_id",)
+            query = sql.SQL("SELECT q.*, {} FROM ({}) q").format(sql.Literal(options.run_id), query)
+        return sql.SQL("INSERT INTO {} ({}) {} ON CONFLICT {}DO NOTHING").format(
+            sql.Identifier(*target_table.split('.')),
+            sql.SQL(', ').join(map(sql.Identifier, target_columns)),
+            query,
+            conflict_target
+        )
+
+    if options.profile_dir:
+        row_filter = sql.SQL("TRUE") if extra_filter is None else extra_filter
+        explain_core_select(warehouse_conn, target_table, select_query.format(row_filter=row_filter, **query_arguments), options)
+
+    if not options.fault_isolation:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute(insert_query(sql.SQL("TRUE")))
+            return cursor.rowcount
+
+    # Keys of the source rows the SELECT would load, with the same joins and filters, one page at a time
+    key_filter = sql.SQL("{} = bisect_source.{}").format(key, sql.Identifier(key_column))
+    if extra_filter is not None:
+        key_filter = sql.SQL("({}) AND ({})").format(extra_filter, key_filter)
+    key_page_query = sql.SQL("""
+        SELECT DISTINCT bisect_source.{column}
+        FROM {source} bisect_source
+        WHERE (%(after)s IS NULL OR bisect_source.{column} > %(after)s) AND EXISTS ({select})
+        ORDER BY bisect_source.{column}
+        LIMIT %(page)s
+    """).format(column=sql.Identifier(key_column), source=sql.Identifier(*source_table.split('.')),
+                select=select_query.format(row_filter=key_filter, **query_arguments))
+    key_range_query = insert_query(sql.SQL("{} BETWEEN %s AND %s").format(key))
+    inserted_rows = []
+
+    def insert_chunk(cursor, chunk):
+        cursor.execute(key_range_query, (chunk[0], chunk[-1]))
+        inserted_rows.append(cursor.rowcount)
+
+    rejects = []
+    last_key = None
+    while True:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute(key_page_query, {"after": last_key, "page": options.fault_isolation_page_keys})
+            keys = [row[0] for row in cursor.fetchall()]
+        if not keys:
+            break
+        bisect_insert(warehouse_conn, keys, insert_chunk, rejects)
+        last_key = keys[-1]
+    if rejects:
+        with warehouse_conn.cursor() as cursor:
+            record_query = sql.SQL("SELECT row_to_json(s)::text FROM {} s WHERE s.{} = %s").format(
+                sql.Identifier(*source_table.split('.')), sql.Identifier(key_column))
+            records = []
+            for key_value, error in rejects:
+                cursor.execute(record_query, (key_value,))
+                records.extend((row[0], error) for row in cursor.fetchall())
+        write_load_rejects(warehouse_conn, 'core', target_table, records, logger)
+    return sum(inserted_rows)
+
+
+def load_partitioned_fact(warehouse_conn, table_name, columns, select_query, source_table, key_column,
+                          partition_column, first_day, last_day, logger, options=None, source_alias=None,
+                          extra_filter=None, conflict_columns=None):
+    """
+    Loads a monthly partitioned core fact table from staging within the caller's transaction.
+
+    Missing monthly partitions between first_day and last_day are created automatically. With
+    options.attach_partitions every new month is loaded into a standalone table which is attached once filled, and
+    only the rows of months that already had a partition go through the parent table.
+
+    Args:
+        warehouse_conn (connection): Connection to the warehouse database.
+        table_name (str): The fact table in options.core_schema, e.g. 'sales_fact'.
+        columns (tuple): The target columns, in the order of the select list.
+        select_query (sql.SQL): The SELECT producing the fact rows, with a {row_filter} placeholder.
+        source_table (str): The staging table driving the SELECT.
+        key_column (str): A key of the source table, see execute_core_insert.
+        partition_column (sql.Composable): The timestamp or date expression of select_query the partition key
+            is derived from.
+        first_day (date): The earliest day in the delta, None when the delta is empty.
+        last_day (date): The latest day in the delta.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+        source_alias (str, optional): The alias of the source table inside select_query.
+        extra_filter (sql.Composable, optional): An additional condition restricting the rows to load.
+        conflict_columns (tuple, optional): The unique key of rows already loaded, see execute_core_insert.
+
+    Returns:
+        int: The number of rows inserted.
+    """
+    options = options or LoadOptions()
+    if first_day is None:
+        return 0
+
+    def restrict(row_filter):
+        if extra_filter is None:
+            return row_filter
+        if row_filter is None:
+            return extra_filter
+        return sql.SQL("({}) AND ({})").format(extra_filter, row_filter)
+
+    schema = options.core_schema
+    if not options.attach_partitions:
+        ensure_monthly_partitions(warehouse_conn, logger, table_name, first_day, last_day, schema)
+        return execute_core_insert(warehouse_conn, f"{schema}.{table_name}", columns, select_query, source_table,
+                                   key_column, logger, options, source_alias, extra_filter=extra_filter,
+                                   conflict_columns=conflict_columns)
+
+    inserted = 0
+    month_filters = []
+    for month in missing_monthly_partitions(warehouse_conn, table_name, first_day, last_day, schema):
+        month_filter = sql.SQL("{column} >= {lower} AND {column} < {upper}").format(
+            column=partition_column, lower=sql.Literal(month), upper=sql.Literal(next_month_start(month)))
+        partition = create_monthly_partition(warehouse_conn, table_name, month, detached=True, schema=schema)
+        inserted += execute_core_insert(warehouse_conn, partition, columns, select_query, source_table, key_column,
+                                        logger, options, source_alias, extra_filter=restrict(month_filter),
+                                        conflict_columns=conflict_columns)
+        attach_monthly_partition(warehouse_conn, table_name, month, schema)
+        month_filters.append(month_filter)
+        logger.info(f"Loaded and attached partition {partition}.")
+
+    remaining_filter = None
+    if month_filters:
+        remaining_filter = sql.SQL("NOT ({})").format(sql.SQL(" OR ").join(month_filters))
+    inserted += execute_core_insert(warehouse_conn, f"{schema}.{table_name}", columns, select_query, source_table,
+                                    key_column, logger, options, source_alias, extra_filter=restrict(remaining_filter),
+                                    conflict_columns=conflict_columns)
+    return inserted
+
+
+# bulk fact load helpers
+def estimated_row_count(cursor, table):
+    """
+    Returns the planner's estimate of the rows in a table; partitioned parents report the sum over their
+    partitions.
+    """
+    cursor.execute("""
+        SELECT COALESCE(sum(GREATEST(c.reltuples, 0)), 0)
+        FROM pg_class c
+        WHERE c.oid = %s::regclass
+           OR c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass)
+    """, (table, table))
+    return float(cursor.fetchone()[0])
+
+
+def choose_fact_load_strategy(warehouse_conn, target_table, source_table, logger, options=None):
+    """
+    Chooses between a regular load and a bulk load of a core fact table from the size of its staging delta.
+
+    A bulk load pays off when the delta is both large in absolute terms and large relative to the fact table, since
+    rebuilding the secondary indexes and revalidating the foreign keys then costs less than maintaining them row by
+    row. The delta is the rows of source_table in options.core_delta, see core_delta_filter, and counting stops once
+    it is large enough for a bulk load.
+
+    Args:
+        warehouse_conn (connection): Connection to the warehouse database.
+        target_table (str): The schema qualified fact table, e.g. 'core.sales_fact'.
+        source_table (str): The staging table holding the delta, e.g. 'staging.orderitem'.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+
+    Returns:
+        str: 'bulk' or 'regular'.
+    """
+    options = options or LoadOptions()
+    if options.bulk_load is not None:
+        return 'bulk' if options.bulk_load else 'regular'
+
+    with warehouse_conn.cursor() as cursor:
+        target_rows = estimated_row_count(cursor, target_table)
+        count_limit = max(options.bulk_load_min_rows, int(options.bulk_load_ratio * target_rows) + 1)
+        cursor.execute(sql.SQL("SELECT count(*) FROM (SELECT 1 FROM {} WHERE {} LIMIT %s) delta").format(
+            sql.Identifier(*source_table.split('.')), core_delta_filter(options, source_table) or sql.SQL("TRUE")),
+            (count_limit,))
+        delta_rows = cursor.fetchone()[0]
+
+    strategy = 'regular'
+    if delta_rows >= options.bulk_load_min_rows and delta_rows >= options.bulk_load_ratio * float(target_rows):
+        strategy = 'bulk'
+    logger.info(f"{strategy.capitalize()} load chosen for {target_table}: {delta_rows}"
+                f"{'+' if delta_rows >= count_limit else ''} delta rows, about {int(target_rows)} existing rows.")
+    return strategy
+
+
+def drop_secondary_indexes_and_foreign_keys(target_table, logger, lock_timeout='10s'):
+    """
+    Drops the non-unique indexes and the foreign keys of a table in a transaction of its own, ahead of a bulk load.
+
+    The primary key and unique indexes are kept, so the load still rejects duplicates. The drops take an ACCESS
+    EXCLUSIVE lock on the table, held only until this short transaction commits and given up after lock_timeout;
+    the load itself then only takes the ROW EXCLUSIVE lock of its inserts, so readers are never blocked by it, they
+    only run without the dropped indexes until rebuild_secondary_indexes_and_foreign_keys restores them. The caller
+    must call it whether or not the load succeeds.
+
+    Returns:
+        tuple: (index_definitions, foreign_keys) to pass to rebuild_secondary_indexes_and_foreign_keys, None if the
+        lock was not granted in time and nothing was dropped.
+    """
+    table = sql.Identifier(*target_table.split('.'))
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute("SELECT set_config('lock_timeout', %s, true)", (lock_timeout,))
+            cursor.execute("""
+                SELECT n.nspname, c.relname, pg_get_indexdef(i.indexrelid)
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE i.indrelid = %s::regclass
+                  AND NOT i.indisprimary
+                  AND NOT i.indisunique
+            """, (target_table,))
+            indexes = cursor.fetchall()
+            cursor.execute("""
+                SELECT conname, pg_get_constraintdef(oid)
+                FROM pg_constraint
+                WHERE conrelid = %s::regclass AND contype = 'f'
+            """, (target_table,))
+            foreign_keys = cursor.fetchall()
+
+            for schema, index_name, _ in indexes:
+                cursor.execute(sql.SQL("DROP INDEX {}").format(sql.Identifier(schema, index_name)))
+            for constraint_name, _ in foreign_keys:
+                cursor.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+                    table, sql.Identifier(constraint_name)))
+        warehouse_conn.commit()
+    except psycopg2.Error as e:
+        warehouse_conn.rollback()
+        logger.warning(f"Could not drop the indexes of {target_table}, loading it with them: {e}")
+        return None
+    finally:
+        close_connection(warehouse_conn)
+
+    logger.info(f"Dropped {len(indexes)} indexes and {len(foreign_keys)} foreign keys of {target_table} for bulk load.")
+    # Partitioned indexes are reported as ON ONLY, which would not cascade to the partitions when recreated
+    return [definition.replace(" ON ONLY ", " ON ", 1) for _, _, definition in indexes], foreign_keys
+
+
+def rebuild_secondary_indexes_and_foreign_keys(target_table, index_definitions, foreign_keys, logger, options=None):
+    """
+    Recreates the indexes and foreign keys dropped by drop_secondary_indexes_and_foreign_keys once the load is over,
+    whether it succeeded or not.
+
+    Indexes are built in parallel on separate connections; each build blocks writes to the table, not reads, while
+    it runs. Foreign keys are added NOT VALID, which is instant, and
+    then validated with VALIDATE CONSTRAINT, which does not block concurrent reads and writes. Partitioned tables
+    do not support NOT VALID foreign keys, so theirs are added and validated in one step.
+
+    A foreign key the loaded rows violate is never left dropped: it stays NOT VALID, on every partition of a
+    partitioned table, so new rows are checked again, and the failure is recorded on the run of options.run_id,
+    see record_run_warning.
+
+    Args:
+        target_table (str): The schema qualified fact table.
+        index_definitions (list): CREATE INDEX statements.
+        foreign_keys (list): (constraint_name, constraint_definition) tuples.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+
+    Returns:
+        list: The foreign keys left NOT VALID or missing.
+    """
+    options = options or LoadOptions()
+
+    def build_index(index_definition):
+        conn = connect_warehouse("index_build")
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(index_definition)
+            conn.commit()
+        finally:
+            close_connection(conn)
+
+    if index_definitions:
+        with ThreadPoolExecutor(max_workers=max(1, min(options.index_build_workers, len(index_definitions)))) as pool:
+            for index_definition, future in [(d, pool.submit(build_index, d)) for d in index_definitions]:
+                try:
+                    future.result()
+                except psycopg2.Error as e:
+                    logger.error(f"Failed to rebuild index for {target_table}: {index_definition} Error: {e}")
+
+    conn = connect_warehouse("index_build")
+    table = sql.Identifier(*target_table.split('.'))
+    unvalidated = []
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", (target_table,))
+            partitioned = cursor.fetchone()[0] == 'p'
+            partitions = []
+            if partitioned:
+                cursor.execute("""
+                    SELECT relid::regclass::text FROM pg_partition_tree(%s::regclass) WHERE isleaf
+                """, (target_table,))
+                partitions = [row[0] for row in cursor.fetchall()]
+        for constraint_name, definition in foreign_keys:
+            try:
+                with conn.cursor() as cursor:
+                    if partitioned:
+                        cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+                            table, sql.Identifier(constraint_name), sql.SQL(definition)))
+                    else:
+                        cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID").format(
+                            table, sql.Identifier(constraint_name), sql.SQL(definition)))
+                        conn.commit()
+                        cursor.execute(sql.SQL("ALTER TABLE {} VALIDATE CONSTRAINT {}").format(
+                            table, sql.Identifier(constraint_name)))
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                logger.error(f"Failed to validate foreign key {constraint_name} on {target_table}. Error: {e}")
+                unvalidated.append(constraint_name)
+                if partitioned:
+                    # the parent cannot hold a NOT VALID foreign key, its partitions can
+                    try:
+                        with conn.cursor() as cursor:
+                            for partition in partitions:
+                                cursor.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {} NOT VALID").format(
+                                    sql.SQL(partition), sql.Identifier(constraint_name), sql.SQL(definition)))
+                        conn.commit()
+                    except psycopg2.Error as e:
+                        conn.rollback()
+                        logger.error(f"Failed to restore foreign key {constraint_name} on the partitions of "
+                                     f"{target_table}. Error: {e}")
+                        continue
+                logger.warning(f"Foreign key {constraint_name} of {target_table} is left NOT VALID.")
+    finally:
+        close_connection(conn)
+    logger.info(f"Rebuilt {len(index_definitions)} indexes and {len(foreign_keys) - len(unvalidated)} foreign keys "
+                f"of {target_table}.")
+    if unvalidated and options.run_id is not None:
+        record_run_warning(options.run_id, f"foreign keys of {target_table} not validated: "
+                                           f"{', '.join(unvalidated)}", logger)
+    return unvalidated
+
+
+def perform_table_maintenance(changed_rows, logger, options=None):
+    """
+    Refreshes planner statistics of the tables that received many rows in this run, so the stages reading them
+    plan their joins on current numbers.
+
+    A table is analyzed when its new rows reach options.analyze_min_rows and options.analyze_ratio of its
+    estimated size, and vacuumed as well when its dead rows exceed options.vacuum_dead_ratio. Tables are
+    maintained concurrently on separate connections.
+
+    Args:
+        changed_rows (dict): Rows inserted per schema qualified table in this run.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+
+    Returns:
+        dict: The maintenance command run per table, for the tables that needed one.
+    """
+    options = options or LoadOptions()
+    if not options.maintenance:
+        return {}
+    if not any(rows and rows >= options.analyze_min_rows for rows in changed_rows.values()):
+        return {}
+
+    warehouse_conn = connect_warehouse()
+    actions = {}
+    try:
+        with warehouse_conn.cursor() as cursor:
+            for table, rows in changed_rows.items():
+                if not rows or rows < options.analyze_min_rows:
+                    continue
+                # The estimate predates the load, so it is taken as the size before this run's rows
+                estimated_rows = estimated_row_count(cursor, table)
+                if rows < options.analyze_ratio * estimated_rows:
+                    continue
+                cursor.execute("""
+                    SELECT COALESCE(sum(n_dead_tup), 0), COALESCE(sum(n_live_tup), 0)
+                    FROM pg_stat_user_tables
+                    WHERE relid = %s::regclass
+                       OR relid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass)
+                """, (table, table))
+                dead_rows, live_rows = cursor.fetchone()
+                vacuum = live_rows and dead_rows > options.vacuum_dead_ratio * live_rows
+                actions[table] = "VACUUM (ANALYZE)" if vacuum else "ANALYZE"
+        warehouse_conn.commit()
+    finally:
+        close_connection(warehouse_conn)
+
+    def maintain(table):
+        conn = connect_warehouse("index_build")
+        try:
+            # VACUUM cannot run inside a transaction block
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL("{} {}").format(sql.SQL(actions[table]), sql.Identifier(*table.split('.'))))
+        finally:
+            conn.autocommit = False
+            close_connection(conn)
+
+    if actions:
+        with ThreadPoolExecutor(max_workers=max(1, min(options.maintenance_workers, len(actions)))) as pool:
+            for table, future in [(t, pool.submit(maintain, t)) for t in actions]:
+                try:
+                    future.result()
+                    logger.info(f"{actions[table]} {table} after {changed_rows[table]} new rows.")
+                except psycopg2.Error as e:
+                    logger.error(f"Failed to {actions[table]} {table}. Error: {e}")
+    return actions
 
 
 # delta load location table
-def perform_delta_load_location(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.location")
+def perform_delta_load_location(ETL_LOAD_FOLDER, logger, options=None):
     """
     Performs a delta load of the location data from the production database to the data warehouse.
 
     Parameters:
     - ETL_LOAD_FOLDER (str): The folder path where the last_location_id.json file is located.
     - logger (logging.Logger): The logger object used for logging.
+    - options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-    - None
+    - int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def save_last_location_id(last_location_id):
         with open(os.path.join(ETL_LOAD_FOLDER, 'last_location_id.json'), 'w') as file:
@@ -167,25 +1475,13 @@ def perform_delta_load_location(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database (location)
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.location")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -193,6 +1489,10 @@ def perform_delta_load_location(ETL_LOAD_FOLDER, logger):
             # Capture the last extracted location_id
             last_extracted_location_id = load_last_location_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_location_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.location", last_extracted_location_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     location_id,
@@ -208,10 +1508,10 @@ def perform_delta_load_location(ETL_LOAD_FOLDER, logger):
             rows = production_cursor.fetchall()
 
             if rows:
-                warehouse_cursor.executemany("""
-                    INSERT INTO staging.location (location_id, latitude, longitude, country, state, city)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, [(row[0], row[1], row[2], row[3], row[4], row[5]) for row in rows])
+                inserted = load_staging_records(
+                    warehouse_conn, "staging.location",
+                    ("location_id", "latitude", "longitude", "country", "state", "city"),
+                    rows, logger, options, load_mode)
 
                 # Get the maximum location_id from the production data
                 max_location_id = max(row[0] for row in rows)
@@ -220,10 +1520,12 @@ def perform_delta_load_location(ETL_LOAD_FOLDER, logger):
                 save_last_location_id(max_location_id)
 
                 # Commit the changes to the data warehouse
-                warehouse_conn.commit()
+                timed_commit(warehouse_conn, "staging.location")
 
                 # Log success
-                logger.info(f"Delta load for location completed successfully. rows inserted {len(rows)}")
+                logger.info(f"Delta load for location completed successfully. rows inserted {inserted}")
+
+            return inserted
 
         except Exception as e:
             # Log the error
@@ -244,24 +1546,27 @@ def perform_delta_load_location(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
 # delta load category table
-def perform_delta_load_category(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.category")
+def perform_delta_load_category(ETL_LOAD_FOLDER, logger, options=None):
     """
     Performs a delta load for the category table.
 
     Args:
         ETL_LOAD_FOLDER (str): The folder path where the ETL load files are stored.
         logger (Logger): The logger object used for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_category_id():
         try:
@@ -278,25 +1583,13 @@ def perform_delta_load_category(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.category")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -305,6 +1598,10 @@ def perform_delta_load_category(ETL_LOAD_FOLDER, logger):
             # Read the last extracted category_id from the JSON file
             last_extracted_category_id = read_last_extracted_category_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_category_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.category", last_extracted_category_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     category_id,
@@ -321,23 +1618,25 @@ def perform_delta_load_category(ETL_LOAD_FOLDER, logger):
                 logger.info("No new records to load for category.")
             else:
                 # Insert all records into the data warehouse
-                warehouse_cursor.executemany("""
-                    INSERT INTO staging.category (category_id, category_name)
-                    VALUES (%s, %s)
-                """, records)
+                inserted = load_staging_records(
+                    warehouse_conn, "staging.category",
+                    ("category_id", "category_name"),
+                    records, logger, options, load_mode)
 
                 # Update the last extracted category_id
                 last_extracted_category_id = max(record[0] for record in records)
 
                 # Commit changes
-                warehouse_conn.commit()
+                timed_commit(warehouse_conn, "staging.category")
 
                 # Log the number of new records inserted
-                logger.info(f"Delta load for category completed successfully. {len(records)} new records inserted.")
+                logger.info(f"Delta load for category completed successfully. {inserted} new records inserted.")
 
             # Write the updated last extracted category_id to the JSON file
             write_last_extracted_category_id(last_extracted_category_id)
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for category: {e}")
@@ -357,24 +1656,27 @@ def perform_delta_load_category(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
 #  delta load supplier table
-def perform_delta_load_supplier(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.supplier")
+def perform_delta_load_supplier(ETL_LOAD_FOLDER, logger, options=None):
     """
     Performs a delta load for the supplier data from the production database to the data warehouse(staging).
 
     Args:
         ETL_LOAD_FOLDER (str): The path to the folder where ETL data is stored.
         logger: The logger object for logging messages.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_supplier_id():
         try:
@@ -391,25 +1693,13 @@ def perform_delta_load_supplier(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.supplier")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -418,6 +1708,10 @@ def perform_delta_load_supplier(ETL_LOAD_FOLDER, logger):
             # Read the last extracted supplier_id from the JSON file
             last_extracted_supplier_id = read_last_extracted_supplier_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_supplier_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.supplier", last_extracted_supplier_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     supplier_id,
@@ -435,23 +1729,25 @@ def perform_delta_load_supplier(ETL_LOAD_FOLDER, logger):
                 logger.info("No new records to load for supplier.")
             else:
                 # Insert all records into the data warehouse
-                warehouse_cursor.executemany("""
-                    INSERT INTO staging.supplier (supplier_id, supplier_name, email)
-                    VALUES (%s, %s, %s)
-                """, records)
+                inserted = load_staging_records(
+                    warehouse_conn, "staging.supplier",
+                    ("supplier_id", "supplier_name", "email"),
+                    records, logger, options, load_mode)
 
                 # Update the last extracted supplier_id
                 last_extracted_supplier_id = max(record[0] for record in records)
 
                 # Commit changes
-                warehouse_conn.commit()
+                timed_commit(warehouse_conn, "staging.supplier")
 
                 # Log the number of new records inserted
-                logger.info(f"Delta load for supplier completed successfully. {len(records)} new records inserted.")
+                logger.info(f"Delta load for supplier completed successfully. {inserted} new records inserted.")
 
             # Write the updated last extracted supplier_id to the JSON file
             write_last_extracted_supplier_id(last_extracted_supplier_id)
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for supplier: {e}")
@@ -471,24 +1767,27 @@ def perform_delta_load_supplier(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
 #  delta load payment_method table
-def perform_delta_load_payment_method(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.payment_method")
+def perform_delta_load_payment_method(ETL_LOAD_FOLDER, logger, options=None):
     """
     Perform a delta load for the payment_method table.
 
     Args:
         ETL_LOAD_FOLDER (str): The path to the ETL load folder.
         logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_payment_method_id():
         try:
@@ -505,25 +1804,13 @@ def perform_delta_load_payment_method(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.payment_method")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -532,6 +1819,10 @@ def perform_delta_load_payment_method(ETL_LOAD_FOLDER, logger):
             # Read the last extracted payment_method_id from the JSON file
             last_extracted_payment_method_id = read_last_extracted_payment_method_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_payment_method_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.payment_method", last_extracted_payment_method_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     payment_method_id,
@@ -548,24 +1839,26 @@ def perform_delta_load_payment_method(ETL_LOAD_FOLDER, logger):
                 logger.info("No new records to load for payment_method.")
             else:
                 # Insert all records into the data warehouse
-                warehouse_cursor.executemany("""
-                    INSERT INTO staging.payment_method (payment_method_id, payment_method)
-                    VALUES (%s, %s)
-                """, records)
+                inserted = load_staging_records(
+                    warehouse_conn, "staging.payment_method",
+                    ("payment_method_id", "payment_method"),
+                    records, logger, options, load_mode)
 
                 # Update the last extracted payment_method_id
                 last_extracted_payment_method_id = max(record[0] for record in records)
 
                 # Commit changes
-                warehouse_conn.commit()
+                timed_commit(warehouse_conn, "staging.payment_method")
 
                 # Log the number of new records inserted
                 logger.info(
-                    f"Delta load for payment_method completed successfully. {len(records)} new records inserted.")
+                    f"Delta load for payment_method completed successfully. {inserted} new records inserted.")
 
             # Write the updated last extracted payment_method_id to the JSON file
             write_last_extracted_payment_method_id(last_extracted_payment_method_id)
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for payment_method: {e}")
@@ -585,24 +1878,27 @@ def perform_delta_load_payment_method(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
 # delta load subcategory table
-def perform_delta_load_subcategory(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.subcategory")
+def perform_delta_load_subcategory(ETL_LOAD_FOLDER, logger, options=None):
     """
     Perform a delta load for the subcategory table.
 
     Args:
         ETL_LOAD_FOLDER (str): The path to the ETL load folder.
         logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_subcategory_id():
         try:
@@ -619,25 +1915,13 @@ def perform_delta_load_subcategory(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.subcategory")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -646,6 +1930,10 @@ def perform_delta_load_subcategory(ETL_LOAD_FOLDER, logger):
             # Read the last extracted subcategory_id from the JSON file
             last_extracted_subcategory_id = read_last_extracted_subcategory_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_subcategory_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.subcategory", last_extracted_subcategory_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     subcategory_id,
@@ -663,23 +1951,25 @@ def perform_delta_load_subcategory(ETL_LOAD_FOLDER, logger):
                 logger.info("No new records to load for subcategory.")
             else:
                 # Insert all records into the data warehouse
-                warehouse_cursor.executemany("""
-                    INSERT INTO staging.subcategory (subcategory_id, subcategory_name, category_id)
-                    VALUES (%s, %s, %s)
-                """, records)
+                inserted = load_staging_records(
+                    warehouse_conn, "staging.subcategory",
+                    ("subcategory_id", "subcategory_name", "category_id"),
+                    records, logger, options, load_mode)
 
                 # Update the last extracted subcategory_id
                 last_extracted_subcategory_id = max(record[0] for record in records)
 
                 # Commit changes
-                warehouse_conn.commit()
+                timed_commit(warehouse_conn, "staging.subcategory")
 
                 # Log the number of new records inserted
-                logger.info(f"Delta load for subcategory completed successfully. {len(records)} new records inserted.")
+                logger.info(f"Delta load for subcategory completed successfully. {inserted} new records inserted.")
 
             # Write the updated last extracted subcategory_id to the JSON file
             write_last_extracted_subcategory_id(last_extracted_subcategory_id)
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for subcategory: {e}")
@@ -699,24 +1989,27 @@ def perform_delta_load_subcategory(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
 # delta load product table
-def perform_delta_load_product(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.product")
+def perform_delta_load_product(ETL_LOAD_FOLDER, logger, options=None):
     """
     Perform a delta load for the product table.
 
     Args:
         ETL_LOAD_FOLDER (str): The path to the ETL load folder.
         logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_product_id():
         try:
@@ -733,25 +2026,13 @@ def perform_delta_load_product(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.product")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -760,6 +2041,10 @@ def perform_delta_load_product(ETL_LOAD_FOLDER, logger):
             # Read the last extracted product_id from the JSON file
             last_extracted_product_id = read_last_extracted_product_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_product_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.product", last_extracted_product_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     product_id,
@@ -779,23 +2064,25 @@ def perform_delta_load_product(ETL_LOAD_FOLDER, logger):
                 logger.info("No new records to load for product.")
             else:
                 # Insert all records into the data warehouse
-                warehouse_cursor.executemany("""
-                    INSERT INTO staging.product (product_id, name, price, description, subcategory_id)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, records)
+                inserted = load_staging_records(
+                    warehouse_conn, "staging.product",
+                    ("product_id", "name", "price", "description", "subcategory_id"),
+                    records, logger, options, load_mode)
 
                 # Update the last extracted product_id
                 last_extracted_product_id = max(record[0] for record in records)
 
                 # Commit changes
-                warehouse_conn.commit()
+                timed_commit(warehouse_conn, "staging.product")
 
                 # Log the number of new records inserted
-                logger.info(f"Delta load for product completed successfully. {len(records)} new records inserted.")
+                logger.info(f"Delta load for product completed successfully. {inserted} new records inserted.")
 
             # Write the updated last extracted product_id to the JSON file
             write_last_extracted_product_id(last_extracted_product_id)
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for product: {e}")
@@ -815,24 +2102,27 @@ def perform_delta_load_product(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
 # delta load customer table
-def perform_delta_load_customer(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.customer")
+def perform_delta_load_customer(ETL_LOAD_FOLDER, logger, options=None):
     """
     Perform a delta load for the customer table.
 
     Args:
         ETL_LOAD_FOLDER (str): The path to the ETL load folder.
         logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_customer_id():
         try:
@@ -849,25 +2139,13 @@ def perform_delta_load_customer(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.customer")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -876,6 +2154,10 @@ def perform_delta_load_customer(ETL_LOAD_FOLDER, logger):
             # Read the last extracted customer_id from the JSON file
             last_extracted_customer_id = read_last_extracted_customer_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_customer_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.customer", last_extracted_customer_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     customer_id,
@@ -895,23 +2177,25 @@ def perform_delta_load_customer(ETL_LOAD_FOLDER, logger):
                 logger.info("No new records to load for customer.")
             else:
                 # Insert all records into the data warehouse
-                warehouse_cursor.executemany("""
-                    INSERT INTO staging.customer (customer_id, first_name, last_name, email, location_id)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, records)
+                inserted = load_staging_records(
+                    warehouse_conn, "staging.customer",
+                    ("customer_id", "first_name", "last_name", "email", "location_id"),
+                    records, logger, options, load_mode)
 
                 # Update the last extracted customer_id
                 last_extracted_customer_id = max(record[0] for record in records)
 
                 # Commit changes
-                warehouse_conn.commit()
+                timed_commit(warehouse_conn, "staging.customer")
 
                 # Log the number of new records inserted
-                logger.info(f"Delta load for customer completed successfully. {len(records)} new records inserted.")
+                logger.info(f"Delta load for customer completed successfully. {inserted} new records inserted.")
 
             # Write the updated last extracted customer_id to the JSON file
             write_last_extracted_customer_id(last_extracted_customer_id)
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for customer: {e}")
@@ -931,24 +2215,27 @@ def perform_delta_load_customer(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
 # delta load marketing campaign table
-def perform_delta_load_marketing_campaigns(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.marketing_campaigns")
+def perform_delta_load_marketing_campaigns(ETL_LOAD_FOLDER, logger, options=None):
     """
     Perform a delta load of marketing campaigns from the production database to the data warehouse.
 
     Args:
         ETL_LOAD_FOLDER (str): The folder path where the ETL load files are stored.
         logger (Logger): The logger object used for logging messages.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_campaign_id():
         try:
@@ -965,25 +2252,13 @@ def perform_delta_load_marketing_campaigns(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.marketing_campaigns")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -992,6 +2267,10 @@ def perform_delta_load_marketing_campaigns(ETL_LOAD_FOLDER, logger):
             # Read the last extracted campaign_id from the JSON file
             last_extracted_campaign_id = read_last_extracted_campaign_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_campaign_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.marketing_campaigns", last_extracted_campaign_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     campaign_id,
@@ -1005,26 +2284,28 @@ def perform_delta_load_marketing_campaigns(ETL_LOAD_FOLDER, logger):
             records = production_cursor.fetchall()
 
             # Insert all records into the data warehouse
-            warehouse_cursor.executemany("""
-                INSERT INTO staging.marketing_campaigns (campaign_id, campaign_name, offer_week)
-                VALUES (%s, %s, %s)
-            """, records)
+            inserted = load_staging_records(
+                warehouse_conn, "staging.marketing_campaigns",
+                ("campaign_id", "campaign_name", "offer_week"),
+                records, logger, options, load_mode)
 
             # Update the last extracted campaign_id
             if records:
                 last_extracted_campaign_id = max(record[0] for record in records)
                 logger.info(
-                    f"Delta load for marketing_campaigns completed successfully. Records inserted: {len(records)}")
+                    f"Delta load for marketing_campaigns completed successfully. Records inserted: {inserted}")
             else:
                 logger.info("No new records to load for marketing_campaigns")
             # Commit changes
-            warehouse_conn.commit()
+            timed_commit(warehouse_conn, "staging.marketing_campaigns")
 
             # Write the updated last extracted campaign_id to the JSON file
             write_last_extracted_campaign_id(last_extracted_campaign_id)
 
             # Log success
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for marketing_campaigns: {e}")
@@ -1044,23 +2325,26 @@ def perform_delta_load_marketing_campaigns(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
-def perform_delta_load_customer_product_ratings(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.customer_product_ratings")
+def perform_delta_load_customer_product_ratings(ETL_LOAD_FOLDER, logger, options=None):
     """
     Perform a delta load of customer product ratings from the production database to the data warehouse.
 
     Args:
         ETL_LOAD_FOLDER (str): The folder path where the ETL load files are stored.
         logger (Logger): The logger object used for logging messages.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_rating_id():
         try:
@@ -1077,25 +2361,13 @@ def perform_delta_load_customer_product_ratings(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.customer_product_ratings")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -1104,6 +2376,10 @@ def perform_delta_load_customer_product_ratings(ETL_LOAD_FOLDER, logger):
             # Read the last extracted rating_id from the JSON file
             last_extracted_rating_id = read_last_extracted_rating_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_rating_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.customer_product_ratings", last_extracted_rating_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     customerproductrating_id,
@@ -1120,10 +2396,10 @@ def perform_delta_load_customer_product_ratings(ETL_LOAD_FOLDER, logger):
             records = production_cursor.fetchall()
 
             # Insert all records into the data warehouse
-            warehouse_cursor.executemany("""
-                INSERT INTO staging.customer_product_ratings (customerproductrating_id, customer_id, product_id, ratings, review, sentiment)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, records)
+            inserted = load_staging_records(
+                warehouse_conn, "staging.customer_product_ratings",
+                ("customerproductrating_id", "customer_id", "product_id", "ratings", "review", "sentiment"),
+                records, logger, options, load_mode)
 
             # Update the last extracted rating_id
             if records:
@@ -1131,15 +2407,17 @@ def perform_delta_load_customer_product_ratings(ETL_LOAD_FOLDER, logger):
 
                 # Log success
                 logger.info(
-                    f"Delta load for customer_product_ratings completed successfully. Records inserted: {len(records)}")
+                    f"Delta load for customer_product_ratings completed successfully. Records inserted: {inserted}")
             else:
                 logger.info("No new records to load for customer_product_ratings")
             # Commit changes
-            warehouse_conn.commit()
+            timed_commit(warehouse_conn, "staging.customer_product_ratings")
 
             # Write the updated last extracted rating_id to the JSON file
             write_last_extracted_rating_id(last_extracted_rating_id)
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for customer_product_ratings: {e}")
@@ -1159,23 +2437,26 @@ def perform_delta_load_customer_product_ratings(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
-def perform_delta_load_orders(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.orders")
+def perform_delta_load_orders(ETL_LOAD_FOLDER, logger, options=None):
     """
     Perform a delta load for the orders table.
 
     Args:
         ETL_LOAD_FOLDER (str): The path to the ETL load folder.
         logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_order_id():
         try:
@@ -1192,25 +2473,13 @@ def perform_delta_load_orders(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.orders")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -1219,6 +2488,10 @@ def perform_delta_load_orders(ETL_LOAD_FOLDER, logger):
             # Read the last extracted order_id from the JSON file
             last_extracted_order_id = read_last_extracted_order_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_order_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.orders", last_extracted_order_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     order_id_surrogate,
@@ -1229,7 +2502,7 @@ def perform_delta_load_orders(ETL_LOAD_FOLDER, logger):
                     amount,
                     payment_method_id
                 FROM public.orders
-                WHERE order_id_surrogate > %s
+                WHERE order_id > %s
             """, (last_extracted_order_id,))
 
             # Fetch all records
@@ -1240,24 +2513,26 @@ def perform_delta_load_orders(ETL_LOAD_FOLDER, logger):
                 logger.info("No new records to load for orders.")
             else:
                 # Insert all records into the data warehouse
-                warehouse_cursor.executemany("""
-                    INSERT INTO staging.orders (order_id_surrogate, order_id, customer_id, order_timestamp, campaign_id,
-                    amount, payment_method_id)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """, records)
+                inserted = load_staging_records(
+                    warehouse_conn, "staging.orders",
+                    ("order_id_surrogate", "order_id", "customer_id", "order_timestamp", "campaign_id", "amount",
+                     "payment_method_id"),
+                    records, logger, options, load_mode)
 
                 # Update the last extracted order_id
                 last_extracted_order_id = max(record[1] for record in records)
 
                 # Commit changes
-                warehouse_conn.commit()
+                timed_commit(warehouse_conn, "staging.orders")
 
                 # Log the number of new records inserted
-                logger.info(f"Delta load for orders completed successfully. {len(records)} new records inserted.")
+                logger.info(f"Delta load for orders completed successfully. {inserted} new records inserted.")
 
             # Write the updated last extracted order_id to the JSON file
             write_last_extracted_order_id(last_extracted_order_id)
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for orders: {e}")
@@ -1277,23 +2552,26 @@ def perform_delta_load_orders(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
-def perform_delta_load_orderitem(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.orderitem")
+def perform_delta_load_orderitem(ETL_LOAD_FOLDER, logger, options=None):
     """
     Perform a delta load for the orderitem table.
 
     Args:
         ETL_LOAD_FOLDER (str): The path to the ETL load folder.
         logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_orderitem_id():
         try:
@@ -1310,25 +2588,13 @@ def perform_delta_load_orderitem(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database (orderitem)
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.orderitem")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -1337,6 +2603,10 @@ def perform_delta_load_orderitem(ETL_LOAD_FOLDER, logger):
             # Read the last extracted orderitem_id from the JSON file
             last_extracted_orderitem_id = read_last_extracted_orderitem_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_orderitem_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.orderitem", last_extracted_orderitem_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     orderitem_id,
@@ -1358,23 +2628,25 @@ def perform_delta_load_orderitem(ETL_LOAD_FOLDER, logger):
                 logger.info("No new records to load for orderitem.")
             else:
                 # Insert all records into the data warehouse
-                warehouse_cursor.executemany("""
-                    INSERT INTO staging.orderitem (orderitem_id, order_id, product_id, quantity, supplier_id, subtotal, discount)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                """, records)
+                inserted = load_staging_records(
+                    warehouse_conn, "staging.orderitem",
+                    ("orderitem_id", "order_id", "product_id", "quantity", "supplier_id", "subtotal", "discount"),
+                    records, logger, options, load_mode)
 
                 # Update the last extracted orderitem_id
                 last_extracted_orderitem_id = max(record[0] for record in records)
 
                 # Commit changes
-                warehouse_conn.commit()
+                timed_commit(warehouse_conn, "staging.orderitem")
 
                 # Log the number of new records inserted
-                logger.info(f"Delta load for orderitem completed successfully. {len(records)} new records inserted.")
+                logger.info(f"Delta load for orderitem completed successfully. {inserted} new records inserted.")
 
             # Write the updated last extracted orderitem_id to the JSON file
             write_last_extracted_orderitem_id(last_extracted_orderitem_id)
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for orderitem: {e}")
@@ -1394,23 +2666,26 @@ def perform_delta_load_orderitem(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
+            close_connection(warehouse_conn)
 
 
-def perform_delta_load_returns(ETL_LOAD_FOLDER, logger):
+@timed_stage("staging", "staging.returns")
+def perform_delta_load_returns(ETL_LOAD_FOLDER, logger, options=None):
     """
     Perform a delta load for the returns table.
 
     Args:
         ETL_LOAD_FOLDER (str): The path to the ETL load folder.
         logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of records inserted, None if the load failed.
     """
     production_conn, warehouse_conn = None, None
+    inserted = 0
 
     def read_last_extracted_return_id():
         try:
@@ -1427,25 +2702,13 @@ def perform_delta_load_returns(ETL_LOAD_FOLDER, logger):
 
     try:
         # Connect to the production database (returns)
-        production_conn = psycopg2.connect(
-            database="production",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        production_conn = connect_production("bulk_extract")
 
         # Create a cursor for the production database
-        production_cursor = production_conn.cursor()
+        production_cursor = MeasuredCursor(production_conn.cursor(), "staging.returns")
 
         # Connect to the data warehouse
-        warehouse_conn = psycopg2.connect(
-            database="warehouse",
-            user="postgres",
-            password="swati",
-            host="localhost",
-            port="5432"
-        )
+        warehouse_conn = connect_warehouse()
 
         # Create a cursor for the data warehouse
         warehouse_cursor = warehouse_conn.cursor()
@@ -1454,6 +2717,10 @@ def perform_delta_load_returns(ETL_LOAD_FOLDER, logger):
             # Read the last extracted return_id from the JSON file
             last_extracted_return_id = read_last_extracted_return_id()
 
+            # Full reload, upsert or append, whichever suits this run's delta
+            load_mode, last_extracted_return_id = choose_staging_load_mode(
+                production_conn, warehouse_conn, "staging.returns", last_extracted_return_id, logger, options)
+
             production_cursor.execute("""
                 SELECT
                     return_id,
@@ -1474,23 +2741,25 @@ def perform_delta_load_returns(ETL_LOAD_FOLDER, logger):
                 logger.info("No new records to load for returns.")
             else:
                 # Insert all records into the data warehouse
-                warehouse_cursor.executemany("""
-                    INSERT INTO staging.returns (return_id, order_id, product_id, return_date, reason, amount_refunded)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                """, records)
+                inserted = load_staging_records(
+                    warehouse_conn, "staging.returns",
+                    ("return_id", "order_id", "product_id", "return_date", "reason", "amount_refunded"),
+                    records, logger, options, load_mode)
 
                 # Update the last extracted return_id
                 last_extracted_return_id = max(record[0] for record in records)
 
                 # Commit changes
-                warehouse_conn.commit()
+                timed_commit(warehouse_conn, "staging.returns")
 
                 # Log the number of new records inserted
-                logger.info(f"Delta load for returns completed successfully. {len(records)} new records inserted.")
+                logger.info(f"Delta load for returns completed successfully. {inserted} new records inserted.")
 
             # Write the updated last extracted return_id to the JSON file
             write_last_extracted_return_id(last_extracted_return_id)
 
+            return inserted
+
         except Exception as e:
             # Log the error
             logger.error(f"Error performing delta load for returns: {e}")
@@ -1510,369 +2779,961 @@ def perform_delta_load_returns(ETL_LOAD_FOLDER, logger):
     finally:
         # Close connections
         if production_conn is not None:
-            production_conn.close()
+            close_connection(production_conn)
         if warehouse_conn is not None:
-            warehouse_conn.close()
-
-
-def perform_delta_load_staging(ETL_LOAD_FOLDER, logger):
-    # load location table
-    perform_delta_load_location(ETL_LOAD_FOLDER, logger)
-    # load category table
-    perform_delta_load_category(ETL_LOAD_FOLDER, logger)
-    # load supplier table
-    perform_delta_load_supplier(ETL_LOAD_FOLDER, logger)
-    # load payment method table
-    perform_delta_load_payment_method(ETL_LOAD_FOLDER, logger)
-    # load subcategory table
-    perform_delta_load_subcategory(ETL_LOAD_FOLDER, logger)
-    # load product table
-    perform_delta_load_product(ETL_LOAD_FOLDER, logger)
-    # load customer table
-    perform_delta_load_customer(ETL_LOAD_FOLDER, logger)
-    # load marketing campaign table
-    perform_delta_load_marketing_campaigns(ETL_LOAD_FOLDER, logger)
-    # load customer_product_ratings table
-    perform_delta_load_customer_product_ratings(ETL_LOAD_FOLDER, logger)
-    # load orders table
-    perform_delta_load_orders(ETL_LOAD_FOLDER, logger)
+            close_connection(warehouse_conn)
+
+
+# Staging loaders in load order, keyed by the staging table they fill
+STAGING_LOADERS = {
+    "staging.location": perform_delta_load_location,
+    "staging.category": perform_delta_load_category,
+    "staging.supplier": perform_delta_load_supplier,
+    "staging.payment_method": perform_delta_load_payment_method,
+    "staging.subcategory": perform_delta_load_subcategory,
+    "staging.product": perform_delta_load_product,
+    "staging.customer": perform_delta_load_customer,
+    "staging.marketing_campaigns": perform_delta_load_marketing_campaigns,
+    "staging.customer_product_ratings": perform_delta_load_customer_product_ratings,
+    "staging.orders": perform_delta_load_orders,
+    "staging.orderitem": perform_delta_load_orderitem,
+    "staging.returns": perform_delta_load_returns,
+}
+
+
+# Extraction watermark of each staging table: the JSON file in ETL_LOAD_FOLDER, its key and the column it tracks
+STAGING_WATERMARKS = {
+    "staging.location": ("last_location_id.json", "last_location_id", "location_id"),
+    "staging.category": ("last_extracted_category_id.json", "last_extracted_category_id", "category_id"),
+    "staging.supplier": ("last_extracted_supplier_id.json", "last_extracted_supplier_id", "supplier_id"),
+    "staging.payment_method": (
+        "last_extracted_payment_method_id.json", "last_extracted_payment_method_id", "payment_method_id"),
+    "staging.subcategory": ("last_extracted_subcategory_id.json", "last_extracted_subcategory_id", "subcategory_id"),
+    "staging.product": ("last_extracted_product_id.json", "last_extracted_product_id", "product_id"),
+    "staging.customer": ("last_extracted_customer_id.json", "last_extracted_customer_id", "customer_id"),
+    "staging.marketing_campaigns": ("last_extracted_campaign_id.json", "last_extracted_campaign_id", "campaign_id"),
+    "staging.customer_product_ratings": (
+        "last_extracted_rating_id.json", "last_extracted_rating_id", "customerproductrating_id"),
+    "staging.orders": ("last_extracted_order_id.json", "last_extracted_order_id", "order_id"),
+    "staging.orderitem": ("last_extracted_orderitem_id.json", "last_extracted_orderitem_id", "orderitem_id"),
+    "staging.returns": ("last_extracted_return_id.json", "last_extracted_return_id", "return_id"),
+}
+
+
+def read_staging_watermark(ETL_LOAD_FOLDER, staging_table):
+    file_name, key, _ = STAGING_WATERMARKS[staging_table]
+    try:
+        with open(os.path.join(ETL_LOAD_FOLDER, file_name), 'r') as file:
+            data = json.load(file)
+            return data.get(key, 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_staging_watermark(ETL_LOAD_FOLDER, staging_table, watermark):
+    file_name, key, _ = STAGING_WATERMARKS[staging_table]
+    with open(os.path.join(ETL_LOAD_FOLDER, file_name), 'w') as file:
+        json.dump({key: watermark}, file)
+
+
+# Staging rows the core load joins to their parent row and can only consume once that row is staged:
+# staging table -> (column, parent staging table). Order items are written to production before their order.
+STAGING_JOIN_DEPENDENCIES = {
+    "staging.orderitem": ("order_id", "staging.orders"),
+}
+
+# Staging rows that unconsumed rows of other staging tables still reference, so the purge keeps them:
+# staging table -> ((referencing staging table, referencing column), ...), joined on the key of the table
+STAGING_REFERENCES = {
+    "staging.orders": (("staging.orderitem", "order_id"), ("staging.returns", "order_id")),
+    "staging.customer": (("staging.orders", "customer_id"),),
+}
+
+
+def read_consumed_watermarks(ETL_LOAD_FOLDER):
+    """
+    Reads the extraction watermarks of the staging tables as of the last core load that consumed them.
+    """
+    try:
+        with open(os.path.join(ETL_LOAD_FOLDER, 'consumed_watermarks.json'), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def read_pending_staging_rows(ETL_LOAD_FOLDER):
+    """
+    Reads the keys of the staging rows up to the consumed watermark of their table that the core load could not
+    consume yet, because the row they join was not staged, see STAGING_JOIN_DEPENDENCIES.
+    """
+    try:
+        with open(os.path.join(ETL_LOAD_FOLDER, 'pending_staging_rows.json'), 'r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def find_pending_staging_rows(ETL_LOAD_FOLDER, staging_tables, logger, watermarks=None):
+    """
+    Lists the rows of the staging tables in STAGING_JOIN_DEPENDENCIES that the core load just read, i.e. past
+    their consumed watermark or pending before, but could not consume: their parent is past the extraction
+    watermark of its table, so it has not been staged yet. Rows whose parent was staged and purged before can never
+    be joined again and are only logged.
+
+    Args:
+        ETL_LOAD_FOLDER (str): The path to the ETL load folder.
+        staging_tables (set): The staging tables the core load consumed.
+        logger (Logger): The logger object for logging.
+        watermarks (dict, optional): The extraction watermarks the core load read up to, defaults to the current
+            ones.
+
+    Returns:
+        dict: The pending keys per staging table, for record_consumed_watermarks.
+    """
+    consumed = read_consumed_watermarks(ETL_LOAD_FOLDER)
+    previous = read_pending_staging_rows(ETL_LOAD_FOLDER)
+    watermarks = watermarks or {table: read_staging_watermark(ETL_LOAD_FOLDER, table) for table in STAGING_WATERMARKS}
+    pending = {}
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            for staging_table, (column, parent_table) in STAGING_JOIN_DEPENDENCIES.items():
+                if staging_table not in staging_tables:
+                    continue
+                _, _, key_column = STAGING_WATERMARKS[staging_table]
+                _, _, parent_key = STAGING_WATERMARKS[parent_table]
+                cursor.execute(sql.SQL("""
+                    SELECT t.{key}, t.{column} > %(parent_watermark)s
+                    FROM {table} t
+                    WHERE (t.{key} > %(watermark)s OR t.{key} = ANY(%(pending)s::bigint[]))
+                      AND t.{key} <= %(new_watermark)s
+                      AND NOT EXISTS (SELECT 1 FROM {parent} p WHERE p.{parent_key} = t.{column})
+                    ORDER BY t.{key}
+                """).format(key=sql.Identifier(key_column), column=sql.Identifier(column),
+                            table=sql.Identifier(*staging_table.split('.')),
+                            parent=sql.Identifier(*parent_table.split('.')), parent_key=sql.Identifier(parent_key)),
+                    {"parent_watermark": watermarks[parent_table], "watermark": consumed.get(staging_table, 0),
+                     "pending": previous.get(staging_table, []), "new_watermark": watermarks[staging_table]})
+                rows = cursor.fetchall()
+                pending[staging_table] = [key for key, waiting in rows if waiting]
+                if pending[staging_table]:
+                    logger.info(f"{len(pending[staging_table])} rows of {staging_table} wait for their "
+                                f"{parent_table} row.")
+                orphans = [key for key, waiting in rows if not waiting]
+                if orphans:
+                    logger.warning(f"{len(orphans)} rows of {staging_table} reference {parent_table} rows that are "
+                                   f"no longer staged and are skipped, e.g. {orphans[:10]}.")
+        warehouse_conn.rollback()
+        return pending
+    finally:
+        close_connection(warehouse_conn)
+
+
+def record_consumed_watermarks(ETL_LOAD_FOLDER, staging_tables, pending=None, watermarks=None):
+    """
+    Records the extraction watermarks of staging tables whose rows the core load has consumed, the ones it read up
+    to or else the current ones. Rows up to these watermarks no longer need to be in staging, except the pending
+    ones, see find_pending_staging_rows.
+    """
+    consumed = read_consumed_watermarks(ETL_LOAD_FOLDER)
+    for staging_table in staging_tables:
+        consumed[staging_table] = (watermarks[staging_table] if watermarks
+                                   else read_staging_watermark(ETL_LOAD_FOLDER, staging_table))
+    with open(os.path.join(ETL_LOAD_FOLDER, 'consumed_watermarks.json'), 'w') as file:
+        json.dump(consumed, file)
+    if pending is not None:
+        with open(os.path.join(ETL_LOAD_FOLDER, 'pending_staging_rows.json'), 'w') as file:
+            json.dump({**read_pending_staging_rows(ETL_LOAD_FOLDER), **pending}, file)
+
+
+def prepare_staging_tables(ETL_LOAD_FOLDER, logger, options=None):
+    """
+    Puts the staging tables in the LOGGED or UNLOGGED mode requested by options.fast_staging, and recovers from a
+    crash that emptied unlogged staging tables: their extraction watermarks are moved back so that the lost rows
+    the next core loads still read are extracted again.
+
+    - FULL_RELOAD_STAGING_TABLES are joined in full by the core loaders, so they are extracted again from the start.
+    - Other tables go back to the last core load that consumed them, or before their first pending row.
+    - The parent tables of STAGING_JOIN_DEPENDENCIES go back further, before the oldest parent row referenced by a
+      production row of the dependent table the core load has not consumed, so the join finds it again.
+
+    Returns:
+        list: The staging tables whose watermark was reset.
+    """
+    options = options or LoadOptions()
+    warehouse_conn = connect_warehouse()
+    try:
+        truncated = {f"staging.{table_name}" for table_name in crash_truncated_staging_tables(warehouse_conn)}
+        consumed = read_consumed_watermarks(ETL_LOAD_FOLDER)
+        pending = read_pending_staging_rows(ETL_LOAD_FOLDER)
+        watermarks = {}
+        for staging_table in truncated:
+            watermark = 0 if staging_table in FULL_RELOAD_STAGING_TABLES else consumed.get(staging_table, 0)
+            if pending.get(staging_table):
+                # the pending rows were lost too
+                watermark = min(watermark, min(pending[staging_table]) - 1)
+            watermarks[staging_table] = watermark
+
+        parents = {table: dependency for table, dependency in STAGING_JOIN_DEPENDENCIES.items()
+                   if dependency[1] in truncated}
+        if parents:
+            production_conn = connect_production()
+            try:
+                with production_conn.cursor() as cursor:
+                    for staging_table, (column, parent_table) in parents.items():
+                        _, _, key_column = STAGING_WATERMARKS[staging_table]
+                        cursor.execute(sql.SQL("""
+                            SELECT min({column}) FROM {table} WHERE {key} > %s OR {key} = ANY(%s::bigint[])
+                        """).format(column=sql.Identifier(column), key=sql.Identifier(key_column),
+                                    table=sql.Identifier("public", staging_table.split('.')[1])),
+                            (consumed.get(staging_table, 0), pending.get(staging_table, [])))
+                        oldest = cursor.fetchone()[0]
+                        if oldest is not None:
+                            watermarks[parent_table] = min(watermarks[parent_table], oldest - 1)
+                production_conn.rollback()
+            finally:
+                close_connection(production_conn)
+
+        reset = []
+        for staging_table, watermark in sorted(watermarks.items()):
+            if read_staging_watermark(ETL_LOAD_FOLDER, staging_table) != watermark:
+                write_staging_watermark(ETL_LOAD_FOLDER, staging_table, watermark)
+                reset.append(staging_table)
+                logger.warning(f"{staging_table} was truncated by crash recovery, re-extracting after {watermark}.")
+        warehouse_conn.commit()
+        set_staging_persistence(warehouse_conn, logger, options.fast_staging)
+        return reset
+    finally:
+        close_connection(warehouse_conn)
+
+
+# Session of each stage holding its advisory lock while a run of the stage is in progress: stage -> (run_id, conn)
+_stage_locks = {}
+
+
+def begin_pipeline_run(ETL_LOAD_FOLDER, stage, logger):
+    """
+    Registers a run of a pipeline stage in etl.pipeline_runs. If the last run of the stage did not succeed, it is
+    retried under the same run id instead, so the caller can replace exactly the rows that attempt left behind.
+
+    The run holds an advisory lock on its stage until finish_pipeline_run, on a session of its own, so a single
+    run of a stage is in progress at a time. The lock goes with the session of a process that dies, so a last run
+    still marked 'running' once the lock is taken has crashed and is retried like a failed one. When another
+    process holds the lock the run is refused.
+
+    A new staging run records the extraction watermarks it starts from; a retried one returns them so they can be
+    restored.
+
+    Returns:
+        tuple: (run_id, watermarks), watermarks is None for a new run and the recorded watermarks for a retry.
+        (None, None) when a run of the stage is in progress in another process.
+    """
+    # a run of this process that raised before finishing is no longer in progress
+    release_pipeline_run_lock(stage)
+    lock_conn = psycopg2.connect(**WAREHOUSE_DSN)
+    lock_conn.autocommit = True
+    with lock_conn.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (f"etl.pipeline_runs.{stage}",))
+        locked = cursor.fetchone()[0]
+    if not locked:
+        lock_conn.close()
+        logger.error(f"A {stage} run is in progress in another process, not starting another one.")
+        return None, None
+
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT run_id, status, watermarks
+                FROM etl.pipeline_runs
+                WHERE stage = %s
+                ORDER BY run_id DESC
+                LIMIT 1
+                FOR UPDATE
+            """, (stage,))
+            last_run = cursor.fetchone()
+            if last_run is not None and last_run[1] != 'succeeded':
+                run_id, _, watermarks = last_run
+                cursor.execute("""
+                    UPDATE etl.pipeline_runs
+                    SET status = 'running', attempts = attempts + 1, started_at = now(), finished_at = NULL,
+                        error = NULL
+                    WHERE run_id = %s
+                """, (run_id,))
+                logger.warning(f"Retrying {stage} run {run_id}, which did not succeed.")
+                warehouse_conn.commit()
+                _stage_locks[stage] = (run_id, lock_conn)
+                return run_id, watermarks or {}
+
+            watermarks = {}
+            if stage == 'staging':
+                watermarks = {table: read_staging_watermark(ETL_LOAD_FOLDER, table) for table in STAGING_WATERMARKS}
+            cursor.execute("""
+                INSERT INTO etl.pipeline_runs (stage, status, watermarks)
+                VALUES (%s, 'running', %s)
+                RETURNING run_id
+            """, (stage, json.dumps(watermarks)))
+            run_id = cursor.fetchone()[0]
+        warehouse_conn.commit()
+        _stage_locks[stage] = (run_id, lock_conn)
+        logger.info(f"Started {stage} run {run_id}.")
+        return run_id, None
+    except Exception:
+        lock_conn.close()
+        raise
+    finally:
+        close_connection(warehouse_conn)
+
+
+def release_pipeline_run_lock(stage=None, run_id=None):
+    """
+    Ends the session holding the advisory lock of a stage, or of the stage run_id belongs to, see
+    begin_pipeline_run.
+    """
+    for locked_stage, (locked_run_id, lock_conn) in list(_stage_locks.items()):
+        if locked_stage == stage or locked_run_id == run_id:
+            del _stage_locks[locked_stage]
+            lock_conn.close()
+
+
+def record_run_warning(run_id, message, logger):
+    """
+    Appends a problem that did not fail the run, e.g. a foreign key left NOT VALID, to the error of its
+    etl.pipeline_runs row, where the status command shows it.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE etl.pipeline_runs
+                SET error = concat_ws('; ', error, %s)
+                WHERE run_id = %s
+            """, (message, run_id))
+        warehouse_conn.commit()
+        logger.warning(f"Run {run_id}: {message}")
+    finally:
+        close_connection(warehouse_conn)
+
+
+def finish_pipeline_run(run_id, succeeded, logger, error=None):
+    """
+    Records the outcome of a run registered by begin_pipeline_run. Warnings recorded on the run are kept, after
+    the error of a failed run.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute("""
+                UPDATE etl.pipeline_runs
+                SET status = %s, finished_at = now(), error = NULLIF(concat_ws('; ', %s, error), '')
+                WHERE run_id = %s
+                RETURNING error
+            """, ('succeeded' if succeeded else 'failed', error, run_id))
+            row = cursor.fetchone()
+        warehouse_conn.commit()
+        release_pipeline_run_lock(run_id=run_id)
+        if not succeeded:
+            logger.error(f"Run {run_id} failed: {error}")
+        elif row and row[0]:
+            logger.warning(f"Run {run_id} succeeded with warnings: {row[0]}")
+        else:
+            logger.info(f"Run {run_id} succeeded.")
+    finally:
+        close_connection(warehouse_conn)
+
+
+def discard_staging_batch(run_id, logger):
+    """
+    Deletes the staging rows extracted by a failed staging run before it is retried.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            for staging_table in STAGING_LOADERS:
+                cursor.execute(sql.SQL("DELETE FROM {} WHERE etl_batch_id = %s").format(
+                    sql.Identifier(*staging_table.split('.'))), (run_id,))
+                if cursor.rowcount:
+                    logger.info(f"Removed {cursor.rowcount} rows of batch {run_id} from {staging_table}.")
+        warehouse_conn.commit()
+    finally:
+        close_connection(warehouse_conn)
+
+
+def read_dirty_staging_tables(ETL_LOAD_FOLDER):
+    """
+    Reads the staging tables that received rows since the core phase last consumed them.
+
+    Returns:
+        set: The dirty staging tables, None if they were never recorded and every table must be assumed dirty.
+    """
+    try:
+        with open(os.path.join(ETL_LOAD_FOLDER, 'dirty_staging_tables.json'), 'r') as file:
+            data = json.load(file)
+            return set(data.get('dirty_staging_tables', []))
+    except FileNotFoundError:
+        return None
+
+
+def write_dirty_staging_tables(ETL_LOAD_FOLDER, dirty_tables):
+    data = {'dirty_staging_tables': sorted(dirty_tables)}
+    with open(os.path.join(ETL_LOAD_FOLDER, 'dirty_staging_tables.json'), 'w') as file:
+        json.dump(data, file)
+
+
+def perform_delta_load_staging(ETL_LOAD_FOLDER, logger, options=None, tables=None, changed_rows=None):
+    """
+    Runs every staging loader and adds the staging tables that received rows to the dirty tables recorded in
+    ETL_LOAD_FOLDER, which the core phase uses to skip loaders whose inputs did not change. A failed loader
+    marks its table dirty as well, since it may have been partially loaded.
+
+    The run is registered in etl.pipeline_runs and its rows are tagged with the run id. Retrying a failed run
+    deletes the rows it staged and restores the watermarks it started from, so every row is staged exactly once.
+    With options.workers above 1 the tables are loaded concurrently.
+
+    Args:
+        ETL_LOAD_FOLDER (str): The path to the ETL load folder.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+        tables (list, optional): The staging tables to load, e.g. ['staging.orders']. Defaults to all of them.
+        changed_rows (dict, optional): Filled with the rows loaded per staging table.
+
+    Returns:
+        bool: True if every staging loader succeeded.
+    """
+    options = options or LoadOptions()
+    run_id, retry_watermarks = begin_pipeline_run(ETL_LOAD_FOLDER, 'staging', logger)
+    if run_id is None:
+        return False
+    if retry_watermarks is not None:
+        discard_staging_batch(run_id, logger)
+        for staging_table, watermark in retry_watermarks.items():
+            write_staging_watermark(ETL_LOAD_FOLDER, staging_table, watermark)
+    options = replace(options, run_id=run_id)
+
+    dirty_tables = read_dirty_staging_tables(ETL_LOAD_FOLDER) or set()
+    if options.prepare_staging:
+        prepare_staging_tables(ETL_LOAD_FOLDER, logger, options)
+    selected = [table for table in STAGING_LOADERS if tables is None or table in tables]
+    if options.workers > 1:
+        pools_opened = open_connection_pools(options.workers)
+        try:
+            with ThreadPoolExecutor(max_workers=options.workers) as pool:
+                futures = {table: pool.submit(STAGING_LOADERS[table], ETL_LOAD_FOLDER, logger, options)
+                           for table in selected}
+                results = {table: future.result() for table, future in futures.items()}
+        finally:
+            if pools_opened:
+                close_connection_pools()
+    else:
+        results = {table: STAGING_LOADERS[table](ETL_LOAD_FOLDER, logger, options) for table in selected}
+
+    changed_rows = {} if changed_rows is None else changed_rows
+    failed = []
+    for staging_table, inserted in results.items():
+        changed_rows[staging_table] = inserted
+        if inserted is None:
+            failed.append(staging_table)
+        if inserted is None or inserted > 0:
+            dirty_tables.add(staging_table)
+    write_dirty_staging_tables(ETL_LOAD_FOLDER, dirty_tables)
+    # the core joins read these tables next
+    perform_table_maintenance(changed_rows, logger, options)
+    logger.info(f"Staging tables changed since the last core load: {', '.join(sorted(dirty_tables)) or 'none'}")
+
+    finish_pipeline_run(run_id, not failed, logger, f"failed loading {', '.join(failed)}" if failed else None)
+    return not failed
 
 
 #####################################################################################################
-def delta_core_load_time_dimension(logger):
+@timed_stage("core", "time_dimension")
+def delta_core_load_time_dimension(logger, options=None):
     """
     Creates time dimension records from the orders in staging table.
 
     Args:
-        conn (connection): Connection to the warehouse database.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of rows inserted, None if the load failed.
     """
-    conn = psycopg2.connect(
-        database="warehouse",
-        user="postgres",
-        password="swati",
-        host="localhost",
-        port="5432"
-    )
+    options = options or LoadOptions()
+    conn = connect_warehouse("core_join")
     try:
-        with conn.cursor() as cursor:
-            # Create Time Dimension Records from Orders with Hierarchy-based time_id
-            query = sql.SQL("""
-                INSERT INTO core.time_dimension (timeid, date, day, month, year, day_name, is_weekend, month_name, quarter, hour, minutes, seconds)
-                SELECT DISTINCT 
-                    EXTRACT(EPOCH FROM order_timestamp)::BIGINT AS timeid,
-                    date_trunc('day', order_timestamp) AS date,
-                    EXTRACT(day FROM order_timestamp) AS day,
-                    EXTRACT(month FROM order_timestamp) AS month,
-                    EXTRACT(year FROM order_timestamp) AS year,
-                    TO_CHAR(order_timestamp, 'Day') AS day_name,
-                    CASE WHEN EXTRACT(ISODOW FROM order_timestamp) IN (6,7) THEN 1 ELSE 0 END AS is_weekend,
-                    TO_CHAR(order_timestamp, 'Month') AS month_name,
-                    EXTRACT(quarter FROM order_timestamp) AS quarter,
-                    EXTRACT(hour FROM order_timestamp) AS hour,
-                    EXTRACT(minute FROM order_timestamp) AS minutes,
-                    EXTRACT(second FROM order_timestamp) AS seconds
-                FROM staging.orders;
-            """)
-            cursor.execute(query)
+        # Create Time Dimension Records from Orders with Hierarchy-based time_id
+        query = sql.SQL("""
+            SELECT DISTINCT 
+                EXTRACT(EPOCH FROM order_timestamp)::BIGINT AS timeid,
+                date_trunc('day', order_timestamp) AS date,
+                EXTRACT(day FROM order_timestamp) AS day,
+                EXTRACT(month FROM order_timestamp) AS month,
+                EXTRACT(year FROM order_timestamp) AS year,
+                TO_CHAR(order_timestamp, 'Day') AS day_name,
+                CASE WHEN EXTRACT(ISODOW FROM order_timestamp) IN (6,7) THEN 1 ELSE 0 END AS is_weekend,
+                TO_CHAR(order_timestamp, 'Month') AS month_name,
+                EXTRACT(quarter FROM order_timestamp) AS quarter,
+                EXTRACT(hour FROM order_timestamp) AS hour,
+                EXTRACT(minute FROM order_timestamp) AS minutes,
+                EXTRACT(second FROM order_timestamp) AS seconds
+            FROM staging.orders
+            WHERE {row_filter}
+        """)
+        # timeid is not unique, so the instants already in the dimension are left out explicitly
+        new_instants = sql.SQL("""
+            NOT EXISTS (SELECT 1 FROM {} t WHERE t.timeid = EXTRACT(EPOCH FROM order_timestamp)::BIGINT)
+        """).format(sql.Identifier(options.core_schema, "time_dimension"))
+        inserted = execute_core_insert(
+            conn, f"{options.core_schema}.time_dimension",
+            ("timeid", "date", "day", "month", "year", "day_name", "is_weekend", "month_name", "quarter", "hour",
+             "minutes", "seconds"),
+            query, "staging.orders", "order_id_surrogate", logger, options,
+            extra_filter=and_filters(core_delta_filter(options, "staging.orders"), new_instants))
 
         # Commit the changes
         conn.commit()
         logger.info("Time Dimension records created successfully")
+        return inserted
 
     except Exception as e:
         logger.error(f"Error connecting to the data warehouse: {e}")
 
     finally:
         # Close the connection
-        conn.close()
+        close_connection(conn)
 
 
-def delta_core_load_customer_dimension(logger):
+@timed_stage("core", "customer_dimension")
+def delta_core_load_customer_dimension(logger, options=None):
     """
     Fill the customer_dimension table in the warehouse database with customer information.
 
     Args:
-        warehouse_conn: Connection object for the warehouse database.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-        None
+        int: The number of rows inserted, None if the load failed.
     """
-    warehouse_conn = psycopg2.connect(
-        database="warehouse",
-        user="postgres",
-        password="swati",
-        host="localhost",
-        port="5432"
-    )
+    options = options or LoadOptions()
+    warehouse_conn = connect_warehouse("core_join")
     try:
-        with warehouse_conn.cursor() as cursor:
-
-            # Insert records into core.customer_dimension by combining information from customer and location
-            query = sql.SQL("""
-                INSERT INTO core.customer_dimension (customer_id, first_name, last_name, email, country, state, city, latitude, longitude)
-                SELECT
-                    c.customer_id,
-                    c.first_name,
-                    c.last_name,
-                    c.email,
-                    l.country,
-                    l.state,
-                    l.city,
-                    l.latitude,
-                    l.longitude
-                FROM staging.customer c
-                JOIN staging.location l ON c.location_id = l.location_id;
-            """)
-            cursor.execute(query)
+        # Insert records into core.customer_dimension by combining information from customer and location
+        query = sql.SQL("""
+            SELECT
+                c.customer_id,
+                c.first_name,
+                c.last_name,
+                c.email,
+                l.country,
+                l.state,
+                l.city,
+                l.latitude,
+                l.longitude
+            FROM staging.customer c
+            JOIN staging.location l ON c.location_id = l.location_id
+            WHERE {row_filter}
+        """)
+        inserted = execute_core_insert(
+            warehouse_conn, f"{options.core_schema}.customer_dimension",
+            ("customer_id", "first_name", "last_name", "email", "country", "state", "city", "latitude", "longitude"),
+            query, "staging.customer", "customer_id", logger, options, source_alias="c",
+            extra_filter=core_delta_filter(options, "staging.customer", "c"))
 
         # Commit the changes
         warehouse_conn.commit()
 
         logger.info("Customer Dimension records filled successfully.")
+        return inserted
 
     except Exception as e:
         logger.error(f"Error connecting to the data warehouse: {e}")
 
     finally:
         # Close the connection
-        warehouse_conn.close()
+        close_connection(warehouse_conn)
 
 
-def delta_core_load_product_dimension(logger):
+@timed_stage("core", "product_dimension")
+def delta_core_load_product_dimension(logger, options=None):
     """
     Load product dimension data from staging tables into the core.product_dimension table.
 
+    The category and subcategory names are denormalised into the product rows. Staged categories and
+    subcategories are first merged into core.subcategory_lookup; a rename there is propagated only to the products
+    of the affected subcategories, found through the subcategory_id index of product_dimension.
+
     Parameters:
     - logger: The logger object used for logging.
+    - options (LoadOptions, optional): Loader options, defaults to LoadOptions().
 
     Returns:
-    None
-    """
-    warehouse_conn = psycopg2.connect(
-        database="warehouse",
-        user="postgres",
-        password="swati",
-        host="localhost",
-        port="5432"
-    )
+    int: The number of rows inserted, None if the load failed.
+    """
+    options = options or LoadOptions()
+    lookup = sql.Identifier(options.core_schema, "subcategory_lookup")
+    warehouse_conn = connect_warehouse("core_join")
 
     try:
         with warehouse_conn.cursor() as cursor:
-            # Insert records into core.product_dimension by combining information from product, category,
-            # and subcategory
-            query = sql.SQL("""
-                INSERT INTO core.product_dimension (product_id, name, price, description, category, sub_category)
-                SELECT
-                    p.product_id,
-                    p.name,
-                    p.price,
-                    p.description,
-                    c.category_name,
-                    s.subcategory_name
-                FROM staging.product p
-                JOIN staging.subcategory s ON p.subcategory_id = s.subcategory_id
-                JOIN staging.category c ON s.category_id = c.category_id;
-            """)
-            cursor.execute(query)
+            if options.run_id is not None:
+                # the lookup as it was, for rollback_core_run
+                cursor.execute(sql.SQL("""
+                    INSERT INTO etl.core_run_undo (run_id, table_name, previous)
+                    SELECT %s, %s, COALESCE(jsonb_agg(to_jsonb(l)), '[]') FROM {lookup} l
+                """).format(lookup=lookup), (options.run_id, f"{options.core_schema}.subcategory_lookup"))
+
+            # Merge the staged subcategories, taking the category name from staging or from the known mapping
+            cursor.execute(sql.SQL("""
+                INSERT INTO {lookup} AS l (subcategory_id, category_id, subcategory_name, category_name)
+                SELECT DISTINCT ON (s.subcategory_id)
+                    s.subcategory_id,
+                    s.category_id,
+                    s.subcategory_name,
+                    COALESCE(c.category_name, known.category_name)
+                FROM staging.subcategory s
+                LEFT JOIN staging.category c ON c.category_id = s.category_id
+                LEFT JOIN LATERAL (
+                    SELECT k.category_name FROM {lookup} k WHERE k.category_id = s.category_id LIMIT 1
+                ) known ON TRUE
+                WHERE COALESCE(c.category_name, known.category_name) IS NOT NULL
+                ORDER BY s.subcategory_id
+                ON CONFLICT (subcategory_id) DO UPDATE SET
+                    category_id = EXCLUDED.category_id,
+                    subcategory_name = EXCLUDED.subcategory_name,
+                    category_name = EXCLUDED.category_name
+                WHERE (l.category_id, l.subcategory_name, l.category_name)
+                    IS DISTINCT FROM (EXCLUDED.category_id, EXCLUDED.subcategory_name, EXCLUDED.category_name)
+                RETURNING l.subcategory_id
+            """).format(lookup=lookup))
+            changed_subcategories = {row[0] for row in cursor.fetchall()}
+
+            # Category renames reach every subcategory of the category
+            cursor.execute(sql.SQL("""
+                UPDATE {lookup} l
+                SET category_name = c.category_name
+                FROM staging.category c
+                WHERE l.category_id = c.category_id
+                  AND l.category_name IS DISTINCT FROM c.category_name
+                RETURNING l.subcategory_id
+            """).format(lookup=lookup))
+            changed_subcategories.update(row[0] for row in cursor.fetchall())
+
+            updated = 0
+            if changed_subcategories:
+                # The self join returns the names before the update, kept for rollback_core_run
+                cursor.execute(sql.SQL("""
+                    WITH renamed AS (
+                        UPDATE {product} p
+                        SET category = l.category_name, sub_category = l.subcategory_name
+                        FROM {lookup} l, {product} old
+                        WHERE p.subcategory_id = l.subcategory_id
+                          AND old.product_id = p.product_id
+                          AND l.subcategory_id = ANY(%s)
+                          AND (p.category, p.sub_category) IS DISTINCT FROM (l.category_name, l.subcategory_name)
+                        RETURNING old.product_id, old.category, old.sub_category,
+                            p.category AS new_category, p.sub_category AS new_sub_category
+                    ), undo AS (
+                        INSERT INTO etl.core_run_undo (run_id, table_name, previous)
+                        SELECT %s, %s, jsonb_agg(to_jsonb(renamed)) FROM renamed
+                        HAVING count(*) > 0 AND %s IS NOT NULL
+                    )
+                    SELECT category, sub_category, new_category, new_sub_category, count(*)
+                    FROM renamed
+                    GROUP BY 1, 2, 3, 4
+                """).format(product=sql.Identifier(options.core_schema, "product_dimension"), lookup=lookup),
+                    (sorted(changed_subcategories), options.run_id, f"{options.core_schema}.product_dimension",
+                     options.run_id))
+                moves = cursor.fetchall()
+                updated = sum(row[4] for row in moves)
+                if moves:
+                    # the sales of the renamed products move to their new category rows
+                    refold_category_sales(warehouse_conn, {(row[0], row[1]) for row in moves}
+                                          | {(row[2], row[3]) for row in moves}, options.core_schema)
+
+        # Insert the new products with the names of their subcategory and category
+        query = sql.SQL("""
+            SELECT
+                p.product_id,
+                p.name,
+                p.price,
+                p.description,
+                s.category_name,
+                s.subcategory_name,
+                p.subcategory_id
+            FROM staging.product p
+            JOIN {lookup} s ON p.subcategory_id = s.subcategory_id
+            WHERE {row_filter}
+        """)
+        inserted = execute_core_insert(
+            warehouse_conn, f"{options.core_schema}.product_dimension",
+            ("product_id", "name", "price", "description", "category", "sub_category", "subcategory_id"),
+            query, "staging.product", "product_id", logger, options, source_alias="p",
+            extra_filter=core_delta_filter(options, "staging.product", "p"), query_arguments={"lookup": lookup})
 
         # Commit the changes
         warehouse_conn.commit()
-        logger.info("Product Dimension records filled successfully.")
+        logger.info(f"Product Dimension records filled successfully, {updated} products updated for "
+                    f"{len(changed_subcategories)} changed subcategories.")
+        return inserted
 
     except Exception as e:
         logger.error("Product Dimension not created", e)
 
     finally:
         # Close the connection
-        warehouse_conn.close()
+        close_connection(warehouse_conn)
 
 
-def delta_core_load_campaign_dimension(logger):
-    warehouse_conn = psycopg2.connect(
-        database="warehouse",
-        user="postgres",
-        password="swati",
-        host="localhost",
-        port="5432"
-    )
+# campaign_dimension member of the sales made outside any campaign
+NO_CAMPAIGN_ID = 0
+
+
+@timed_stage("core", "campaign_dimension")
+def delta_core_load_campaign_dimension(logger, options=None):
+    options = options or LoadOptions()
+    warehouse_conn = connect_warehouse("core_join")
 
     try:
-        with warehouse_conn.cursor() as cursor:
-            # Insert records into core.campaign_dimension with mapped start_date and end_date
-            query = sql.SQL("""
-                INSERT INTO core.campaign_dimension (campaign_id, campaign_name, start_date, end_date)
+        # Insert records into core.campaign_dimension with mapped start_date and end_date
+        query = sql.SQL("""
+            SELECT
+                campaign_id,
+                campaign_name,
+                start_date,
+                end_date
+            FROM (
                 SELECT
                     campaign_id,
                     campaign_name,
-                    start_date,
-                    end_date
-                FROM (
-                    SELECT
-                        campaign_id,
-                        campaign_name,
-                        (DATE '2022-01-01' + (offer_week - 1) * 7) AS start_date,
-                        (DATE '2022-01-01' + (offer_week) * 7 - 1) AS end_date
-                    FROM staging.marketing_campaigns
-                ) AS mapped_campaigns;
-            """)
-            cursor.execute(query)
+                    (DATE '2022-01-01' + (offer_week - 1) * 7) AS start_date,
+                    (DATE '2022-01-01' + (offer_week) * 7 - 1) AS end_date
+                FROM staging.marketing_campaigns
+                WHERE {row_filter}
+            ) AS mapped_campaigns
+        """)
+        inserted = execute_core_insert(
+            warehouse_conn, f"{options.core_schema}.campaign_dimension",
+            ("campaign_id", "campaign_name", "start_date", "end_date"),
+            query, "staging.marketing_campaigns", "campaign_id", logger, options,
+            extra_filter=core_delta_filter(options, "staging.marketing_campaigns"))
+
+        # The sales of orders outside any campaign reference the "No campaign" member, see delta_core_load_sales_fact.
+        # Production has no such campaign, and its id is below every extraction watermark, so it is added here. It
+        # belongs to no run, so rolling a run back keeps it.
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute(sql.SQL("""
+                INSERT INTO {} (campaign_id, campaign_name, start_date, end_date)
+                VALUES (%s, 'No campaign', '-infinity', 'infinity')
+                ON CONFLICT DO NOTHING
+            """).format(sql.Identifier(options.core_schema, "campaign_dimension")), (NO_CAMPAIGN_ID,))
+            inserted += cursor.rowcount
 
         # Commit the changes
         warehouse_conn.commit()
         logger.info("Campaign Dimension records filled successfully.")
+        return inserted
 
     except Exception as e:
         logger.error("Campaign Dimension, not created", e)
 
     finally:
         # Close the connection
-        warehouse_conn.close()
+        close_connection(warehouse_conn)
 
 
-def delta_core_load_order_dimension(logger):
-    warehouse_conn = psycopg2.connect(
-        database="warehouse",
-        user="postgres",
-        password="swati",
-        host="localhost",
-        port="5432"
-    )
+@timed_stage("core", "order_dimension")
+def delta_core_load_order_dimension(logger, options=None):
+    options = options or LoadOptions()
+    warehouse_conn = connect_warehouse("core_join")
 
     try:
-        with warehouse_conn.cursor() as cursor:
-            # Insert records into core.order_dimension by combining information from orders, payment_method,
-            # and customers
-            query = sql.SQL("""
-                INSERT INTO core.order_dimension (order_id, customer_id, payment_method)
-                SELECT
-                    o.order_id,
-                    o.customer_id,
-                    pm.payment_method
-                FROM staging.orders o
-                JOIN staging.payment_method pm ON o.payment_method_id = pm.payment_method_id
-            """)
-            cursor.execute(query)
+        # Insert records into core.order_dimension by combining information from orders, payment_method,
+        # and customers
+        query = sql.SQL("""
+            SELECT
+                o.order_id,
+                o.customer_id,
+                pm.payment_method
+            FROM staging.orders o
+            JOIN staging.payment_method pm ON o.payment_method_id = pm.payment_method_id
+            WHERE {row_filter}
+        """)
+        inserted = execute_core_insert(
+            warehouse_conn, f"{options.core_schema}.order_dimension",
+            ("order_id", "customer_id", "payment_method"),
+            query, "staging.orders", "order_id", logger, options, source_alias="o",
+            extra_filter=core_delta_filter(options, "staging.orders", "o"))
 
         # Commit the changes
         warehouse_conn.commit()
         logger.info("Order Dimension records filled successfully.")
+        return inserted
 
     except Exception as e:
         logger.error("Order Dimension, not created", e)
 
     finally:
         # Close the connection
-        warehouse_conn.close()
+        close_connection(warehouse_conn)
 
 
-def delta_core_load_supplier_dimension(logger):
-    warehouse_conn = psycopg2.connect(
-        database="warehouse",
-        user="postgres",
-        password="swati",
-        host="localhost",
-        port="5432"
-    )
+@timed_stage("core", "supplier_dimension")
+def delta_core_load_supplier_dimension(logger, options=None):
+    options = options or LoadOptions()
+    warehouse_conn = connect_warehouse("core_join")
 
     try:
-        with warehouse_conn.cursor() as cursor:
-            # Insert records into core.supplier_dimension
-            query = sql.SQL("""
-                INSERT INTO core.supplier_dimension (supplier_id, supplier_name, email)
-                SELECT
-                    supplier_id,
-                    supplier_name,
-                    email
-                FROM staging.supplier;
-            """)
-            cursor.execute(query)
+        # Insert records into core.supplier_dimension
+        query = sql.SQL("""
+            SELECT
+                supplier_id,
+                supplier_name,
+                email
+            FROM staging.supplier
+            WHERE {row_filter}
+        """)
+        inserted = execute_core_insert(
+            warehouse_conn, f"{options.core_schema}.supplier_dimension",
+            ("supplier_id", "supplier_name", "email"),
+            query, "staging.supplier", "supplier_id", logger, options,
+            extra_filter=core_delta_filter(options, "staging.supplier"))
 
         # Commit the changes
         warehouse_conn.commit()
         logger.info("Supplier Dimension records filled successfully.")
+        return inserted
 
     except Exception as e:
         logger.error("Supplier Dimension, not created", e)
 
     finally:
         # Close the connection
-        warehouse_conn.close()
+        close_connection(warehouse_conn)
 
 
-def delta_core_load_sales_fact(logger):
-    warehouse_conn = psycopg2.connect(
-        database="warehouse",
-        user="postgres",
-        password="swati",
-        host="localhost",
-        port="5432"
-    )
-    try:
-        with warehouse_conn.cursor() as cursor:
+def sales_fact_delta_days(warehouse_conn, delta_filter=None):
+    """
+    Returns the first and last day of the orders of the sales facts to load, the months to route them into.
 
-            # Insert records into core.sales_fact by combining information from orderitem and orders
-            query = sql.SQL("""
-                INSERT INTO core.sales_fact (order_id, time_id, product_id, customer_id, campaign_id, supplier_id, quantity, subtotal, discount_percentage, sales_price)
-                SELECT
-                    o.order_id,
-                    EXTRACT(EPOCH FROM o.order_timestamp)::integer AS time_id,
-                    oi.product_id,
-                    o.customer_id,
-                    COALESCE(o.campaign_id, 0),  -- Replace NULL with 0 using COALESCE
-                    oi.supplier_id,
-                    oi.quantity,
-                    oi.subtotal,
-                    oi.discount,
-                    (1-oi.discount) * oi.subtotal AS sales_price
-                FROM staging.orderitem oi
-                JOIN staging.orders o ON oi.order_id = o.order_id;
-            """)
-            cursor.execute(query)
+    Args:
+        warehouse_conn (connection): Connection to the warehouse database.
+        delta_filter (sql.Composable, optional): The condition on orderitem (oi) and orders (o) restricting the
+            facts to load, see core_delta_filter.
+
+    Returns:
+        tuple: (first_day, last_day), both None when there is nothing to load.
+    """
+    with warehouse_conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            SELECT min(o.order_timestamp)::date, max(o.order_timestamp)::date
+            FROM staging.orderitem oi
+            JOIN staging.orders o ON oi.order_id = o.order_id
+            WHERE {}
+        """).format(delta_filter or sql.SQL("TRUE")))
+        return cursor.fetchone()
+
+
+@timed_stage("core", "sales_fact")
+def delta_core_load_sales_fact(logger, options=None):
+    options = options or LoadOptions()
+    warehouse_conn = connect_warehouse("core_join")
+    deferred = None
+    try:
+        if choose_fact_load_strategy(warehouse_conn, f"{options.core_schema}.sales_fact", "staging.orderitem", logger, options) == 'bulk':
+            deferred = drop_secondary_indexes_and_foreign_keys(f"{options.core_schema}.sales_fact", logger)
+
+        # Insert records into core.sales_fact by combining information from orderitem and orders
+        query = sql.SQL("""
+            SELECT
+                oi.orderitem_id,
+                o.order_id,
+                EXTRACT(EPOCH FROM o.order_timestamp)::integer AS time_id,
+                oi.product_id,
+                o.customer_id,
+                COALESCE(o.campaign_id, 0),  -- Replace NULL with NO_CAMPAIGN_ID using COALESCE
+                oi.supplier_id,
+                oi.quantity,
+                oi.subtotal,
+                oi.discount,
+                (1-oi.discount) * oi.subtotal AS sales_price
+            FROM staging.orderitem oi
+            JOIN staging.orders o ON oi.order_id = o.order_id
+            WHERE {row_filter}
+        """)
+        slice_filter = None
+        if options.fact_slice:
+            # Only the orders of this slice, see perform_parallel_core_load
+            slice_index, slice_count = options.fact_slice
+            slice_filter = sql.SQL("mod(o.order_id, {}) = {}").format(
+                sql.Literal(slice_count), sql.Literal(slice_index))
+        delta_filter = and_filters(core_delta_filter(options, "staging.orderitem", "oi"), slice_filter)
+        first_day, last_day = sales_fact_delta_days(warehouse_conn, delta_filter)
+        inserted = load_partitioned_fact(
+            warehouse_conn, "sales_fact",
+            ("orderitem_id", "order_id", "time_id", "product_id", "customer_id", "campaign_id", "supplier_id",
+             "quantity", "subtotal", "discount_percentage", "sales_price"),
+            query, "staging.orderitem", "orderitem_id", sql.Identifier("o", "order_timestamp"),
+            first_day, last_day, logger, options, source_alias="oi", extra_filter=delta_filter,
+            conflict_columns=("orderitem_id", "time_id"))
 
         # Commit the changes
         warehouse_conn.commit()
 
-        logger.info("Sales Fact records filled successfully.")
+        if options.fact_slice:
+            logger.info(f"Sales Fact records of slice {slice_index + 1}/{slice_count} filled successfully.")
+        else:
+            logger.info("Sales Fact records filled successfully.")
+        return inserted
 
     except Exception as e:
         logger.error("sales_fact, not created", e)
 
     finally:
         # Close the connection
-        warehouse_conn.close()
+        close_connection(warehouse_conn)
+        # the indexes were dropped in a transaction of their own, so they are rebuilt after a failed load as well
+        if deferred:
+            rebuild_secondary_indexes_and_foreign_keys(f"{options.core_schema}.sales_fact", *deferred, logger, options)
 
 
-def delta_core_load_returns_fact(logger):
-    warehouse_conn = psycopg2.connect(
-        database="warehouse",
-        user="postgres",
-        password="swati",
-        host="localhost",
-        port="5432"
-    )
+@timed_stage("core", "returns_fact")
+def delta_core_load_returns_fact(logger, options=None):
+    options = options or LoadOptions()
+    warehouse_conn = connect_warehouse("core_join")
+    deferred = None
     try:
+        if choose_fact_load_strategy(warehouse_conn, f"{options.core_schema}.returns_fact", "staging.returns", logger, options) == 'bulk':
+            deferred = drop_secondary_indexes_and_foreign_keys(f"{options.core_schema}.returns_fact", logger)
+
+        # Insert records into core.returns_fact
+        query = sql.SQL("""
+            SELECT
+                return_id,
+                order_id,
+                product_id,
+                return_date,
+                reason,
+                amount_refunded
+            FROM staging.returns
+            WHERE {row_filter}
+        """)
+        delta_filter = core_delta_filter(options, "staging.returns")
         with warehouse_conn.cursor() as cursor:
-            # Insert records into core.returns_fact
-            query = sql.SQL("""
-                INSERT INTO core.returns_fact (return_id, order_id, product_id, return_date, reason, amount_refunded)
-                SELECT
-                    return_id,
-                    order_id,
-                    product_id,
-                    return_date,
-                    reason,
-                    amount_refunded
-                FROM staging.returns;
-            """)
-            cursor.execute(query)
+            # Months covered by the delta, to route it into the monthly partitions
+            cursor.execute(sql.SQL("SELECT min(return_date), max(return_date) FROM staging.returns WHERE {}").format(
+                delta_filter or sql.SQL("TRUE")))
+            first_day, last_day = cursor.fetchone()
+        inserted = load_partitioned_fact(
+            warehouse_conn, "returns_fact",
+            ("return_id", "order_id", "product_id", "return_date", "reason", "amount_refunded"),
+            query, "staging.returns", "return_id", sql.Identifier("return_date"),
+            first_day, last_day, logger, options, extra_filter=delta_filter)
 
         # Commit the changes
         warehouse_conn.commit()
 
         logger.info("Returns Fact records filled successfully.")
+        return inserted
 
     except IntegrityError as integrity_error:
         logger.error("Integrity error: %s", integrity_error)
@@ -1883,36 +3744,44 @@ def delta_core_load_returns_fact(logger):
 
     finally:
         # Close the connection
-        warehouse_conn.close()
-
-def delta_core_load_customer_product_ratings_fact(logger):
-    warehouse_conn = psycopg2.connect(
-        database="warehouse",
-        user="postgres",
-        password="swati",
-        host="localhost",
-        port="5432"
-    )
+        close_connection(warehouse_conn)
+        if deferred:
+            rebuild_secondary_indexes_and_foreign_keys(f"{options.core_schema}.returns_fact", *deferred, logger, options)
+
+@timed_stage("core", "customer_product_ratings_fact")
+def delta_core_load_customer_product_ratings_fact(logger, options=None):
+    options = options or LoadOptions()
+    warehouse_conn = connect_warehouse("core_join")
+    deferred = None
     try:
-        with warehouse_conn.cursor() as cursor:
-            # Insert records into core.customer_product_fact
-            query = sql.SQL("""
-                INSERT INTO core.customer_product_ratings_fact (customerproductrating_id, customer_id, product_id, ratings, review, sentiment)
-                SELECT
-                    customerproductrating_id,
-                    customer_id,
-                    product_id,
-                    ratings,
-                    review,
-                    sentiment
-                FROM staging.customer_product_ratings;
-            """)
-            cursor.execute(query)
+        if choose_fact_load_strategy(warehouse_conn, f"{options.core_schema}.customer_product_ratings_fact",
+                                     "staging.customer_product_ratings", logger, options) == 'bulk':
+            deferred = drop_secondary_indexes_and_foreign_keys(
+                f"{options.core_schema}.customer_product_ratings_fact", logger)
+
+        # Insert records into core.customer_product_fact
+        query = sql.SQL("""
+            SELECT
+                customerproductrating_id,
+                customer_id,
+                product_id,
+                ratings,
+                review,
+                sentiment
+            FROM staging.customer_product_ratings
+            WHERE {row_filter}
+        """)
+        inserted = execute_core_insert(
+            warehouse_conn, f"{options.core_schema}.customer_product_ratings_fact",
+            ("customerproductrating_id", "customer_id", "product_id", "ratings", "review", "sentiment"),
+            query, "staging.customer_product_ratings", "customerproductrating_id", logger, options,
+            extra_filter=core_delta_filter(options, "staging.customer_product_ratings"))
 
         # Commit the changes
         warehouse_conn.commit()
 
         logger.info("Customer Product Fact records filled successfully.")
+        return inserted
 
     except IntegrityError as integrity_error:
         logger.error("Integrity error: %s", integrity_error)
@@ -1922,36 +3791,1154 @@ def delta_core_load_customer_product_ratings_fact(logger):
         logger.error("Unexpected error: %s", e)
     finally:
         # Close the connection
-        warehouse_conn.close()
+        close_connection(warehouse_conn)
+        if deferred:
+            rebuild_secondary_indexes_and_foreign_keys(f"{options.core_schema}.customer_product_ratings_fact",
+                                                       *deferred, logger, options)
+
+
+# Sales summary tables maintained from core.sales_fact: table -> (group columns, group expressions, extra join)
+SALES_AGGREGATES = {
+    "agg_daily_sales": (
+        ("sales_date",), ("(TIMESTAMP 'epoch' + f.time_id * INTERVAL '1 second')::date",), ""),
+    "agg_product_sales": (("product_id",), ("f.product_id",), ""),
+    "agg_category_sales": (
+        ("category", "sub_category"),
+        ("COALESCE(p.category, 'Unknown')", "COALESCE(p.sub_category, 'Unknown')"),
+        "LEFT JOIN {schema}.product_dimension p ON p.product_id = f.product_id"),
+    "agg_campaign_sales": (("campaign_id",), ("f.campaign_id",), ""),
+    "agg_supplier_sales": (("supplier_id",), ("f.supplier_id",), ""),
+}
+
+
+def fold_sales_aggregates(warehouse_conn, from_fact_id, to_fact_id, schema="core"):
+    """
+    Adds the sales_fact rows with from_fact_id < id <= to_fact_id to every sales aggregate table of the schema,
+    within the caller's transaction.
+    """
+    with warehouse_conn.cursor() as cursor:
+        for table_name, (group_columns, group_expressions, join) in SALES_AGGREGATES.items():
+            columns = sql.SQL(', ').join(map(sql.Identifier, group_columns))
+            expressions = sql.SQL(', ').join(map(sql.SQL, group_expressions))
+            cursor.execute(sql.SQL("""
+                INSERT INTO {table} AS agg ({columns}, order_lines, quantity, subtotal, sales_amount, discount_amount)
+                SELECT
+                    {expressions},
+                    count(*),
+                    sum(f.quantity),
+                    sum(f.subtotal),
+                    sum(f.sales_price),
+                    sum(f.subtotal - f.sales_price)
+                FROM {fact} f
+                {join}
+                WHERE f.id > %s AND f.id <= %s
+                GROUP BY {expressions}
+                ON CONFLICT ({columns}) DO UPDATE SET
+                    order_lines = agg.order_lines + EXCLUDED.order_lines,
+                    quantity = agg.quantity + EXCLUDED.quantity,
+                    subtotal = agg.subtotal + EXCLUDED.subtotal,
+                    sales_amount = agg.sales_amount + EXCLUDED.sales_amount,
+                    discount_amount = agg.discount_amount + EXCLUDED.discount_amount
+            """).format(table=sql.Identifier(schema, table_name), columns=columns, expressions=expressions,
+                        fact=sql.Identifier(schema, "sales_fact"),
+                        join=sql.SQL(join).format(schema=sql.Identifier(schema))), (from_fact_id, to_fact_id))
+
+
+def refold_category_sales(warehouse_conn, groups, schema="core"):
+    """
+    Recomputes the agg_category_sales rows of the given (category, sub_category) groups from the sales_fact rows
+    already folded into the aggregates, within the caller's transaction. Used when renamed categories or
+    subcategories move products, and their sales, from one group to another.
+    """
+    group_columns, group_expressions, join = SALES_AGGREGATES["agg_category_sales"]
+    columns = sql.SQL(', ').join(map(sql.Identifier, group_columns))
+    expressions = sql.SQL(', ').join(map(sql.SQL, group_expressions))
+    categories, sub_categories = zip(*sorted(groups))
+    with warehouse_conn.cursor() as cursor:
+        # the lock orders this with perform_sales_aggregation folding in new facts
+        cursor.execute(sql.SQL("SELECT last_fact_id FROM {} WHERE aggregate_name = 'sales' FOR UPDATE").format(
+            sql.Identifier(schema, "aggregate_watermark")))
+        row = cursor.fetchone()
+        if row is None:
+            return
+        cursor.execute(sql.SQL("""
+            DELETE FROM {table}
+            WHERE ({columns}) IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+        """).format(table=sql.Identifier(schema, "agg_category_sales"), columns=columns),
+            (list(categories), list(sub_categories)))
+        cursor.execute(sql.SQL("""
+            INSERT INTO {table} ({columns}, order_lines, quantity, subtotal, sales_amount, discount_amount)
+            SELECT
+                {expressions},
+                count(*),
+                sum(f.quantity),
+                sum(f.subtotal),
+                sum(f.sales_price),
+                sum(f.subtotal - f.sales_price)
+            FROM {fact} f
+            {join}
+            WHERE f.id <= %s
+              AND f.product_id IN (
+                  SELECT product_id FROM {product}
+                  WHERE (category, sub_category) IN (SELECT * FROM unnest(%s::text[], %s::text[])))
+            GROUP BY {expressions}
+        """).format(table=sql.Identifier(schema, "agg_category_sales"), columns=columns, expressions=expressions,
+                    fact=sql.Identifier(schema, "sales_fact"), product=sql.Identifier(schema, "product_dimension"),
+                    join=sql.SQL(join).format(schema=sql.Identifier(schema))),
+            (row[0], list(categories), list(sub_categories)))
+
+
+def check_sales_aggregates(warehouse_conn, last_fact_id, logger, schema="core"):
+    """
+    Compares the totals of every sales aggregate table with sales_fact up to last_fact_id, and the rows of
+    agg_category_sales group by group, since category renames move sales between groups without changing the
+    totals.
+
+    Returns:
+        bool: True if every aggregate table matches the base fact.
+    """
+    with warehouse_conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            SELECT count(*), COALESCE(sum(quantity), 0), COALESCE(sum(sales_price), 0)
+            FROM {}
+            WHERE id <= %s
+        """).format(sql.Identifier(schema, "sales_fact")), (last_fact_id,))
+        expected = tuple(cursor.fetchone())
+        consistent = True
+        for table_name in SALES_AGGREGATES:
+            cursor.execute(sql.SQL("""
+                SELECT COALESCE(sum(order_lines), 0), COALESCE(sum(quantity), 0), COALESCE(sum(sales_amount), 0)
+                FROM {}
+            """).format(sql.Identifier(schema, table_name)))
+            actual = tuple(cursor.fetchone())
+            if actual != expected:
+                consistent = False
+                logger.error(f"{schema}.{table_name} is inconsistent with {schema}.sales_fact: "
+                             f"(order_lines, quantity, sales_amount) {actual} != {expected}")
+
+        group_columns, group_expressions, join = SALES_AGGREGATES["agg_category_sales"]
+        cursor.execute(sql.SQL("""
+            WITH stored AS (
+                SELECT {columns}, order_lines, quantity, sales_amount FROM {table}
+            ), expected AS (
+                SELECT {expressions}, count(*), sum(f.quantity), sum(f.sales_price)
+                FROM {fact} f
+                {join}
+                WHERE f.id <= %s
+                GROUP BY {expressions}
+            )
+            SELECT count(*) FROM ((TABLE stored EXCEPT TABLE expected) UNION ALL (TABLE expected EXCEPT TABLE stored)) d
+        """).format(columns=sql.SQL(', ').join(map(sql.Identifier, group_columns)),
+                    expressions=sql.SQL(', ').join(map(sql.SQL, group_expressions)),
+                    table=sql.Identifier(schema, "agg_category_sales"), fact=sql.Identifier(schema, "sales_fact"),
+                    join=sql.SQL(join).format(schema=sql.Identifier(schema))), (last_fact_id,))
+        mismatched_groups = cursor.fetchone()[0]
+        if mismatched_groups:
+            consistent = False
+            logger.error(f"{schema}.agg_category_sales has {mismatched_groups} category rows inconsistent with "
+                         f"{schema}.sales_fact.")
+    return consistent
+
+
+def perform_sales_aggregation(logger, options=None):
+    """
+    Refreshes the sales summary tables (daily, product, category/sub_category, campaign and supplier) from
+    core.sales_fact.
+
+    Only the fact rows loaded since the last refresh, tracked by their id in aggregate_watermark, are folded
+    into the summaries. The summaries are rebuilt from scratch when requested, when the fact table was reloaded
+    underneath them (its ids no longer continue from the watermark) or when the consistency check fails.
+
+    Args:
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+
+    Returns:
+        bool: True if the aggregates were refreshed, None if the refresh failed.
+    """
+    options = options or LoadOptions()
+    schema = options.core_schema
+    warehouse_conn = connect_warehouse("core_join")
+
+    def rebuild(max_fact_id):
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute(sql.SQL("TRUNCATE TABLE {}").format(
+                sql.SQL(', ').join(sql.Identifier(schema, table_name) for table_name in SALES_AGGREGATES)))
+        fold_sales_aggregates(warehouse_conn, 0, max_fact_id, schema)
+
+    try:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT last_fact_id FROM {} WHERE aggregate_name = 'sales' FOR UPDATE").format(
+                sql.Identifier(schema, "aggregate_watermark")))
+            row = cursor.fetchone()
+            last_fact_id = row[0] if row else 0
+            cursor.execute(sql.SQL("SELECT min(id), max(id) FROM {}").format(sql.Identifier(schema, "sales_fact")))
+            min_fact_id, max_fact_id = cursor.fetchone()
+        max_fact_id = max_fact_id or 0
+
+        reloaded = max_fact_id < last_fact_id or (last_fact_id > 0 and min_fact_id is not None
+                                                 and min_fact_id > last_fact_id)
+        if options.aggregate_full_rebuild or reloaded:
+            rebuild(max_fact_id)
+            mode = "rebuilt"
+        else:
+            fold_sales_aggregates(warehouse_conn, last_fact_id, max_fact_id, schema)
+            mode = f"folded in facts {last_fact_id + 1}..{max_fact_id}"
+
+        if (options.aggregate_consistency_check
+                and not check_sales_aggregates(warehouse_conn, max_fact_id, logger, schema)):
+            rebuild(max_fact_id)
+            mode = "rebuilt after a failed consistency check"
+
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute(sql.SQL("""
+                INSERT INTO {} (aggregate_name, last_fact_id, refreshed_at)
+                VALUES ('sales', %s, now())
+                ON CONFLICT (aggregate_name) DO UPDATE SET
+                    last_fact_id = EXCLUDED.last_fact_id,
+                    refreshed_at = EXCLUDED.refreshed_at
+            """).format(sql.Identifier(schema, "aggregate_watermark")), (max_fact_id,))
+
+        # Commit the changes
+        warehouse_conn.commit()
+        logger.info(f"Sales aggregates refreshed successfully, {mode}.")
+        return True
+
+    except psycopg2.Error as e:
+        warehouse_conn.rollback()
+        logger.error(f"Error refreshing sales aggregates: {e}")
+
+    finally:
+        # Close the connection
+        close_connection(warehouse_conn)
+
+
+# Core loaders in dependency order: dimensions before the facts referencing them
+CORE_LOADERS = [
+    delta_core_load_time_dimension,
+    delta_core_load_customer_dimension,
+    delta_core_load_product_dimension,
+    delta_core_load_campaign_dimension,
+    delta_core_load_order_dimension,
+    delta_core_load_supplier_dimension,
+    delta_core_load_sales_fact,
+    delta_core_load_returns_fact,
+    delta_core_load_customer_product_ratings_fact,
+]
+
+def rollback_core_run(run_id, logger, schema="core"):
+    """
+    Deletes the rows a core load tagged with run_id, facts before the dimensions they reference, and restores the
+    rows it updated in place from etl.core_run_undo, newest change first, in one transaction. Restoring the
+    categories of products moves their sales back between agg_category_sales groups, so the groups involved are
+    refolded in the same transaction, see refold_category_sales.
+
+    Returns:
+        bool: True if the rows were deleted.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            for table_name in reversed(RUN_TAGGED_TABLES):
+                cursor.execute(sql.SQL("DELETE FROM {} WHERE etl_run_id = %s").format(
+                    sql.Identifier(schema, table_name)), (run_id,))
+                if cursor.rowcount:
+                    logger.info(f"Removed {cursor.rowcount} rows of run {run_id} from {schema}.{table_name}.")
+
+            cursor.execute("""
+                DELETE FROM etl.core_run_undo
+                WHERE run_id = %s AND table_name IN (%s, %s)
+                RETURNING undo_id, table_name, previous::text
+            """, (run_id, f"{schema}.subcategory_lookup", f"{schema}.product_dimension"))
+            moved_groups = set()
+            for _, table_name, previous in sorted(cursor.fetchall(), reverse=True):
+                table = sql.Identifier(schema, table_name.split('.')[1])
+                if table_name.endswith(".subcategory_lookup"):
+                    cursor.execute(sql.SQL("DELETE FROM {}").format(table))
+                    cursor.execute(sql.SQL("""
+                        INSERT INTO {table}
+                        SELECT * FROM jsonb_populate_recordset(NULL::{table}, %s::jsonb)
+                    """).format(table=table), (previous,))
+                else:
+                    cursor.execute(sql.SQL("""
+                        UPDATE {table} p
+                        SET category = r.category, sub_category = r.sub_category
+                        FROM jsonb_to_recordset(%s::jsonb) AS r(product_id INTEGER, category TEXT, sub_category TEXT),
+                            {table} old
+                        WHERE p.product_id = r.product_id AND old.product_id = p.product_id
+                        RETURNING old.category, old.sub_category, p.category, p.sub_category
+                    """).format(table=table), (previous,))
+                    for category, sub_category, restored_category, restored_sub_category in cursor.fetchall():
+                        moved_groups.update({(category, sub_category), (restored_category, restored_sub_category)})
+                logger.info(f"Restored {cursor.rowcount} rows of {table_name} changed by run {run_id}.")
+        if moved_groups:
+            # the sales of the restored products move back to their previous category rows
+            refold_category_sales(warehouse_conn, moved_groups, schema)
+        warehouse_conn.commit()
+        return True
+
+    except psycopg2.Error as e:
+        warehouse_conn.rollback()
+        logger.error(f"Error rolling back core run {run_id}: {e}")
+        return False
+
+    finally:
+        close_connection(warehouse_conn)
+
+
+def discard_core_run_undo(run_id):
+    """
+    Deletes the undo records of a core run that no longer needs rolling back.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute("DELETE FROM etl.core_run_undo WHERE run_id = %s", (run_id,))
+        warehouse_conn.commit()
+    finally:
+        close_connection(warehouse_conn)
+
+
+def core_load_waves(warehouse_conn, schema="core"):
+    """
+    Groups the CORE_LOADERS into waves that can run concurrently: every loader comes one wave after the last loader
+    filling a table its table references by foreign key, as declared in the catalog of schema.
+
+    Returns:
+        list: Lists of core loaders, in CORE_LOADERS order within a wave.
+    """
+    with warehouse_conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT DISTINCT c.relname, p.relname
+            FROM pg_constraint k
+            JOIN pg_class c ON c.oid = k.conrelid
+            JOIN pg_class p ON p.oid = k.confrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE k.contype = 'f' AND n.nspname = %s AND k.conrelid <> k.confrelid
+        """, (schema,))
+        references = {}
+        for table, parent in cursor.fetchall():
+            references.setdefault(table, set()).add(parent)
+
+    loaders_by_table = {table: loader for loader, table in CORE_LOADER_TABLES.items()}
+    levels = {}
+
+    def level(loader):
+        if loader not in levels:
+            levels[loader] = 0  # guards against reference cycles
+            parents = [loaders_by_table[parent] for parent in references.get(CORE_LOADER_TABLES[loader], ())
+                       if parent in loaders_by_table]
+            levels[loader] = max((level(parent) + 1 for parent in parents), default=0)
+        return levels[loader]
+
+    waves = [[] for _ in range(max(map(level, CORE_LOADERS)) + 1)]
+    for loader in CORE_LOADERS:
+        waves[level(loader)].append(loader)
+    return waves
+
+
+def perform_parallel_core_load(logger, options=None, loaders=None, inserted_rows=None):
+    """
+    Loads the core tables concurrently on options.workers pooled connections, in the waves of core_load_waves, so a
+    table is loaded after the tables its foreign keys reference, with core.sales_fact split into options.workers
+    slices by order_id % workers. Every loader commits on its own connection, so all rows are tagged with one run
+    id, options.run_id or a new one from etl.run_id_seq; if any loader fails, the rows of the run are deleted
+    again.
+
+    The tables keep their indexes and foreign keys: dropping them would leave the live tables without them until
+    the last wave. Loads without them are left to the shadow schema, see perform_shadow_core_load.
+
+    Args:
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+        loaders (list, optional): The core loaders to run, see plan_core_load. Defaults to all of them.
+        inserted_rows (dict, optional): Filled with the rows inserted per loader.
+
+    Returns:
+        bool: True if every loader succeeded.
+    """
+    options = options or LoadOptions()
+    loaders = CORE_LOADERS if loaders is None else loaders
+    schema = options.core_schema
+    workers = max(1, options.workers)
+    load_sales = delta_core_load_sales_fact in loaders
+    pools_opened = open_connection_pools(workers + 1)
+    try:
+        warehouse_conn = connect_warehouse()
+        try:
+            with warehouse_conn.cursor() as cursor:
+                run_id = options.run_id
+                if run_id is None:
+                    cursor.execute("SELECT nextval('etl.run_id_seq')")
+                    run_id = cursor.fetchone()[0]
+            first_day, last_day = sales_fact_delta_days(
+                warehouse_conn, core_delta_filter(options, "staging.orderitem", "oi"))
+            # The slices would race creating the same partitions, so they are created up front
+            if load_sales and first_day is not None:
+                ensure_monthly_partitions(warehouse_conn, logger, "sales_fact", first_day, last_day, schema)
+            loader_waves = core_load_waves(warehouse_conn, schema)
+            warehouse_conn.commit()
+        except psycopg2.Error as e:
+            warehouse_conn.rollback()
+            logger.error(f"Error preparing the parallel core load: {e}")
+            return False
+        finally:
+            close_connection(warehouse_conn)
+
+        run_options = replace(options, run_id=run_id, bulk_load=False)
+        slice_options = replace(run_options, attach_partitions=False)
+        waves = []
+        for loader_wave in loader_waves:
+            wave = []
+            for loader in loader_wave:
+                if loader is delta_core_load_sales_fact:
+                    wave += [(loader, replace(slice_options, fact_slice=(index, workers))) for index in range(workers)]
+                else:
+                    wave.append((loader, run_options))
+            waves.append(wave)
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for wave in waves:
+                wave = [(loader, loader_options) for loader, loader_options in wave if loader in loaders]
+                futures = [(loader, pool.submit(loader, logger, loader_options)) for loader, loader_options in wave]
+                failed = []
+                for loader, future in futures:
+                    inserted = future.result()
+                    if inserted is None:
+                        failed.append(loader.__name__)
+                    elif inserted_rows is not None:
+                        inserted_rows[loader] = inserted_rows.get(loader, 0) + inserted
+                if failed:
+                    break
+
+        if failed:
+            logger.error(f"Core run {run_id} failed in {', '.join(failed)}, rolling it back.")
+            rollback_core_run(run_id, logger, schema)
+            return False
+        logger.info(f"Core run {run_id} loaded successfully with {workers} workers.")
+        return True
+
+    finally:
+        if pools_opened:
+            close_connection_pools()
+
+
+# The staging tables each core loader reads
+CORE_LOADER_INPUTS = {
+    delta_core_load_time_dimension: ("staging.orders",),
+    delta_core_load_customer_dimension: ("staging.customer", "staging.location"),
+    delta_core_load_product_dimension: ("staging.product", "staging.subcategory", "staging.category"),
+    delta_core_load_campaign_dimension: ("staging.marketing_campaigns",),
+    delta_core_load_order_dimension: ("staging.orders", "staging.payment_method"),
+    delta_core_load_supplier_dimension: ("staging.supplier",),
+    delta_core_load_sales_fact: ("staging.orderitem", "staging.orders"),
+    delta_core_load_returns_fact: ("staging.returns",),
+    delta_core_load_customer_product_ratings_fact: ("staging.customer_product_ratings",),
+}
+
+
+# The core table each core loader fills
+CORE_LOADER_TABLES = {
+    delta_core_load_time_dimension: "time_dimension",
+    delta_core_load_customer_dimension: "customer_dimension",
+    delta_core_load_product_dimension: "product_dimension",
+    delta_core_load_campaign_dimension: "campaign_dimension",
+    delta_core_load_order_dimension: "order_dimension",
+    delta_core_load_supplier_dimension: "supplier_dimension",
+    delta_core_load_sales_fact: "sales_fact",
+    delta_core_load_returns_fact: "returns_fact",
+    delta_core_load_customer_product_ratings_fact: "customer_product_ratings_fact",
+}
+
+
+def plan_core_load(dirty_tables, logger):
+    """
+    Selects the core loaders that have at least one dirty staging input, in dependency order, and logs the
+    ones skipped.
+
+    Args:
+        dirty_tables (set): The dirty staging tables, None to run every loader.
+        logger (Logger): The logger object for logging.
+
+    Returns:
+        list: The core loaders to run.
+    """
+    if dirty_tables is None:
+        logger.info("No record of changed staging tables, running every core loader.")
+        return list(CORE_LOADERS)
+
+    plan = []
+    for loader in CORE_LOADERS:
+        inputs = CORE_LOADER_INPUTS[loader]
+        if dirty_tables.intersection(inputs):
+            plan.append(loader)
+        else:
+            logger.info(f"Skipping {loader.__name__}: no new rows in {', '.join(inputs)}.")
+    return plan
+
+
+SHADOW_CORE_SCHEMA = "core_shadow"
+PREVIOUS_CORE_SCHEMA = "core_previous"
+
+
+def prepare_shadow_core_schema(logger):
+    """
+    Recreates the shadow core schema with empty star schema tables and no secondary indexes, which are built after
+    the load.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}").format(
+                schema=sql.Identifier(SHADOW_CORE_SCHEMA)))
+        warehouse_conn.commit()
+        forget_monthly_partitions(SHADOW_CORE_SCHEMA)
+        create_core_tables(warehouse_conn, logger, SHADOW_CORE_SCHEMA, indexes=False)
+    finally:
+        close_connection(warehouse_conn)
+
+
+def swap_core_schema(logger, lock_timeout='10s'):
+    """
+    Publishes the shadow core schema: the live core schema is renamed to core_previous and the shadow schema to core
+    in one short transaction, so readers see either the old or the new warehouse, never a partial one. The version
+    replaced before, if any, is dropped in the same transaction, so it is kept if the swap fails.
+
+    Views defined outside the core schema follow the tables they were created on, so they keep pointing at
+    core_previous after a swap.
+
+    Returns:
+        bool: True if the schemas were swapped.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute("SELECT set_config('lock_timeout', %s, true)", (lock_timeout,))
+            cursor.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(sql.Identifier(PREVIOUS_CORE_SCHEMA)))
+            cursor.execute(sql.SQL("ALTER SCHEMA core RENAME TO {}").format(sql.Identifier(PREVIOUS_CORE_SCHEMA)))
+            cursor.execute(sql.SQL("ALTER SCHEMA {} RENAME TO core").format(sql.Identifier(SHADOW_CORE_SCHEMA)))
+        warehouse_conn.commit()
+        forget_monthly_partitions()
+        logger.info(f"Shadow core schema published, the previous version is kept as {PREVIOUS_CORE_SCHEMA}.")
+        return True
+
+    except psycopg2.Error as e:
+        warehouse_conn.rollback()
+        logger.error(f"Error swapping the core schema: {e}")
+        return False
+
+    finally:
+        close_connection(warehouse_conn)
+
+
+def rollback_core_schema_swap(logger, lock_timeout='10s'):
+    """
+    Reverts the last swap_core_schema by exchanging core and core_previous. Running it again rolls forward.
+
+    Returns:
+        bool: True if the schemas were exchanged.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute("SELECT set_config('lock_timeout', %s, true)", (lock_timeout,))
+            cursor.execute("ALTER SCHEMA core RENAME TO core_rollback")
+            cursor.execute(sql.SQL("ALTER SCHEMA {} RENAME TO core").format(sql.Identifier(PREVIOUS_CORE_SCHEMA)))
+            cursor.execute(sql.SQL("ALTER SCHEMA core_rollback RENAME TO {}").format(
+                sql.Identifier(PREVIOUS_CORE_SCHEMA)))
+        warehouse_conn.commit()
+        forget_monthly_partitions()
+        logger.info(f"Core schema rolled back, the replaced version is kept as {PREVIOUS_CORE_SCHEMA}.")
+        return True
+
+    except psycopg2.Error as e:
+        warehouse_conn.rollback()
+        logger.error(f"Error rolling back the core schema: {e}")
+        return False
+
+    finally:
+        close_connection(warehouse_conn)
+
+
+def staging_holds_full_history(watermarks, logger):
+    """
+    Checks that every staging table holds all the production rows up to its extraction watermark, as a core
+    schema rebuilt from staging needs. Purged staging tables, see purge_consumed_staging_rows, do not.
+
+    Args:
+        watermarks (dict): The extraction watermark of each staging table.
+        logger (Logger): The logger object for logging.
+
+    Returns:
+        bool: True if no staging table misses rows.
+    """
+    production_conn = connect_production()
+    warehouse_conn = connect_warehouse()
+    complete = True
+    try:
+        for staging_table, (_, _, key_column) in STAGING_WATERMARKS.items():
+            counts = []
+            for conn, schema in ((production_conn, "public"), (warehouse_conn, "staging")):
+                with conn.cursor() as cursor:
+                    cursor.execute(sql.SQL("SELECT count(*) FROM {} WHERE {} <= %s").format(
+                        sql.Identifier(schema, staging_table.split('.')[1]), sql.Identifier(key_column)),
+                        (watermarks[staging_table],))
+                    counts.append(cursor.fetchone()[0])
+            if counts[1] < counts[0]:
+                complete = False
+                logger.error(f"{staging_table} holds {counts[1]} of the {counts[0]} production rows up to its "
+                             f"watermark {watermarks[staging_table]}.")
+        return complete
+    finally:
+        production_conn.rollback()
+        warehouse_conn.rollback()
+        close_connection(production_conn)
+        close_connection(warehouse_conn)
+
+
+def perform_shadow_core_load(logger, options=None):
+    """
+    Builds the whole core schema from staging in a shadow schema - tables, indexes and aggregates - and swaps it
+    with the live core schema once every step succeeded. Analysts keep querying the previous version meanwhile.
+
+    Args:
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+
+    Returns:
+        bool: True if the new core schema was published.
+    """
+    options = options or LoadOptions()
+    # The shadow tables start empty and without secondary indexes, so a bulk load has nothing to drop
+    shadow_options = replace(options, core_schema=SHADOW_CORE_SCHEMA, bulk_load=False, aggregate_full_rebuild=True)
+
+    try:
+        prepare_shadow_core_schema(logger)
+    except psycopg2.Error as e:
+        logger.error(f"Error preparing the shadow core schema: {e}")
+        return False
+
+    if options.workers > 1:
+        if not perform_parallel_core_load(logger, shadow_options):
+            logger.error("Parallel core load failed, the live core schema is left unchanged.")
+            return False
+    else:
+        for loader in CORE_LOADERS:
+            if loader(logger, shadow_options) is None:
+                logger.error(f"{loader.__name__} failed, the live core schema is left unchanged.")
+                return False
+
+    warehouse_conn = connect_warehouse("index_build")
+    try:
+        create_core_indexes(warehouse_conn, logger, SHADOW_CORE_SCHEMA)
+    finally:
+        close_connection(warehouse_conn)
+
+    if perform_sales_aggregation(logger, shadow_options) is None:
+        logger.error("Sales aggregation failed, the live core schema is left unchanged.")
+        return False
+
+    return swap_core_schema(logger)
+
+
+def perform_delta_core_load(ETL_LOAD_FOLDER, logger, options=None, tables=None, changed_rows=None):
+    """
+    Loads the core tables from staging as one run registered in etl.pipeline_runs. The rows of a run are tagged
+    with its id and a run that fails is rolled back as a whole, so retrying it cannot hit leftover rows.
 
+    Only the staging rows staged since the last core load consumed its watermarks are read, see core_delta_filter,
+    and dimension rows already in core are skipped, so the cost of a run follows the size of the delta.
 
-def perform_delta_core_load(logger):
-    testing = True
-    if testing:
-        cascade_truncate_tables_core(logger)
+    Args:
+        ETL_LOAD_FOLDER (str): The path to the ETL load folder.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+        tables (list, optional): Restricts the load to the core loaders filling or reading these tables, e.g.
+            ['sales_fact'] or ['staging.orders'].
+        changed_rows (dict, optional): Filled with the rows inserted per core table.
+
+    Returns:
+        bool: True if the core load succeeded.
+    """
+    options = options or LoadOptions()
+    run_id, retry_watermarks = begin_pipeline_run(ETL_LOAD_FOLDER, 'core', logger)
+    if run_id is None:
+        return False
+    if retry_watermarks is not None and not options.shadow_swap:
+        # a crash can leave rows of the failed attempt behind
+        rollback_core_run(run_id, logger, options.core_schema)
+    options = replace(options, run_id=run_id)
+    # the staging rows of this run: past the consumed watermarks, up to the rows staged by now
+    consumed = read_consumed_watermarks(ETL_LOAD_FOLDER)
+    pending = read_pending_staging_rows(ETL_LOAD_FOLDER)
+    watermarks = {table: read_staging_watermark(ETL_LOAD_FOLDER, table) for table in STAGING_WATERMARKS}
+
+    if options.shadow_swap:
+        # the shadow schema is built from scratch, so every loader runs over all the rows staged by now
+        options = replace(options, core_delta={table: (0, watermarks[table], []) for table in STAGING_WATERMARKS})
+        try:
+            complete = staging_holds_full_history(watermarks, logger)
+        except psycopg2.Error as e:
+            logger.error(f"Error checking the staging history: {e}")
+            complete = False
+        if not complete:
+            finish_pipeline_run(run_id, False, logger, "staging does not hold the full history for a shadow build")
+            return False
+        succeeded = perform_shadow_core_load(logger, options)
+        discard_core_run_undo(run_id)
+        if succeeded:
+            write_dirty_staging_tables(ETL_LOAD_FOLDER, set())
+            record_consumed_watermarks(
+                ETL_LOAD_FOLDER, set(STAGING_WATERMARKS),
+                find_pending_staging_rows(ETL_LOAD_FOLDER, set(STAGING_WATERMARKS), logger, watermarks), watermarks)
+        finish_pipeline_run(run_id, succeeded, logger, None if succeeded else "shadow core load failed")
+        return succeeded
+
+    options = replace(options, core_delta={
+        table: (consumed.get(table, 0), watermarks[table], pending.get(table, [])) for table in STAGING_WATERMARKS})
+    dirty_tables = read_dirty_staging_tables(ETL_LOAD_FOLDER)
+    plan = plan_core_load(dirty_tables, logger)
+    if tables is not None:
+        plan = [loader for loader in plan
+                if CORE_LOADER_TABLES[loader] in tables or set(CORE_LOADER_INPUTS[loader]) & set(tables)]
+    inserted_rows = {}
+    error = None
+    if options.workers > 1:
+        if not perform_parallel_core_load(logger, options, plan, inserted_rows):
+            error = "parallel core load failed"
     else:
-        # delta_core_load_time_dimension(logger)
-        # delta_core_load_customer_dimension(logger)
-        # delta_core_load_product_dimension(logger)
-        # delta_core_load_campaign_dimension(logger)
-        # delta_core_load_order_dimension(logger)
-        # delta_core_load_supplier_dimension(logger)
-        # delta_core_load_sales_fact(logger)
-        # delta_core_load_returns_fact(logger)
-        delta_core_load_customer_product_ratings_fact(logger)
-
-def main():
+        for loader in plan:
+            inserted = loader(logger, options)
+            if inserted is None:
+                error = f"{loader.__name__} failed"
+                rollback_core_run(run_id, logger, options.core_schema)
+                break
+            inserted_rows[loader] = inserted
+    # the run is all or nothing
+    failed = plan if error else []
+
+    # fresh statistics for the aggregation and the reports reading the new rows
+    core_rows = {f"{options.core_schema}.{CORE_LOADER_TABLES[loader]}": rows for loader, rows in inserted_rows.items()}
+    if changed_rows is not None:
+        changed_rows.update(core_rows)
+    perform_table_maintenance(core_rows, logger, options)
+
+    # refresh the sales summary tables from the newly loaded facts
+    if delta_core_load_sales_fact in plan and not failed:
+        perform_sales_aggregation(logger, options)
+
+    # inputs of a failed run, and of loaders left out of the run, stay dirty for the next one
+    still_dirty = set()
+    for loader in CORE_LOADERS:
+        if loader in failed or loader not in plan:
+            still_dirty.update(CORE_LOADER_INPUTS[loader])
+    if dirty_tables is not None:
+        still_dirty &= dirty_tables
+    write_dirty_staging_tables(ETL_LOAD_FOLDER, still_dirty)
+    consumed_tables = set(STAGING_WATERMARKS) - still_dirty
+    record_consumed_watermarks(ETL_LOAD_FOLDER, consumed_tables,
+                               find_pending_staging_rows(ETL_LOAD_FOLDER, consumed_tables, logger, watermarks),
+                               watermarks)
+    if not failed:
+        discard_core_run_undo(run_id)
+    if options.staging_retention and not failed:
+        purge_consumed_staging_rows(ETL_LOAD_FOLDER, logger, options)
+
+    finish_pipeline_run(run_id, not failed, logger, error)
+    return not failed
+
+# Freshness targets in seconds of the daemon; a table with a target is polled at least twice within it
+DAEMON_LATENCY_TARGETS = {
+    "staging.orders": 60,
+    "staging.orderitem": 60,
+}
+
+
+def poll_staging_changes(production_conn, watermarks, staging_tables):
+    """
+    Returns the staging tables whose production table has rows past the watermark.
+    """
+    changed = []
+    with production_conn.cursor() as cursor:
+        for staging_table in staging_tables:
+            _, _, key_column = STAGING_WATERMARKS[staging_table]
+            cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE {} > %s)").format(
+                sql.Identifier("public", staging_table.split('.')[1]), sql.Identifier(key_column)),
+                (watermarks[staging_table],))
+            if cursor.fetchone()[0]:
+                changed.append(staging_table)
+    production_conn.rollback()
+    return changed
+
+
+def run_daemon(ETL_LOAD_FOLDER, logger, options=None, tables=None, min_interval=5.0, max_interval=300.0,
+               housekeeping_interval=60.0):
+    """
+    Keeps the warehouse fresh with micro-batches until SIGINT or SIGTERM.
+
+    Each staging table is polled on its own schedule with a cheap existence check past its watermark. Once one has
+    new rows, all tables with new rows are staged and pushed through the core load together. With
+    options.staging_retention the staging rows consumed are purged after every micro-batch, see
+    purge_consumed_staging_rows, so staging only holds the rows still needed.
+
+    A table's polling interval halves when it had changes and grows by half when it had none, between min_interval
+    and max_interval, or half its DAEMON_LATENCY_TARGETS entry. Connections are pooled for the whole lifetime of
+    the daemon.
+
+    A micro-batch only loads: the staging tables are prepared before the first one, see prepare_staging_tables, and
+    again after a failed one, which may follow a server crash. The rows loaded are added up across batches and table
+    maintenance, the run metrics file and the freshness measurement run at most every housekeeping_interval
+    seconds, maintenance only once a table received options.analyze_min_rows rows.
+
+    Args:
+        ETL_LOAD_FOLDER (str): The path to the ETL load folder.
+        logger (Logger): The logger object for logging.
+        options (LoadOptions, optional): Loader options, defaults to LoadOptions().
+        tables (list, optional): The staging tables to keep fresh. Defaults to all of them.
+        min_interval (float): Shortest polling interval in seconds.
+        max_interval (float): Longest polling interval in seconds.
+        housekeeping_interval (float): Shortest time in seconds between two rounds of maintenance, metrics and
+            freshness measurement.
+
+    Returns:
+        None
+    """
+    options = options or LoadOptions()
+    batch_options = replace(options, maintenance=False, prepare_staging=False)
+    staging_tables = [table for table in STAGING_LOADERS if tables is None or table in tables]
+    ceilings = {table: min(max_interval, DAEMON_LATENCY_TARGETS.get(table, max_interval * 2) / 2)
+                for table in staging_tables}
+    intervals = {table: min_interval for table in staging_tables}
+    next_poll = {table: 0.0 for table in staging_tables}
+    watermarks = {table: read_staging_watermark(ETL_LOAD_FOLDER, table) for table in staging_tables}
+
+    stop = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stop.set())
+
+    open_connection_pools(max(2, options.workers) + 1)
+    logger.info(f"Daemon started for {len(staging_tables)} staging tables.")
+    prepare_staging = True
+    # rows loaded per table since its last maintenance, and whether batches ran since the last housekeeping
+    unmaintained = {}
+    batches_since_housekeeping = False
+    next_housekeeping = time.monotonic() + housekeeping_interval
+    try:
+        while not stop.is_set():
+            now = time.monotonic()
+            due = [table for table in staging_tables if next_poll[table] <= now]
+            if due:
+                production_conn = connect_production()
+                try:
+                    changed = poll_staging_changes(production_conn, watermarks, due)
+                    if changed:
+                        # rows referenced by the new ones may sit in tables not yet due, they join the batch
+                        changed += poll_staging_changes(
+                            production_conn, watermarks, [table for table in staging_tables if table not in due])
+                except psycopg2.Error as e:
+                    logger.error(f"Error polling production: {e}")
+                    changed = []
+                finally:
+                    close_connection(production_conn)
+
+                if changed:
+                    started = time.monotonic()
+                    loaded_rows = {}
+                    try:
+                        if prepare_staging:
+                            prepare_staging_tables(ETL_LOAD_FOLDER, logger, options)
+                        succeeded = (perform_delta_load_staging(ETL_LOAD_FOLDER, logger, batch_options, changed,
+                                                                loaded_rows)
+                                     and perform_delta_core_load(ETL_LOAD_FOLDER, logger, batch_options, changed,
+                                                                 loaded_rows))
+                    except psycopg2.Error as e:
+                        logger.error(f"Micro-batch of {', '.join(changed)} failed: {e}")
+                        succeeded = False
+                    prepare_staging = not succeeded
+                    batches_since_housekeeping = True
+                    for table, rows in loaded_rows.items():
+                        unmaintained[table] = unmaintained.get(table, 0) + (rows or 0)
+                    logger.info(f"Micro-batch of {', '.join(changed)} done in {time.monotonic() - started:.1f}s.")
+                    for table in changed:
+                        watermarks[table] = read_staging_watermark(ETL_LOAD_FOLDER, table)
+
+                for table in due:
+                    if table in changed:
+                        intervals[table] = max(min_interval, intervals[table] / 2)
+                    else:
+                        intervals[table] = min(ceilings[table], intervals[table] * 1.5)
+                    next_poll[table] = time.monotonic() + intervals[table]
+
+            if batches_since_housekeeping and time.monotonic() >= next_housekeeping:
+                for table in perform_table_maintenance(unmaintained, logger, options):
+                    unmaintained.pop(table, None)
+                write_run_metrics(ETL_LOAD_FOLDER, logger)
+                try:
+                    record_freshness(measure_freshness(ETL_LOAD_FOLDER, logger), logger)
+                except psycopg2.Error as e:
+                    logger.error(f"Error measuring freshness: {e}")
+                batches_since_housekeeping = False
+                next_housekeeping = time.monotonic() + housekeeping_interval
+
+            stop.wait(max(0.0, min(min(next_poll.values()), next_housekeeping if batches_since_housekeeping
+                                   else float("inf")) - time.monotonic()))
+    finally:
+        if batches_since_housekeeping:
+            write_run_metrics(ETL_LOAD_FOLDER, logger)
+        close_connection_pools()
+        logger.info("Daemon stopped.")
+
+
+def measure_freshness(ETL_LOAD_FOLDER, logger):
+    """
+    Measures how far the warehouse is behind production for every source table, cheaply enough to be polled every
+    few seconds: the production side only reads the end of primary key indexes.
+
+    - production_max_key is the newest key in production.
+    - staging_watermark and core_watermark are the newest keys extracted into staging and consumed by the core
+      load.
+    - row_lag is the number of keys between the core watermark and production. Keys come from sequences, so this
+      is the number of rows not in core yet, give or take rolled back inserts.
+    - time_lag_seconds, for orders only, is the age of the newest order in core relative to the newest order in
+      production.
+
+    Returns:
+        list: One dict per source table, in STAGING_WATERMARKS order.
+    """
+    consumed = read_consumed_watermarks(ETL_LOAD_FOLDER)
+    production_conn = connect_production()
+    try:
+        with production_conn.cursor() as cursor:
+            cursor.execute(sql.SQL(" UNION ALL ").join(
+                sql.SQL("SELECT {}, max({}) FROM {}").format(
+                    sql.Literal(staging_table), sql.Identifier(key_column),
+                    sql.Identifier("public", staging_table.split('.')[1]))
+                for staging_table, (_, _, key_column) in STAGING_WATERMARKS.items()))
+            max_keys = dict(cursor.fetchall())
+            cursor.execute("""
+                SELECT EXTRACT(EPOCH FROM
+                    (SELECT order_timestamp FROM public.orders ORDER BY order_id DESC LIMIT 1)
+                    - (SELECT order_timestamp FROM public.orders WHERE order_id <= %s ORDER BY order_id DESC LIMIT 1))
+            """, (consumed.get("staging.orders", 0),))
+            order_time_lag = cursor.fetchone()[0]
+    finally:
+        close_connection(production_conn)
+
+    measurements = []
+    for staging_table in STAGING_WATERMARKS:
+        max_key, core_watermark = max_keys.get(staging_table), consumed.get(staging_table, 0)
+        measurements.append({
+            "source_table": f"public.{staging_table.split('.')[1]}",
+            "production_max_key": max_key,
+            "staging_watermark": read_staging_watermark(ETL_LOAD_FOLDER, staging_table),
+            "core_watermark": core_watermark,
+            "row_lag": max(0, (max_key or 0) - core_watermark),
+            "time_lag_seconds": None if staging_table != "staging.orders" else (
+                float(order_time_lag) if order_time_lag is not None else None),
+        })
+    return measurements
+
+
+def record_freshness(measurements, logger):
+    """
+    Appends freshness measurements to etl.freshness, to chart the lag over time.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            execute_values(cursor, """
+                INSERT INTO etl.freshness (source_table, production_max_key, staging_watermark, core_watermark,
+                                           row_lag, time_lag_seconds)
+                VALUES %s
+            """, [(m["source_table"], m["production_max_key"], m["staging_watermark"], m["core_watermark"],
+                   m["row_lag"], m["time_lag_seconds"]) for m in measurements])
+        warehouse_conn.commit()
+    except psycopg2.Error as e:
+        warehouse_conn.rollback()
+        logger.error(f"Error recording freshness: {e}")
+    finally:
+        close_connection(warehouse_conn)
+
+
+def print_freshness(measurements):
+    print(f"{'source table':<34} {'production':>10} {'staging':>10} {'core':>10} {'row lag':>10} {'time lag':>10}")
+    for m in measurements:
+        max_key = "-" if m["production_max_key"] is None else m["production_max_key"]
+        time_lag = "-" if m["time_lag_seconds"] is None else f"{m['time_lag_seconds']:.0f}s"
+        print(f"{m['source_table']:<34} {max_key:>10} {m['staging_watermark']:>10} {m['core_watermark']:>10} "
+              f"{m['row_lag']:>10} {time_lag:>10}")
+
+
+def print_pipeline_status(ETL_LOAD_FOLDER, logger, limit=10):
+    """
+    Prints the latest runs from etl.pipeline_runs, the staging tables waiting for the core load and the freshness
+    of every source table, see measure_freshness.
+    """
+    warehouse_conn = connect_warehouse()
+    try:
+        with warehouse_conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT run_id, stage, status, attempts, started_at, finished_at, error
+                FROM etl.pipeline_runs
+                ORDER BY run_id DESC
+                LIMIT %s
+            """, (limit,))
+            runs = cursor.fetchall()
+    except psycopg2.Error as e:
+        logger.error(f"Error reading the pipeline runs: {e}")
+        runs = []
+    finally:
+        close_connection(warehouse_conn)
+
+    print(f"{'run':>6}  {'stage':<8} {'status':<10} {'tries':>5}  {'started':<19}  {'finished':<19}  error")
+    for run_id, stage, status, attempts, started_at, finished_at, error in runs:
+        print(f"{run_id:>6}  {stage:<8} {status:<10} {attempts:>5}  {started_at:%Y-%m-%d %H:%M:%S}  "
+              f"{finished_at.strftime('%Y-%m-%d %H:%M:%S') if finished_at else '-':<19}  {error or ''}")
+
+    dirty_tables = read_dirty_staging_tables(ETL_LOAD_FOLDER)
+    print()
+    print("Staging tables waiting for the core load: "
+          + ("unknown" if dirty_tables is None else ", ".join(sorted(dirty_tables)) or "none"))
+    print()
+    try:
+        print_freshness(measure_freshness(ETL_LOAD_FOLDER, logger))
+    except psycopg2.Error as e:
+        logger.error(f"Error measuring freshness: {e}")
+
+
+def run_profile_dir():
+    """
+    Returns a fresh directory for the profile artifacts of this run, under 'profiles' next to the run log.
+    """
+    log_dir = os.path.dirname(log_file_path()) if log_file_path() else os.getcwd()
+    return os.path.join(log_dir, "profiles", time.strftime("%Y%m%d-%H%M%S"))
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(prog="pipeline", description="Load the warehouse from the production database.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="extract into staging and/or load the core tables")
+    run.add_argument("--stages", default="staging,core",
+                     help="comma separated stages to run, out of staging and core (default: both)")
+    run.add_argument("--tables",
+                     help="comma separated tables to load, staging tables by name (orders) and core tables by name "
+                          "(sales_fact) or by the staging tables they read")
+    run.add_argument("--workers", type=int, default=1, help="concurrent loaders and connections")
+    run.add_argument("--mode", choices=("insert", "values", "copy"), default="insert",
+                     help="how staging records are sent to the warehouse")
+    run.add_argument("--shadow-swap", action="store_true", help="build the core schema aside and swap it in")
+    run.add_argument("--fault-isolation", action="store_true", help="quarantine failing rows instead of failing")
+    run.add_argument("--fast-staging", action="store_true", help="unlogged staging tables, asynchronous commits")
+    run.add_argument("--staging-retention", action="store_true", help="purge consumed staging rows after the core load")
+    run.add_argument("--profile", action="store_true",
+                     help="profile every loader (cProfile, memory peak, EXPLAIN ANALYZE of the core SELECTs) into a "
+                          "profiles directory next to the run log; slows the run down")
+
+    truncate = commands.add_parser("truncate", help="empty the staging and/or core tables")
+    truncate.add_argument("--layer", choices=("staging", "core", "all"), default="all")
+
+    daemon = commands.add_parser("daemon", help="keep loading small deltas until stopped")
+    daemon.add_argument("--tables", help="comma separated staging tables to keep fresh (default: all)")
+    daemon.add_argument("--workers", type=int, default=1, help="concurrent loaders and connections")
+    daemon.add_argument("--mode", choices=("insert", "values", "copy"), default="insert",
+                        help="how staging records are sent to the warehouse")
+    daemon.add_argument("--staging-retention", action="store_true",
+                        help="purge consumed staging rows after every micro-batch")
+    daemon.add_argument("--min-interval", type=float, default=5.0, help="shortest polling interval in seconds")
+    daemon.add_argument("--max-interval", type=float, default=300.0, help="longest polling interval in seconds")
+    daemon.add_argument("--housekeeping-interval", type=float, default=60.0,
+                        help="seconds between rounds of table maintenance, run metrics and freshness measurement")
+
+    status = commands.add_parser("status", help="show recent runs, pending staging tables and watermarks")
+    status.add_argument("--limit", type=int, default=10, help="number of runs to show")
+
+    freshness = commands.add_parser("freshness", help="show how far the warehouse is behind production")
+    freshness.add_argument("--record", action="store_true", help="also append the measurements to etl.freshness")
+    freshness.add_argument("--interval", type=float,
+                           help="keep measuring every INTERVAL seconds until interrupted")
+    args = parser.parse_args(argv)
+    if args.command == "run" and args.shadow_swap and args.staging_retention:
+        # the shadow schema is rebuilt from the whole staging history, which the purge deletes
+        parser.error("--staging-retention cannot be combined with --shadow-swap")
+    return args
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
     # load etl path
     ETL_LOAD_FOLDER = load_etl_path()
     # setting up a log
     logger = intialize_logger()
-    ############################################################################################
-    # perform delta load into staging
-    # perform_delta_load_staging(ETL_LOAD_FOLDER, logger)
-    ############################################################################################
-    # perform core load from staging
-    perform_delta_core_load(logger)
+
+    if args.command == "status":
+        print_pipeline_status(ETL_LOAD_FOLDER, logger, args.limit)
+        return 0
+
+    if args.command == "freshness":
+        open_connection_pools(2)
+        try:
+            while True:
+                measurements = measure_freshness(ETL_LOAD_FOLDER, logger)
+                if args.record:
+                    record_freshness(measurements, logger)
+                print_freshness(measurements)
+                if not args.interval:
+                    return 0
+                time.sleep(args.interval)
+                print()
+        except KeyboardInterrupt:
+            return 0
+        finally:
+            close_connection_pools()
+
+    if args.command == "truncate":
+        if args.layer in ("staging", "all"):
+            cascade_truncate_tables_staging(logger)
+        if args.layer in ("core", "all"):
+            cascade_truncate_tables_core(logger, ETL_LOAD_FOLDER)
+        return 0
+
+    if args.command == "daemon":
+        tables = None
+        if args.tables:
+            tables = [table.strip() if "." in table else f"staging.{table.strip()}"
+                      for table in args.tables.split(",") if table.strip()]
+        run_daemon(ETL_LOAD_FOLDER, logger, LoadOptions(workers=args.workers, insert_mode=args.mode,
+                                                        staging_retention=args.staging_retention), tables,
+                   args.min_interval, args.max_interval, args.housekeeping_interval)
+        return 0
+
+    options = LoadOptions(
+        workers=args.workers,
+        insert_mode=args.mode,
+        shadow_swap=args.shadow_swap,
+        fault_isolation=args.fault_isolation,
+        fast_staging=args.fast_staging,
+        staging_retention=args.staging_retention,
+        profile_dir=run_profile_dir() if args.profile else None,
+    )
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    tables = None
+    if args.tables:
+        tables = [table.strip() for table in args.tables.split(",") if table.strip()]
+        tables += [f"staging.{table}" for table in tables if "." not in table]
+
+    succeeded = True
+    try:
+        if "staging" in stages:
+            ############################################################################################
+            # perform delta load into staging
+            succeeded = perform_delta_load_staging(ETL_LOAD_FOLDER, logger, options, tables)
+        if "core" in stages and succeeded:
+            ############################################################################################
+            # perform core load from staging
+            succeeded = perform_delta_core_load(ETL_LOAD_FOLDER, logger, options, tables)
+    finally:
+        write_run_metrics(ETL_LOAD_FOLDER, logger)
+    return 0 if succeeded else 1
 
 
 if __name__ == "__main__":
-    main()
+    raise SystemExit(main())
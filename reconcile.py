@@ -0,0 +1,241 @@
+"""
+Reconciles the staging and core tables with the production tables they were loaded from, without comparing them
+row by row.
+
+The key space of each table is split into ranges, and both sides compute per range the row count, the sum of the
+keys and the sum of a 64 bit hash of every row, an aggregate that does not depend on row order. Only the ranges
+whose aggregates differ are split further, Merkle style, until they are small enough to compare the row hashes
+key by key, which yields the exact missing, unexpected and differing keys. Tables and both sides of a table are
+checked in parallel.
+
+Staging is compared up to its extraction watermark and core up to the watermarks consumed by the last core load,
+since production rows past them are not expected to be loaded yet.
+"""
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2 import sql
+
+from etl_logging import setup_logging
+from pipeline import (STAGING_WATERMARKS, close_connection, close_connection_pools, connect_production,
+                      connect_warehouse, load_etl_path, open_connection_pools, read_consumed_watermarks,
+                      read_staging_watermark)
+
+# Ranges each mismatching range is split into
+RANGE_FANOUT = 64
+
+# Ranges of at most this many keys are compared key by key
+LEAF_RANGE_KEYS = 1000
+
+# Core tables compared with production: (production table, key, compared columns, staging table of the watermark)
+CORE_RECONCILIATIONS = {
+    "core.customer_dimension": ("public.customer", "customer_id", ("first_name", "last_name", "email"),
+                                "staging.customer"),
+    "core.product_dimension": ("public.product", "product_id", ("name", "price", "description", "subcategory_id"),
+                               "staging.product"),
+    "core.supplier_dimension": ("public.supplier", "supplier_id", ("supplier_name", "email"), "staging.supplier"),
+    "core.order_dimension": ("public.orders", "order_id", ("customer_id",), "staging.orders"),
+    "core.returns_fact": ("public.returns", "return_id",
+                          ("order_id", "product_id", "return_date", "reason", "amount_refunded"), "staging.returns"),
+    "core.customer_product_ratings_fact": (
+        "public.customer_product_ratings", "customerproductrating_id",
+        ("customer_id", "product_id", "ratings", "review", "sentiment"), "staging.customer_product_ratings"),
+}
+
+
+def row_hash(columns):
+    """
+    SQL for a 64 bit hash of the compared columns of a row, as NUMERIC so it can be summed without overflow.
+    """
+    return sql.SQL("('x' || left(md5(ROW({})::text), 16))::bit(64)::bigint::numeric").format(
+        sql.SQL(", ").join(map(sql.Identifier, columns)))
+
+
+def range_checksums(connect, table, key, columns, low, high, width):
+    """
+    Computes (count, key sum, row hash sum) for the ranges of `width` keys splitting low < key <= high, in one
+    scan.
+
+    Returns:
+        dict: The aggregates of each non-empty range, by range number.
+    """
+    conn = connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("""
+                SELECT ({key} - %(low)s - 1) / %(width)s, count(*), sum({key}), sum({hash})
+                FROM {table}
+                WHERE {key} > %(low)s AND {key} <= %(high)s
+                GROUP BY 1
+            """).format(key=sql.Identifier(key), hash=row_hash(columns),
+                        table=sql.Identifier(*table.split('.'))),
+                {"low": low, "high": high, "width": width})
+            return {row[0]: tuple(row[1:]) for row in cursor.fetchall()}
+    finally:
+        close_connection(conn)
+
+
+def row_hashes(connect, table, key, columns, low, high):
+    """
+    Returns the hash of every row with low < key <= high, by key.
+    """
+    conn = connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL("SELECT {key}, {hash} FROM {table} WHERE {key} > %s AND {key} <= %s").format(
+                key=sql.Identifier(key), hash=row_hash(columns), table=sql.Identifier(*table.split('.'))),
+                (low, high))
+            return dict(cursor.fetchall())
+    finally:
+        close_connection(conn)
+
+
+def table_columns(connect, table):
+    conn = connect()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                SELECT column_name FROM information_schema.columns
+                WHERE table_schema = %s AND table_name = %s
+                ORDER BY ordinal_position
+            """, tuple(table.split('.')))
+            return [row[0] for row in cursor.fetchall()]
+    finally:
+        close_connection(conn)
+
+
+def reconcile_table(source, target, key, columns, low, high, logger):
+    """
+    Compares the rows of a production table with a warehouse table over low < key <= high.
+
+    Args:
+        source (str): The production table, e.g. 'public.orderitem'.
+        target (str): The warehouse table, e.g. 'staging.orderitem'.
+        key (str): The integer key shared by both tables.
+        columns (tuple): The columns compared, present in both tables.
+        low (int): Keys above this one are compared.
+        high (int): Keys up to this one are compared.
+        logger (Logger): The logger object for logging.
+
+    Returns:
+        dict: The keys 'missing' from the target, 'unexpected' in the target, and 'differing' between the two,
+        with the number of ranges checksummed.
+    """
+    report = {"missing": [], "unexpected": [], "differing": [], "ranges_checked": 0}
+    pending = [(low, high)]
+    with ThreadPoolExecutor(max_workers=2) as sides:
+        while pending:
+            range_low, range_high = pending.pop()
+            if range_high - range_low <= LEAF_RANGE_KEYS:
+                source_rows, target_rows = (side.result() for side in (
+                    sides.submit(row_hashes, connect_production, source, key, columns, range_low, range_high),
+                    sides.submit(row_hashes, connect_warehouse, target, key, columns, range_low, range_high)))
+                report["missing"] += sorted(source_rows.keys() - target_rows.keys())
+                report["unexpected"] += sorted(target_rows.keys() - source_rows.keys())
+                report["differing"] += sorted(k for k in source_rows.keys() & target_rows.keys()
+                                              if source_rows[k] != target_rows[k])
+                continue
+
+            width = -(-(range_high - range_low) // RANGE_FANOUT)
+            source_ranges, target_ranges = (side.result() for side in (
+                sides.submit(range_checksums, connect_production, source, key, columns, range_low, range_high, width),
+                sides.submit(range_checksums, connect_warehouse, target, key, columns, range_low, range_high, width)))
+            report["ranges_checked"] += len(source_ranges.keys() | target_ranges.keys())
+            for number in source_ranges.keys() | target_ranges.keys():
+                if source_ranges.get(number) != target_ranges.get(number):
+                    sub_low = range_low + number * width
+                    pending.append((sub_low, min(range_high, sub_low + width)))
+
+    mismatches = len(report["missing"]) + len(report["unexpected"]) + len(report["differing"])
+    if mismatches:
+        logger.warning(f"{target} differs from {source} on {mismatches} keys in ({low}, {high}].")
+    else:
+        logger.info(f"{target} matches {source} in ({low}, {high}].")
+    return report
+
+
+def reconciliation_plan(ETL_LOAD_FOLDER, tables=None, since_consumed=False):
+    """
+    Lists the comparisons to run: every staging table against its production table on all their shared columns,
+    and the core tables of CORE_RECONCILIATIONS on their compared columns.
+
+    Args:
+        ETL_LOAD_FOLDER (str): The path to the ETL load folder, holding the watermarks.
+        tables (list, optional): The staging and core tables to reconcile. Defaults to all of them.
+        since_consumed (bool): Compare staging only past the watermarks consumed by the core load, for staging
+            tables purged after the core load.
+
+    Returns:
+        list: (source, target, key, columns, low, high) tuples.
+    """
+    consumed = read_consumed_watermarks(ETL_LOAD_FOLDER)
+    plan = []
+    for staging_table, (_, _, key) in STAGING_WATERMARKS.items():
+        if tables is None or staging_table in tables:
+            source = f"public.{staging_table.split('.')[1]}"
+            target_columns = set(table_columns(connect_warehouse, staging_table))
+            columns = tuple(column for column in table_columns(connect_production, source)
+                            if column in target_columns)
+            low = consumed.get(staging_table, 0) if since_consumed else 0
+            plan.append((source, staging_table, key, columns, low,
+                         read_staging_watermark(ETL_LOAD_FOLDER, staging_table)))
+    for core_table, (source, key, columns, staging_table) in CORE_RECONCILIATIONS.items():
+        if tables is None or core_table in tables:
+            plan.append((source, core_table, key, columns, 0, consumed.get(staging_table, 0)))
+    return plan
+
+
+def reconcile(ETL_LOAD_FOLDER, logger, tables=None, since_consumed=False, workers=4):
+    """
+    Runs the reconciliation_plan with `workers` tables checked concurrently.
+
+    Returns:
+        dict: The report of each target table, see reconcile_table.
+    """
+    open_connection_pools(workers * 2 + 2)
+    try:
+        plan = reconciliation_plan(ETL_LOAD_FOLDER, tables, since_consumed)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {target: pool.submit(reconcile_table, source, target, key, columns, low, high, logger)
+                       for source, target, key, columns, low, high in plan}
+            return {target: future.result() for target, future in futures.items()}
+    finally:
+        close_connection_pools()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile the staging and core tables with production.")
+    parser.add_argument("--tables", help="comma separated staging or core tables, e.g. staging.orderitem "
+                                         "(default: all)")
+    parser.add_argument("--since-consumed", action="store_true",
+                        help="compare staging only past the rows consumed by the core load, for purged staging")
+    parser.add_argument("--workers", type=int, default=4, help="tables reconciled concurrently")
+    parser.add_argument("--max-keys", type=int, default=20, help="keys listed per kind of mismatch")
+    parser.add_argument("--output", help="write the full report as JSON to this file")
+    args = parser.parse_args()
+
+    logger = setup_logging("reconcile.log")
+    tables = [table.strip() for table in args.tables.split(",")] if args.tables else None
+    reports = reconcile(load_etl_path(), logger, tables, args.since_consumed, args.workers)
+
+    mismatched = 0
+    for target, report in reports.items():
+        if not (report["missing"] or report["unexpected"] or report["differing"]):
+            print(f"{target}: OK ({report['ranges_checked']} ranges)")
+            continue
+        mismatched += 1
+        print(f"{target}: MISMATCH")
+        for kind in ("missing", "unexpected", "differing"):
+            if report[kind]:
+                keys = ", ".join(map(str, report[kind][:args.max_keys]))
+                more = f" and {len(report[kind]) - args.max_keys} more" if len(report[kind]) > args.max_keys else ""
+                print(f"  {len(report[kind])} {kind}: {keys}{more}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=2)
+    return 1 if mismatched else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,235 @@
+import argparse
+
+import psycopg2
+from psycopg2 import sql
+
+from core_layer_table_create import intialize_logger
+
+# Staging tables with their columns. Staging holds the rows extracted from production until the core load has
+# consumed them, so it has primary keys but no foreign keys. Every table also gets an etl_batch_id column holding
+# the staging run that extracted the row.
+STAGING_TABLES = {
+    "location": """
+        location_id INTEGER PRIMARY KEY,
+        latitude DOUBLE PRECISION,
+        longitude DOUBLE PRECISION,
+        country CHARACTER VARYING,
+        state CHARACTER VARYING(100),
+        city CHARACTER VARYING(100)
+    """,
+    "category": """
+        category_id INTEGER PRIMARY KEY,
+        category_name CHARACTER VARYING(50)
+    """,
+    "supplier": """
+        supplier_id INTEGER PRIMARY KEY,
+        supplier_name CHARACTER VARYING(255),
+        email CHARACTER VARYING(255)
+    """,
+    "payment_method": """
+        payment_method_id INTEGER PRIMARY KEY,
+        payment_method CHARACTER VARYING(50)
+    """,
+    "subcategory": """
+        subcategory_id INTEGER PRIMARY KEY,
+        subcategory_name CHARACTER VARYING(50),
+        category_id INTEGER
+    """,
+    "product": """
+        product_id INTEGER PRIMARY KEY,
+        name CHARACTER VARYING(255),
+        price NUMERIC(10,2),
+        description TEXT,
+        subcategory_id INTEGER
+    """,
+    "customer": """
+        customer_id INTEGER PRIMARY KEY,
+        first_name CHARACTER VARYING(255),
+        last_name CHARACTER VARYING(255),
+        email CHARACTER VARYING(255),
+        location_id INTEGER
+    """,
+    "marketing_campaigns": """
+        campaign_id INTEGER PRIMARY KEY,
+        campaign_name CHARACTER VARYING(255),
+        offer_week INTEGER
+    """,
+    "customer_product_ratings": """
+        customerproductrating_id INTEGER PRIMARY KEY,
+        customer_id INTEGER,
+        product_id INTEGER,
+        ratings NUMERIC(2,1),
+        review CHARACTER VARYING(255),
+        sentiment CHARACTER VARYING(10)
+    """,
+    "orders": """
+        order_id_surrogate INTEGER PRIMARY KEY,
+        order_id INTEGER,
+        customer_id INTEGER,
+        order_timestamp TIMESTAMP,
+        campaign_id INTEGER,
+        amount INTEGER,
+        payment_method_id INTEGER
+    """,
+    "orderitem": """
+        orderitem_id INTEGER PRIMARY KEY,
+        order_id INTEGER,
+        product_id INTEGER,
+        quantity INTEGER,
+        supplier_id INTEGER,
+        subtotal NUMERIC(10,2),
+        discount NUMERIC(5,2)
+    """,
+    "returns": """
+        return_id INTEGER PRIMARY KEY,
+        order_id INTEGER,
+        product_id INTEGER,
+        return_date DATE,
+        reason TEXT,
+        amount_refunded NUMERIC(10,2)
+    """,
+}
+
+# Unlogged table holding a single row. Crash recovery empties every unlogged table, so an empty sentinel means the
+# unlogged staging tables were truncated.
+SENTINEL_TABLE = "unlogged_sentinel"
+
+
+def create_staging_schema(conn, logger):
+    sql_query = """
+        CREATE SCHEMA IF NOT EXISTS staging;
+    """
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(sql_query)
+            conn.commit()
+            logger.info("staging schema created successfully.")
+    except Exception as e:
+        logger.error(f"Failed to create staging schema. Error: {e}")
+
+
+def create_staging_tables(conn, logger, unlogged=False):
+    """
+    Creates the staging tables, as UNLOGGED tables when requested. Staging can always be re-extracted from
+    production, so unlogged tables trade crash safety for loads that write no WAL.
+    """
+    for table_name, columns in STAGING_TABLES.items():
+        sql_query = sql.SQL("CREATE {persistence} TABLE IF NOT EXISTS {table} ({columns})").format(
+            persistence=sql.SQL("UNLOGGED" if unlogged else ""),
+            table=sql.Identifier("staging", table_name),
+            columns=sql.SQL(columns)
+        )
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(sql_query)
+                conn.commit()
+                logger.info(f"staging.{table_name} table created successfully.")
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Failed to create staging.{table_name} table. Error: {e}")
+    create_batch_id_columns(conn, logger)
+    set_staging_persistence(conn, logger, unlogged)
+
+
+def create_batch_id_columns(conn, logger):
+    """
+    Adds the etl_batch_id column to the staging tables, so the rows of a failed staging run can be replaced when it
+    is retried.
+    """
+    try:
+        with conn.cursor() as cursor:
+            for table_name in STAGING_TABLES:
+                cursor.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS etl_batch_id BIGINT").format(
+                    sql.Identifier("staging", table_name)))
+            conn.commit()
+            logger.info("etl_batch_id columns created successfully.")
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Failed to create etl_batch_id columns. Error: {e}")
+
+
+def unlogged_staging_tables(conn):
+    """
+    Returns the staging tables that are currently unlogged.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'staging' AND c.relkind = 'r' AND c.relpersistence = 'u'
+              AND c.relname = ANY(%s)
+        """, (list(STAGING_TABLES),))
+        return [row[0] for row in cursor.fetchall()]
+
+
+def set_staging_persistence(conn, logger, unlogged):
+    """
+    Switches the staging tables between LOGGED and UNLOGGED, rewriting only the tables not in the requested mode,
+    and arms the crash sentinel while any of them is unlogged.
+
+    Returns:
+        list: The tables that were switched.
+    """
+    current = set(unlogged_staging_tables(conn))
+    switched = [table_name for table_name in STAGING_TABLES if (table_name in current) != unlogged]
+    with conn.cursor() as cursor:
+        for table_name in switched:
+            cursor.execute(sql.SQL("ALTER TABLE {} SET {}").format(
+                sql.Identifier("staging", table_name), sql.SQL("UNLOGGED" if unlogged else "LOGGED")))
+        if unlogged:
+            cursor.execute(sql.SQL("""
+                CREATE UNLOGGED TABLE IF NOT EXISTS {sentinel} (armed_at TIMESTAMP NOT NULL DEFAULT now());
+                INSERT INTO {sentinel} (armed_at) SELECT now() WHERE NOT EXISTS (SELECT 1 FROM {sentinel});
+            """).format(sentinel=sql.Identifier("staging", SENTINEL_TABLE)))
+    conn.commit()
+    if switched:
+        logger.info(f"Set {len(switched)} staging tables {'UNLOGGED' if unlogged else 'LOGGED'}: "
+                    f"{', '.join(switched)}")
+    return switched
+
+
+def crash_truncated_staging_tables(conn):
+    """
+    Detects unlogged staging tables emptied by crash recovery and re-arms the sentinel inside the caller's
+    transaction.
+
+    Returns:
+        list: The unlogged staging tables that were truncated, empty if there was no crash since the last check.
+    """
+    unlogged = unlogged_staging_tables(conn)
+    if not unlogged:
+        return []
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", (f"staging.{SENTINEL_TABLE}",))
+        if cursor.fetchone()[0] is None:
+            return []
+        cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(
+            sql.Identifier("staging", SENTINEL_TABLE)))
+        if cursor.fetchone()[0]:
+            return []
+        cursor.execute(sql.SQL("INSERT INTO {} DEFAULT VALUES").format(sql.Identifier("staging", SENTINEL_TABLE)))
+    return unlogged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the warehouse staging tables.")
+    parser.add_argument("--unlogged", action="store_true",
+                        help="create the staging tables UNLOGGED, or switch existing ones to UNLOGGED")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        database="warehouse",
+        user="postgres",
+        password="swati",
+        host="localhost",
+        port="5432"
+    )
+    logger = intialize_logger()
+    create_staging_schema(conn, logger)
+    create_staging_tables(conn, logger, unlogged=args.unlogged)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""
+Generates a synthetic production (OLTP) database, see oltp_table_create.py, to benchmark the pipeline against.
+
+Every table is sampled column by column with NumPy and streamed into production with COPY, so a scale factor 1
+database (100,000 orders) loads in seconds and scale factor 100 (10 million orders) in minutes. The data is
+referentially valid: order items reference existing orders, products and suppliers, discounts come from the
+campaign running in the week of the order, and order amounts add up their discounted items.
+"""
+import argparse
+import io
+import time
+
+import numpy as np
+import psycopg2
+from psycopg2 import sql
+
+from etl_logging import setup_logging
+from pipeline import PRODUCTION_DSN
+
+# Orders generated per unit of scale factor: SF1 = 100,000 orders, SF100 = 10,000,000 orders
+ORDERS_PER_SCALE_FACTOR = 100000
+
+# Rows copied per COPY chunk, bounding the memory of the text conversion
+COPY_CHUNK_ROWS = 500000
+
+# The core load dates campaigns by their offer_week counted from this day, see delta_core_load_campaign_dimension
+CAMPAIGN_EPOCH = np.datetime64("2022-01-01")
+
+CATEGORIES = {
+    "Electronics": ["Phones", "Laptops", "Tablets", "Cameras", "Audio"],
+    "Home": ["Furniture", "Kitchen", "Bedding", "Lighting", "Decor"],
+    "Fashion": ["Shirts", "Shoes", "Dresses", "Jackets", "Accessories"],
+    "Sports": ["Fitness", "Cycling", "Running", "Camping", "Swimming"],
+    "Books": ["Fiction", "Science", "History", "Children", "Comics"],
+    "Beauty": ["Skincare", "Makeup", "Haircare", "Fragrance", "Grooming"],
+    "Toys": ["Puzzles", "Dolls", "Board Games", "Building Sets", "Outdoor Toys"],
+    "Grocery": ["Snacks", "Beverages", "Pantry", "Dairy", "Frozen"],
+    "Automotive": ["Tools", "Car Care", "Tyres", "Car Electronics", "Parts"],
+    "Garden": ["Plants", "Seeds", "Garden Tools", "Watering", "Outdoor Furniture"],
+}
+
+PAYMENT_METHODS = ["Credit Card", "Debit Card", "PayPal", "Bank Transfer", "Cash on Delivery"]
+
+# (country, state, city, latitude, longitude)
+CITIES = [
+    ("India", "Maharashtra", "Mumbai", 19.08, 72.88),
+    ("India", "Karnataka", "Bengaluru", 12.97, 77.59),
+    ("India", "Delhi", "New Delhi", 28.61, 77.21),
+    ("United States", "New York", "New York", 40.71, -74.01),
+    ("United States", "California", "San Francisco", 37.77, -122.42),
+    ("United States", "Texas", "Austin", 30.27, -97.74),
+    ("United Kingdom", "England", "London", 51.51, -0.13),
+    ("Germany", "Berlin", "Berlin", 52.52, 13.40),
+    ("France", "Ile-de-France", "Paris", 48.86, 2.35),
+    ("Japan", "Tokyo", "Tokyo", 35.68, 139.69),
+    ("Brazil", "Sao Paulo", "Sao Paulo", -23.55, -46.63),
+    ("Australia", "New South Wales", "Sydney", -33.87, 151.21),
+]
+
+FIRST_NAMES = ["Aarav", "Priya", "James", "Mary", "Liam", "Emma", "Noah", "Olivia", "Arjun", "Ananya", "Lucas",
+               "Sofia", "Ethan", "Mia", "Rohan", "Isha", "Hiro", "Yuki", "Mateo", "Chloe"]
+LAST_NAMES = ["Sharma", "Patel", "Smith", "Johnson", "Brown", "Garcia", "Mueller", "Martin", "Tanaka", "Silva",
+              "Kumar", "Singh", "Williams", "Jones", "Rossi", "Dubois", "Sato", "Lopez", "Taylor", "Khan"]
+
+DESCRIPTIONS = ["Best seller in its range.", "Great value for money.", "Premium quality build.",
+                "Compact and lightweight.", "Limited edition.", "Eco friendly materials."]
+
+CAMPAIGN_THEMES = ["Flash Sale", "Weekend Deals", "Clearance", "Festive Offers", "Mega Savings", "New Arrivals"]
+
+RETURN_REASONS = ["Damaged on arrival", "Wrong item delivered", "Did not match description", "Changed my mind",
+                  "Better price elsewhere", "Size or fit issue"]
+
+REVIEWS = {
+    "negative": ["Very disappointed.", "Stopped working after a week.", "Not worth the price."],
+    "neutral": ["It is okay.", "Does the job.", "Average quality."],
+    "positive": ["Excellent product!", "Exceeded my expectations.", "Would buy again."],
+}
+
+# Shares of the order lines that get returned and rated, and of the orders placed during a campaign
+RETURN_RATE = 0.05
+RATING_RATE = 0.10
+CAMPAIGN_ORDER_RATE = 0.30
+
+
+def table_sizes(scale_factor):
+    """
+    Returns the number of rows of the independently sized tables at a scale factor.
+    """
+    return {
+        "location": max(100, int(1000 * scale_factor)),
+        "customer": max(1000, int(20000 * scale_factor)),
+        "product": max(500, int(5000 * scale_factor)),
+        "supplier": max(20, int(100 * scale_factor)),
+        "orders": max(1, int(ORDERS_PER_SCALE_FACTOR * scale_factor)),
+    }
+
+
+def skewed_ids(rng, count, size):
+    """
+    Samples size ids out of 1..count with low ids much more popular than high ones, like best-selling products
+    and loyal customers.
+    """
+    return (rng.random(size) ** 3 * count).astype(np.int64) + 1
+
+
+def pick(rng, values, size):
+    """
+    Samples size entries of a list of strings.
+    """
+    return np.asarray(values)[rng.integers(0, len(values), size)]
+
+
+def generate_tables(scale_factor, seed=42, start_date="2022-01-01", days=364):
+    """
+    Generates the OLTP tables at a scale factor.
+
+    Args:
+        scale_factor (float): Size of the database, in units of 100,000 orders.
+        seed (int): Seed of the random generator, the same seed yields the same database.
+        start_date (str): Day of the first order.
+        days (int): Days the orders are spread over.
+
+    Returns:
+        dict: The columns of each table, as {table: {column: array}}, in load order.
+    """
+    rng = np.random.default_rng(seed)
+    sizes = table_sizes(scale_factor)
+    tables = {}
+
+    n = sizes["location"]
+    cities = np.asarray(CITIES, dtype=object)[rng.integers(0, len(CITIES), n)]
+    tables["location"] = {
+        "location_id": np.arange(1, n + 1),
+        "latitude": np.round(cities[:, 3].astype(float) + rng.normal(0, 0.2, n), 6),
+        "longitude": np.round(cities[:, 4].astype(float) + rng.normal(0, 0.2, n), 6),
+        "country": cities[:, 0].astype(str),
+        "state": cities[:, 1].astype(str),
+        "city": cities[:, 2].astype(str),
+    }
+
+    n = sizes["customer"]
+    customer_ids = np.arange(1, n + 1)
+    first_names, last_names = pick(rng, FIRST_NAMES, n), pick(rng, LAST_NAMES, n)
+    tables["customer"] = {
+        "customer_id": customer_ids,
+        "first_name": first_names,
+        "last_name": last_names,
+        "email": np.char.add(np.char.add(np.char.lower(np.char.add(np.char.add(first_names, "."), last_names)), "."),
+                             np.char.add(customer_ids.astype(str), "@example.com")),
+        "location_id": rng.integers(1, sizes["location"] + 1, n),
+    }
+
+    tables["category"] = {
+        "category_id": np.arange(1, len(CATEGORIES) + 1),
+        "category_name": np.asarray(list(CATEGORIES)),
+    }
+    subcategory_names = [name for names in CATEGORIES.values() for name in names]
+    subcategory_count = len(subcategory_names)
+    tables["subcategory"] = {
+        "subcategory_id": np.arange(1, subcategory_count + 1),
+        "subcategory_name": np.asarray(subcategory_names),
+        "category_id": np.repeat(np.arange(1, len(CATEGORIES) + 1), [len(names) for names in CATEGORIES.values()]),
+    }
+
+    n = sizes["product"]
+    product_ids = np.arange(1, n + 1)
+    product_subcategories = rng.integers(1, subcategory_count + 1, n)
+    prices = np.round(np.clip(rng.lognormal(3.5, 1.0, n), 1, 5000), 2)
+    tables["product"] = {
+        "product_id": product_ids,
+        "name": np.char.add(np.char.add(np.asarray(subcategory_names)[product_subcategories - 1], " #"),
+                            product_ids.astype(str)),
+        "price": prices,
+        "description": pick(rng, DESCRIPTIONS, n),
+        "subcategory_id": product_subcategories,
+    }
+
+    n = sizes["supplier"]
+    supplier_ids = np.arange(1, n + 1).astype(str)
+    tables["supplier"] = {
+        "supplier_id": np.arange(1, n + 1),
+        "supplier_name": np.char.add("Supplier ", supplier_ids),
+        "email": np.char.add(np.char.add("supplier", supplier_ids), "@example.com"),
+    }
+
+    tables["payment_method"] = {
+        "payment_method_id": np.arange(1, len(PAYMENT_METHODS) + 1),
+        "payment_method": np.asarray(PAYMENT_METHODS),
+    }
+
+    # One campaign per week of the year, its id is its offer_week
+    weeks = np.arange(1, 53)
+    tables["marketing_campaigns"] = {
+        "campaign_id": weeks,
+        "campaign_name": np.char.add(np.char.add(pick(rng, CAMPAIGN_THEMES, len(weeks)), " Week "), weeks.astype(str)),
+        "offer_week": weeks,
+    }
+
+    # Every campaign discounts five subcategories, kept as a dense (campaign, subcategory) lookup for the order lines
+    discounted = np.argsort(rng.random((len(weeks), subcategory_count)), axis=1)[:, :5] + 1
+    discounts = rng.integers(1, 11, discounted.shape) * 0.05
+    tables["campaign_product_subcategory"] = {
+        "campaign_product_subcategory_id": np.arange(1, discounted.size + 1),
+        "campaign_id": np.repeat(weeks, discounted.shape[1]),
+        "subcategory_id": discounted.ravel(),
+        "discount": np.round(discounts.ravel(), 2),
+    }
+    discount_lookup = np.zeros((len(weeks) + 1, subcategory_count + 1))
+    discount_lookup[np.repeat(weeks, discounted.shape[1]), discounted.ravel()] = discounts.ravel()
+
+    # Orders, numbered in time order like the production sequence would
+    n = sizes["orders"]
+    order_ids = np.arange(1, n + 1)
+    start = np.datetime64(start_date, "s")
+    order_timestamps = start + np.sort(rng.integers(0, days * 86400, n)).astype("timedelta64[s]")
+    order_weeks = (order_timestamps.astype("datetime64[D]") - CAMPAIGN_EPOCH).astype(np.int64) // 7 + 1
+    in_campaign = (rng.random(n) < CAMPAIGN_ORDER_RATE) & (order_weeks >= 1) & (order_weeks <= len(weeks))
+    # Orders outside any campaign have no campaign_id, the core load gives them the "No campaign" member
+    order_campaigns = np.where(in_campaign, order_weeks, 0)
+    order_customers = skewed_ids(rng, sizes["customer"], n)
+
+    # Order lines, one to five per order
+    lines = rng.integers(1, 6, n)
+    line_orders = np.repeat(np.arange(n), lines)
+    m = len(line_orders)
+    line_products = skewed_ids(rng, sizes["product"], m)
+    quantities = rng.integers(1, 5, m)
+    subtotals = np.round(prices[line_products - 1] * quantities, 2)
+    line_discounts = discount_lookup[order_campaigns[line_orders], product_subcategories[line_products - 1]]
+    sales_prices = np.round(subtotals * (1 - line_discounts), 2)
+    tables["orders"] = {
+        "order_id_surrogate": order_ids,
+        "order_id": order_ids,
+        "customer_id": order_customers,
+        "order_timestamp": order_timestamps,
+        "campaign_id": np.ma.masked_equal(order_campaigns, 0),
+        "amount": np.rint(np.bincount(line_orders, weights=sales_prices, minlength=n)).astype(np.int64),
+        "payment_method_id": rng.integers(1, len(PAYMENT_METHODS) + 1, n),
+    }
+    tables["orderitem"] = {
+        "orderitem_id": np.arange(1, m + 1),
+        "order_id": order_ids[line_orders],
+        "product_id": line_products,
+        "quantity": quantities,
+        "supplier_id": rng.integers(1, sizes["supplier"] + 1, m),
+        "subtotal": subtotals,
+        "discount": np.round(line_discounts, 2),
+    }
+
+    returned = np.flatnonzero(rng.random(m) < RETURN_RATE)
+    return_dates = (order_timestamps[line_orders[returned]].astype("datetime64[D]")
+                    + rng.integers(1, 31, len(returned)).astype("timedelta64[D]"))
+    tables["returns"] = {
+        "return_id": np.arange(1, len(returned) + 1),
+        "order_id": order_ids[line_orders[returned]],
+        "product_id": line_products[returned],
+        "return_date": return_dates,
+        "reason": pick(rng, RETURN_REASONS, len(returned)),
+        "amount_refunded": sales_prices[returned],
+    }
+
+    rated = np.flatnonzero(rng.random(m) < RATING_RATE)
+    ratings = rng.integers(2, 11, len(rated)) / 2
+    sentiment_index = np.digitize(ratings, [3.0, 4.0])
+    sentiments = np.asarray(list(REVIEWS))[sentiment_index]
+    reviews = np.asarray(list(REVIEWS.values()))[sentiment_index, rng.integers(0, 3, len(rated))]
+    tables["customer_product_ratings"] = {
+        "customerproductrating_id": np.arange(1, len(rated) + 1),
+        "customer_id": order_customers[line_orders[rated]],
+        "product_id": line_products[rated],
+        "ratings": ratings,
+        "review": reviews,
+        "sentiment": sentiments,
+    }
+    return tables
+
+
+def copy_table(cursor, table_name, columns, logger):
+    """
+    Streams the columns of a table into production with COPY, converting them to text one chunk at a time.
+    Masked entries are written as NULL.
+
+    Returns:
+        int: The number of rows copied.
+    """
+    rows = len(next(iter(columns.values())))
+    copy_query = sql.SQL("COPY {} ({}) FROM STDIN").format(
+        sql.Identifier("public", table_name), sql.SQL(", ").join(map(sql.Identifier, columns)))
+    for start in range(0, rows, COPY_CHUNK_ROWS):
+        text_columns = []
+        for values in columns.values():
+            chunk = values[start:start + COPY_CHUNK_ROWS]
+            text = np.asarray(chunk).astype(str)
+            if np.ma.is_masked(chunk):
+                text = np.where(np.ma.getmaskarray(chunk), "\\N", text)
+            text_columns.append(text.tolist())
+        buffer = io.StringIO("\n".join(map("\t".join, zip(*text_columns))) + "\n")
+        cursor.copy_expert(copy_query, buffer)
+    logger.info(f"Copied {rows} rows into public.{table_name}.")
+    return rows
+
+
+def load_tables(conn, tables, logger, replace=False):
+    """
+    Loads generated tables into production in a single transaction.
+
+    orders and orderitem reference each other, so the foreign key triggers are switched off for the load with
+    session_replication_role = replica, which needs a superuser. The generated data is referentially valid, so
+    nothing is left unchecked. The SERIAL sequences are moved past the generated ids afterwards.
+
+    Args:
+        conn (connection): Connection to the production database.
+        tables (dict): The generated tables, see generate_tables.
+        logger (Logger): The logger object for logging.
+        replace (bool): Empty the tables first. Without it the load refuses to run on non-empty tables.
+    """
+    table_identifiers = sql.SQL(", ").join(sql.Identifier("public", table_name) for table_name in tables)
+    with conn.cursor() as cursor:
+        if replace:
+            cursor.execute(sql.SQL("TRUNCATE TABLE {} RESTART IDENTITY").format(table_identifiers))
+        else:
+            for table_name in tables:
+                cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(
+                    sql.Identifier("public", table_name)))
+                if cursor.fetchone()[0]:
+                    raise ValueError(f"public.{table_name} is not empty, use --replace to overwrite it")
+
+        cursor.execute("SET LOCAL session_replication_role = replica")
+        for table_name, columns in tables.items():
+            copy_table(cursor, table_name, columns, logger)
+            id_column = next(iter(columns))
+            cursor.execute(sql.SQL("SELECT setval(pg_get_serial_sequence(%s, %s), GREATEST(max({}), 1)) FROM {}")
+                           .format(sql.Identifier(id_column), sql.Identifier("public", table_name)),
+                           (f"public.{table_name}", id_column))
+    conn.commit()
+
+    # ANALYZE cannot run inside the load transaction
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("ANALYZE {}").format(table_identifiers))
+    conn.autocommit = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the production database with synthetic data.")
+    parser.add_argument("--scale-factor", type=float, default=1.0,
+                        help="size of the database in units of 100,000 orders (default: 1)")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the random generator")
+    parser.add_argument("--start-date", default="2022-01-01", help="day of the first order")
+    parser.add_argument("--days", type=int, default=364, help="days the orders are spread over")
+    parser.add_argument("--replace", action="store_true", help="empty the production tables first")
+    args = parser.parse_args()
+
+    logger = setup_logging("synthetic_data_generator.log")
+    started = time.perf_counter()
+    tables = generate_tables(args.scale_factor, args.seed, args.start_date, args.days)
+    generated = time.perf_counter()
+    logger.info(f"Generated scale factor {args.scale_factor} in {generated - started:.1f}s.")
+
+    conn = psycopg2.connect(**PRODUCTION_DSN)
+    try:
+        load_tables(conn, tables, logger, args.replace)
+    finally:
+        conn.close()
+    logger.info(f"Loaded scale factor {args.scale_factor} in {time.perf_counter() - generated:.1f}s.")
+
+
+if __name__ == "__main__":
+    main()